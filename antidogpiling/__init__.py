@@ -60,6 +60,84 @@ In addition, one can specify the grace time per value. The grace time is the
 number of seconds a client is given to try to produce a new value after the
 current value has timed out. If the client fails to produce a new value within
 the grace period, a new client is given the chance for an equally long time.
+
+By default, the renewal is granted by writing the new soft timeout back to the
+cache, which leaves a small window where several clients can read the timed out
+value before the write-back lands. With the "lease" renewal mode, the renewal
+is instead claimed by atomically adding a short-lived lease key next to the
+value, so exactly one client is let through per grace period. Subclasses must
+implement _add_directly to support that mode.
+
+The "xfetch" renewal mode additionally lets each client decide on its own to
+renew a value slightly before its soft timeout, using a random draw weighted by
+the time it took to compute the value (probabilistic early expiration). The
+renewals are spread out over time without any write-backs. The compute time
+must be provided when adding the value. Values that still reach their soft
+timeout are renewed like in the "grace" mode.
+
+Finally, get_or_set(key, producer, timeout) gets a value, or produces and sets
+it. Concurrent producers for the same key are coalesced within the process, and
+a lease key is claimed across processes when the value is not in the cache at
+all, so a cold cache costs one computation per key. Subclasses must implement
+_get_directly, _add_directly, and _delete_directly to use it.
+
+The antidogpiled method makes a decorator caching the return values of a
+function with get_or_set (see antidogpiling.decorators).
+
+With the single_flight option, concurrent gets for the same key within the
+process share one fetch from the cache as well (see _get_coalesced).
+
+With the refresh_workers option, a client granted the renewal of a value can
+be served the old value as well (stale-while-revalidate), while the value is
+produced by a pool of background threads. The producers are registered per key
+or key prefix with register_producer, or given to get_or_set.
+
+The asynchronous counterparts of the methods above (prefixed with "a", like
+_aapply_anti_dogpiling and aget_or_set) are for use from coroutines. They run
+the renewal write-backs as background tasks, so no client waits for them.
+Subclasses should override the asynchronous direct methods, which block by
+default.
+
+With the l1_max_entries option, fresh values are also kept in a process-local
+LRU tier (L1) until their soft timeout, and served from there without going to
+the cache at all. Values being renewed are not kept locally, so the renewal
+decisions are still made by the shared cache.
+
+Timeouts and grace times may be floats. The soft timeouts are measured by the
+clock option (time.time by default, see antidogpiling.clock), while the hard
+timeouts passed on to the cache are rounded up to whole seconds.
+
+With the invalidation option set to "marker", values are invalidated softly by
+writing a small marker next to them (see _mark_invalidated), fetched along with
+the values on every get. Values are stamped when set or granted for renewal,
+and values stamped before their marker are renewed.
+
+Values may be tagged when added, and all values with a tag invalidated softly
+with soft_invalidate_tag, by a marker per tag, compared with the stamps of the
+values the same way.
+
+With the compress_threshold option, large values are compressed inside the
+wrappers, and only decompressed when used (see Wrapper).
+
+With the chunk_size option, large values are split into chunks under keys of
+their own, written with set_many along with the wrapper, which carries the
+manifest of the chunks, and fetched with get_many after it. Subclasses must
+implement _set_many_directly and _get_many_directly to use it.
+
+With the writeback option set to "background", the grace period write-backs
+are queued for a background thread writing them in batches with
+_set_many_directly (see antidogpiling.writeback), instead of being written
+before the client granted the renewal gets on with producing the value.
+
+Besides the Django backends, there are native backends built on this class
+(see antidogpiling.native), claiming the renewals in place:
+antidogpiling.redis, deciding the renewals on the Redis server,
+antidogpiling.sql, claiming them with a conditional update in a database,
+antidogpiling.filebased, claiming them in the headers of the files, and
+antidogpiling.memory, swapping the wrappers kept by reference in memory.
+
+With the metrics option, the outcome of every get is counted, and the calls to
+the cache are timed (see antidogpiling.metrics).
 """
 
 
@@ -68,29 +146,428 @@ __version__ = "1.1.3"
 __docformat__ = "restructuredtext"
 
 
+import asyncio
+import functools
+import importlib
+import inspect
+import math
+import pickle
+import random
+import struct
+import threading
 import time
+import zlib
+
+try:
+    import lzma
+except ImportError: # Python built without lzma
+    lzma = None
+
+from antidogpiling.decorators import antidogpiled
+from antidogpiling.flight import FlightTable
+from antidogpiling.lru import LRUCache
+from antidogpiling.metrics import (GRACE_EXPIRED, HARD_HIT, MISS,
+                                   RENEWAL_GRANTED, SOFT_HIT, STALE_SERVE,
+                                   timed)
+from antidogpiling.refresh import RefreshPool
+from antidogpiling.writeback import WriteBehind
+
+
+def _whole_seconds(seconds):
+    """
+    Round a timeout up to whole seconds, for the backends only supporting
+    those. Rounding down could make a timeout below one second infinite.
+    """
+
+    return int(math.ceil(seconds))
+
+
+def _as_bool(value):
+    """
+    Interpret an option value as a boolean, also when given as a string (like
+    in the Django 1.2 cache backend URIs).
+    """
+
+    if isinstance(value, str):
+        return value.lower() not in ("", "0", "false", "no", "off")
+    return bool(value)
+
+
+def _as_jitter(value):
+    """
+    Interpret a jitter option value: a number of seconds, or a percentage of
+    the timeout when given as a string ending with "%". A tuple of the amount
+    and whether it is relative to the timeout is returned.
+    """
+
+    if isinstance(value, str) and value.endswith("%"):
+        return float(value[:-1]) / 100, True
+    return float(value or 0), False
+
+
+def _jitter(jitter, timeout):
+    """
+    Draw a random jitter between 0 and the jitter window of a timeout, which
+    is never longer than the timeout itself.
+    """
+
+    amount, relative = jitter
+    window = min(amount * timeout if relative else amount, timeout)
+    return random.uniform(0, window)
+
+
+def _unjitter(jitter, timeout):
+    """
+    Estimate the timeout a timeout lengthened by a jitter was drawn from,
+    taking off half the jitter window, as drawn on average.
+    """
+
+    amount, relative = jitter
+    if not amount:
+        return timeout
+    if relative:
+        return timeout / (1 + min(amount, 1) / 2)
+    return max(timeout - amount / 2, timeout / 1.5)
+
+
+_shared_state = {} # (Scope, factory, args): Object
+_shared_state_lock = threading.Lock()
+
+
+def _shared(scope, factory, *args):
+    """
+    Get the object made by factory(*args) for the given scope, creating it if
+    needed. Without a scope, a new object is made.
+    """
+
+    if scope is None:
+        return factory(*args)
+    with _shared_state_lock:
+        state_key = (scope, factory, args)
+        if state_key not in _shared_state:
+            _shared_state[state_key] = factory(*args)
+        return _shared_state[state_key]
+
+
+def _pickled_size(entry):
+    """
+    Estimate the size of a process-local tier entry by its pickled value.
+    """
+
+    return len(pickle.dumps(entry[0], -1))
+
+
+def _import(path):
+    """
+    Import an object by its dotted path.
+    """
+
+    module, name = path.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
+
+
+SHEDDING_POLICIES = ("renew", "stale")
+"""
+What to do when a background refresh is shed because the refresh queue is
+full: let the client renew the value itself, or serve it the old value.
+"""
 
+RENEWAL_MODES = ("grace", "lease", "xfetch")
+"""
+The supported ways of granting the renewal of a value which has timed out
+softly.
+"""
+
+WRITEBACK_MODES = ("sync", "background")
+"""
+The supported ways of writing back the new soft timeout of a value being
+renewed: right away, or by a background writer, in batches.
+"""
+
+LEASE_SUFFIX = ":adp-lease"
+"""
+Appended to a key to make the key of its lease. Renewal leases have the soft
+timeout of the value being renewed appended as well, so that each soft timeout
+of a value has its own lease.
+"""
+
+INVALIDATION_MODES = ("rewrite", "marker")
+"""
+The supported ways of invalidating values softly: rewriting them with a soft
+timeout of 0, or writing an invalidation marker next to them.
+"""
+
+MARKER_SUFFIX = ":adp-inv"
+"""
+Appended to a key to make the key of its invalidation marker, holding the time
+of the last soft invalidation of the key.
+"""
+
+CHUNK_INFIX = ":adp-chunk:"
+"""
+Inserted between a key and the token and index of a chunk to make the key of
+the chunk. Each write of a chunked value has its own token, so chunks of
+different writes are never mixed.
+"""
+
+TAG_PREFIX = "adp-tag:"
+"""
+Prepended to a tag to make the key of its invalidation marker, holding the
+time of the last soft invalidation of the values with the tag.
+"""
+
+COMPRESSION_CODECS = {"zlib": (0x04, zlib.compress, zlib.decompress)}
+"""
+The supported compression codecs, by name: the header flag, compress, and
+decompress functions of each.
+"""
+
+if lzma is not None:
+    COMPRESSION_CODECS["lzma"] = (0x08, lzma.compress, lzma.decompress)
 
-_now = lambda: int(time.time())
+_DECOMPRESS = dict((flag, decompress) for flag, _, decompress in
+                   COMPRESSION_CODECS.values())
+
+_UNDECODED = object()
+"""
+The value of a wrapper whose value is not yet decoded from its payload.
+"""
+
+_INLINE_TYPES = (type(None), bool, int, float, str, bytes)
 """
-Get the current absolute time in seconds since epoch.
+The types of values pickled inline in the wrappers, as they are unpickled as
+cheaply as their payloads would be copied.
 """
 
 
 class Wrapper(object):
     """
     Wrapper for cached values with anti-dogpiling enabled.
+
+    Wrappers are pickled compactly, as a call to _restore with a fixed-size
+    binary header (see HEADER), the value, and the tags, if any. Wrappers
+    pickled by earlier versions, with an instance dict or an older header,
+    are still unpickled.
+
+    Values other than simple scalars (see _INLINE_TYPES) are pickled on
+    their own, as an opaque payload, and compressed if the compression is set
+    and the payload is large enough. So are strings large enough to compress.
+    When unpickled, the payload is only decoded when the value is first used,
+    so the timeouts can be checked, and the renewal decided, without paying
+    for decoding a value which is thrown away. The payload is kept, and reused
+    when the wrapper is pickled again (like by the renewal write-back), until
+    the value is replaced.
+
+    A payload may also be split into chunks, kept under keys of their own (see
+    AntiDogpiling._split). The wrapper is then pickled with the manifest of
+    the chunks (their token and count) instead of the payload, and the
+    payload has to be joined from the chunks after unpickling.
+    """
+
+    __slots__ = ("_value", "_payload", "soft_timeout", "hard_timeout",
+                 "grace_time", "compute_time", "renewing", "stamp", "tags",
+                 "compression", "chunks")
+
+    HEADER = struct.Struct("!BBdIffd")
+    """
+    The serialized header: format version, flags, soft timeout, hard timeout,
+    grace time, compute time, and stamp.
+    """
+
+    FORMAT_VERSION = 2
+
+    OLD_HEADERS = {1: struct.Struct("!BBdIff")}
+    """
+    The headers of earlier format versions, without the fields added since.
+    """
+
+    RENEWING = 0x01
+    """
+    Header flag for whether the soft timeout is the end of a grace period,
+    i.e. whether the value is being renewed. Set by the renewal write-back.
+    """
+
+    PICKLED = 0x02
+    """
+    Header flag for whether the value is given as a pickle (the payload), to
+    be decoded when first used.
+    """
+
+    CODEC_FLAGS = 0x0C
+    """
+    Header flags of the codec the payload is compressed with, if any.
     """
 
-    def __init__(self, value, soft_timeout, hard_timeout, grace_time):
+    CHUNKED = 0x10
+    """
+    Header flag for whether the value is given as the manifest of the chunks
+    of the payload.
+    """
+
+    def __init__(self, value, soft_timeout, hard_timeout, grace_time,
+                 compute_time=0, stamp=0, tags=()):
         """
-        Set the wrapper values.
+        Set the wrapper values. The stamp is the time the value was set or
+        last granted for renewal, compared with the invalidation markers of
+        the key and the tags.
         """
 
-        self.value = value
+        self._value = value
+        self._payload = None # (Flags, data), when encoded
         self.soft_timeout = soft_timeout # Absolute
         self.hard_timeout = hard_timeout # Relative
         self.grace_time = grace_time # Relative
+        self.compute_time = compute_time # Relative
+        self.stamp = stamp # Absolute
+        self.tags = tuple(tags)
+        self.compression = None # (Codec name, threshold in bytes)
+        self.chunks = None # (Token, count), when chunked
+        self.renewing = False
+
+    @property
+    def value(self):
+        """
+        The wrapped value, decoded from the payload when first used.
+        """
+
+        if self._value is _UNDECODED:
+            flags, data = self._payload
+            if flags & self.CODEC_FLAGS:
+                data = _DECOMPRESS[flags & self.CODEC_FLAGS](data)
+            self._value = pickle.loads(data)
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._payload = None
+        self.chunks = None
+
+    @property
+    def joined(self):
+        """
+        Whether the payload is available, i.e. not left in chunks.
+        """
+
+        return self.chunks is None or self._payload[1] is not None
+
+    def _join(self, chunks):
+        """
+        Set the payload joined from its chunks.
+        """
+
+        self._payload = self._payload[0], b"".join(chunks)
+
+    def _load(self, flags, data):
+        """
+        Set the payload as read from a cache storing it on its own, with the
+        given header flags, to be decoded when first used.
+        """
+
+        self._value = _UNDECODED
+        self._payload = flags & (self.PICKLED | self.CODEC_FLAGS), data
+
+    def _pickled(self):
+        """
+        Get the header flags and the payload, pickling the value even if of a
+        simple type.
+        """
+
+        flags, data = self._encode()
+        if not flags & self.PICKLED:
+            flags, data = self._payload = (
+                self.PICKLED, pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        return flags, data
+
+    @property
+    def empty(self):
+        """
+        Whether the wrapped value is None, without decoding it.
+        """
+
+        return self._value is None
+
+    def _encode(self):
+        """
+        Get the header flags and the value to pickle: the payload if already
+        encoded, or the value itself if of a simple type (unless a string
+        large enough to compress), or else the value pickled (and compressed
+        if large enough with compression set).
+        """
+
+        if self.chunks is not None:
+            return self._payload[0] | self.CHUNKED, self.chunks
+        if self._payload is not None:
+            return self._payload
+        if isinstance(self._value, _INLINE_TYPES) and (
+                self.compression is None or
+                not isinstance(self._value, (str, bytes)) or
+                len(self._value) < self.compression[1]):
+            return 0, self._value
+
+        data = pickle.dumps(self._value, pickle.HIGHEST_PROTOCOL)
+        self._payload = self.PICKLED, data
+        if self.compression is None:
+            return self._payload
+
+        codec, threshold = self.compression
+        if len(data) >= threshold:
+            flag, compress, _ = COMPRESSION_CODECS[codec]
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                self._payload = self.PICKLED | flag, compressed
+        return self._payload
+
+    def __reduce__(self):
+        """
+        Pickle as a call to _restore with the packed header and the value (or
+        its payload).
+        """
+
+        flags, value = self._encode()
+        if self.renewing:
+            flags |= self.RENEWING
+        header = self.HEADER.pack(self.FORMAT_VERSION, flags,
+                                  self.soft_timeout, int(self.hard_timeout),
+                                  self.grace_time, self.compute_time,
+                                  self.stamp)
+        if self.tags:
+            return _restore, (header, value, self.tags)
+        return _restore, (header, value)
+
+    def __setstate__(self, state):
+        """
+        Unpickle a wrapper pickled with an instance dict, by earlier versions.
+        """
+
+        self.__init__(state["value"], state["soft_timeout"],
+                      state["hard_timeout"], state["grace_time"],
+                      state.get("compute_time", 0))
+        self.renewing = state.get("renewing", False)
+
+
+def _restore(header, value, tags=()):
+    """
+    Unpickle a wrapper from its packed header, value, and tags.
+    """
+
+    version = header[0]
+    if version == Wrapper.FORMAT_VERSION:
+        fields = Wrapper.HEADER.unpack(header)
+    elif version in Wrapper.OLD_HEADERS:
+        fields = Wrapper.OLD_HEADERS[version].unpack(header) + (0,)
+    else:
+        raise ValueError("Unknown wrapper format version: %d" % version)
+
+    flags = fields[1]
+    wrapper = Wrapper(value, *fields[2:], tags=tags)
+    wrapper.renewing = bool(flags & Wrapper.RENEWING)
+    if flags & Wrapper.PICKLED:
+        wrapper._load(flags, value)
+    if flags & Wrapper.CHUNKED:
+        wrapper.chunks = tuple(value)
+        wrapper._payload = wrapper._payload[0], None
+    return wrapper
 
 
 class AntiDogpiling(object):
@@ -98,6 +575,21 @@ class AntiDogpiling(object):
     Base class for anti-dogpiling.
     """
 
+    OPTION_NAMES = ("hard_timeout_factor", "default_grace_time", "renewal",
+                    "xfetch_beta", "writeback", "writeback_queue_size",
+                    "soft_timeout_jitter",
+                    "hard_timeout_jitter", "invalidation",
+                    "invalidation_marker_timeout", "compress_threshold",
+                    "compress_codec", "chunk_size", "lease_poll_interval",
+                    "single_flight",
+                    "single_flight_max_keys", "l1_max_entries",
+                    "l1_max_bytes", "refresh_workers", "refresh_queue_size",
+                    "refresh_shedding", "refresh_producers", "metrics",
+                    "clock")
+    """
+    The keyword arguments consumed by the initializer.
+    """
+
     def __init__(self, *args, **kwargs):
         """
         Initialize the anti-dogpiling with base values.
@@ -107,10 +599,240 @@ class AntiDogpiling(object):
                 cached for 1 hour, it will actually stay in the cache for 8
                 hours.
         :param default_grace_time: The default is 60 seconds.
+        :param renewal: How the renewal of a softly timed out value is
+                granted. "grace" (the default) writes a new soft timeout back
+                to the cache. "lease" first claims a lease key with an atomic
+                add, and lets everyone failing to claim it have the old value.
+                "xfetch" renews values probabilistically before they time out.
+        :param xfetch_beta: Scales the early renewals in the "xfetch" renewal
+                mode. Above 1 favors earlier renewals, below 1 later ones.
+                The default is 1.
+        :param writeback: How the new soft timeout of a value being renewed
+                is written back. "sync" (the default) writes it before the
+                client granted the renewal gets on with producing the value.
+                "background" queues it for a background writer thread, which
+                writes everything queued in batches.
+        :param writeback_queue_size: The maximum number of write-backs waiting
+                for the background writer. Beyond it, values are written back
+                right away. The default is 1000.
+        :param invalidation: How values are invalidated softly. "rewrite"
+                (the default) fetches the value and writes it back with a soft
+                timeout of 0. "marker" only writes a small invalidation
+                marker next to the value, without fetching it, and the marker
+                is fetched along with the value on every get, in the same
+                round-trip. Values set with hard=True are not affected by the
+                markers, so delete those with hard=True.
+        :param invalidation_marker_timeout: How long (in seconds) the
+                invalidation markers of keys and tags are kept. It should be
+                at least as long as the longest hard timeout. The default is
+                30 days.
+        :param compress_threshold: Compress the values whose pickles are at
+                least this many bytes. The timeouts are still read without
+                decompressing. The default is 0, disabling the compression.
+        :param compress_codec: The compression codec, "zlib" (the default)
+                or "lzma".
+        :param chunk_size: Split the (pickled and compressed) values larger
+                than this many bytes into chunks of this size, kept under keys
+                of their own, written and read along with the value. The
+                default is 0, disabling the chunking.
+        :param soft_timeout_jitter: Shortens each soft timeout by a random
+                amount up to this window, so values set together are not all
+                renewed at once. A number of seconds, or a percentage of the
+                timeout as a string like "10%". The default is 0.
+        :param hard_timeout_jitter: Lengthens each hard timeout by a random
+                amount up to this window, given like soft_timeout_jitter (a
+                percentage is of the hard timeout). The default is 0.
+        :param lease_poll_interval: How often (in seconds) get_or_set polls
+                for a value being produced by another process. The default is
+                0.1 seconds.
+        :param single_flight: Whether concurrent gets for the same key within
+                the process should share one fetch from the cache. The default
+                is False. (Producers in get_or_set are always shared.)
+        :param single_flight_max_keys: The maximum number of keys being
+                fetched or produced at once, to bound the memory used for the
+                coalescing. Beyond it, calls are not coalesced. The default is
+                1000.
+        :param l1_max_entries: The maximum number of values to keep in the
+                process-local tier. The default is 0, disabling the tier.
+        :param l1_max_bytes: The maximum total size of the values in the
+                process-local tier, as estimated by their pickled size. The
+                default is 0, for no limit.
+        :param refresh_workers: The number of threads producing values in the
+                background, while the old values are served. The default is
+                0, disabling background refreshes.
+        :param refresh_queue_size: The maximum number of background refreshes
+                waiting for a thread. The default is 100.
+        :param refresh_shedding: What to do when the refresh queue is full.
+                "renew" (the default) lets the client renew the value itself.
+                "stale" serves the old value, leaving the renewal to a client
+                after the grace period.
+        :param refresh_producers: A dict of producers to register, by key or
+                key prefix (see register_producer). The producers may be given
+                by their dotted paths.
+        :param clock: A callable returning the current time in seconds since
+                epoch (see antidogpiling.clock), or its dotted path. A class is
+                instantiated. The default is time.time.
+        :param metrics: A Metrics object (see antidogpiling.metrics) counting
+                the outcome of every get and timing the calls to the cache, or
+                the dotted path of one, or of a callable returning one. The
+                default is None, disabling the metrics.
+        :param scope: The per-process state, like the calls in flight, the
+                process-local tier, and the background workers, is shared by
+                all instances with the same (hashable) scope, like the
+                per-thread instances of a Django cache. The default is None,
+                sharing nothing.
         """
 
+        scope = kwargs.pop("scope", None)
+
+        self._clock = kwargs.pop("clock", None) or time.time
+        if isinstance(self._clock, str):
+            self._clock = _import(self._clock)
+        if isinstance(self._clock, type):
+            self._clock = self._clock()
+
         self.hard_timeout_factor = int(kwargs.pop("hard_timeout_factor", 8))
-        self.default_grace_time = int(kwargs.pop("default_grace_time", 60))
+        self.default_grace_time = float(kwargs.pop("default_grace_time", 60))
+        self.renewal = kwargs.pop("renewal", "grace")
+        self.xfetch_beta = float(kwargs.pop("xfetch_beta", 1))
+        self.invalidation = kwargs.pop("invalidation", "rewrite")
+        self.invalidation_marker_timeout = int(kwargs.pop(
+            "invalidation_marker_timeout", 30 * 24 * 3600))
+        compress_threshold = int(kwargs.pop("compress_threshold", 0))
+        compress_codec = kwargs.pop("compress_codec", "zlib")
+        self._compression = None
+        if compress_threshold:
+            self._compression = (compress_codec, compress_threshold)
+        if compress_codec not in COMPRESSION_CODECS:
+            raise ValueError("Unknown compression codec: %r" %
+                             (compress_codec,))
+        self.chunk_size = int(kwargs.pop("chunk_size", 0))
+        self.soft_timeout_jitter = _as_jitter(kwargs.pop("soft_timeout_jitter",
+                                                         0))
+        self.hard_timeout_jitter = _as_jitter(kwargs.pop("hard_timeout_jitter",
+                                                         0))
+        self.lease_poll_interval = float(kwargs.pop("lease_poll_interval",
+                                                    0.1))
+        self.single_flight = _as_bool(kwargs.pop("single_flight", False))
+        single_flight_max_keys = int(kwargs.pop("single_flight_max_keys",
+                                                1000))
+        self._flights = _shared(scope, FlightTable, single_flight_max_keys)
+
+        self._writebacks = {} # Local key: Write-back task
+
+        self.writeback = kwargs.pop("writeback", "sync")
+        writeback_queue_size = int(kwargs.pop("writeback_queue_size", 1000))
+        self._writer = None
+        if self.writeback == "background":
+            self._writer = _shared(scope, WriteBehind, writeback_queue_size)
+        elif self.writeback not in WRITEBACK_MODES:
+            raise ValueError("Unknown write-back mode: %r" %
+                             (self.writeback,))
+
+        refresh_workers = int(kwargs.pop("refresh_workers", 0))
+        refresh_queue_size = int(kwargs.pop("refresh_queue_size", 100))
+        self.refresh_shedding = kwargs.pop("refresh_shedding", "renew")
+        self._refresh_pool = None
+        if refresh_workers:
+            self._refresh_pool = _shared(scope, RefreshPool, refresh_workers,
+                                         refresh_queue_size)
+        if self.refresh_shedding not in SHEDDING_POLICIES:
+            raise ValueError("Unknown refresh shedding policy: %r" %
+                             (self.refresh_shedding,))
+
+        self._producers = {} # Key: (producer, timeout, grace time)
+        self._prefix_producers = [] # (Prefix, producer, timeout, grace time)
+        for pattern, producer in (kwargs.pop("refresh_producers", None) or
+                                  {}).items():
+            self.register_producer(pattern, producer)
+
+        l1_max_entries = int(kwargs.pop("l1_max_entries", 0))
+        l1_max_bytes = int(kwargs.pop("l1_max_bytes", 0))
+        self._l1 = None
+        if l1_max_entries:
+            self._l1 = _shared(scope, LRUCache, l1_max_entries, l1_max_bytes,
+                               _pickled_size)
+
+        if self.renewal not in RENEWAL_MODES:
+            raise ValueError("Unknown renewal mode: %r" % (self.renewal,))
+        if self.invalidation not in INVALIDATION_MODES:
+            raise ValueError("Unknown invalidation mode: %r" %
+                             (self.invalidation,))
+
+        self._metrics = kwargs.pop("metrics", None)
+        if isinstance(self._metrics, str):
+            self._metrics = _import(self._metrics)
+        if self._metrics is not None:
+            if (isinstance(self._metrics, type) or
+                    not hasattr(self._metrics, "incr")):
+                self._metrics = self._metrics()
+            self._instrument()
+
+    def register_producer(self, pattern, producer, timeout=None,
+                          grace_time=None):
+        """
+        Register a producer for refreshing values in the background. The
+        pattern is either a key, or a key prefix followed by "*". The longest
+        matching prefix is used if there is no producer for the exact key.
+
+        The producer is called with the key as its only argument. If no
+        timeout is given, the timeout of the value being refreshed is reused.
+        """
+
+        if isinstance(producer, str):
+            producer = _import(producer)
+
+        if pattern.endswith("*"):
+            self._prefix_producers.append((pattern[:-1], producer, timeout,
+                                           grace_time))
+            self._prefix_producers.sort(key=lambda p: len(p[0]), reverse=True)
+        else:
+            self._producers[pattern] = (producer, timeout, grace_time)
+
+    def _find_producer(self, key):
+        """
+        Get the producer, timeout, and grace time registered for the given
+        key. None is returned if there is no producer.
+        """
+
+        registration = self._producers.get(key)
+        if registration is not None:
+            return registration
+
+        for prefix, producer, timeout, grace_time in self._prefix_producers:
+            if key.startswith(prefix):
+                return producer, timeout, grace_time
+        return None
+
+    def _refresh(self, key, producer, timeout, grace_time, **kwargs):
+        """
+        Produce and set a value in the background. Whether the client should
+        be served the old value is returned: True if the refresh was queued,
+        otherwise as decided by the shedding policy.
+        """
+
+        if self._refresh_pool.submit(self._local_key(key, kwargs),
+                                     self._produce_directly, key, producer,
+                                     timeout, grace_time, **kwargs):
+            return True
+        return self.refresh_shedding == "stale"
+
+    def _refresh_registered(self, key, value, **kwargs):
+        """
+        Refresh a value in the background with its registered producer, if
+        any. Whether the client should be served the old value is returned.
+        """
+
+        registration = self._find_producer(key)
+        if registration is None:
+            return False
+
+        producer, timeout, grace_time = registration
+        if timeout is None:
+            timeout = _unjitter(self.hard_timeout_jitter,
+                                value.hard_timeout) / self.hard_timeout_factor
+        return self._refresh(key, functools.partial(producer, key), timeout,
+                             grace_time, **kwargs)
 
     def _set_directly(self, key, value, timeout, **kwargs):
         """
@@ -120,17 +842,116 @@ class AntiDogpiling(object):
 
         raise NotImplementedError()
 
-    def _add_anti_dogpiling(self, value, timeout, grace_time=None):
+    def _get_directly(self, key, **kwargs):
+        """
+        Get a value from the cache directly, as stored. A subclass must
+        implement this method in order to use get_or_set.
+        """
+
+        raise NotImplementedError()
+
+    def _delete_directly(self, key, **kwargs):
+        """
+        Delete a value from the cache directly. A subclass must implement this
+        method in order to use get_or_set.
+        """
+
+        raise NotImplementedError()
+
+    def _get_many_directly(self, keys, **kwargs):
+        """
+        Get a dict of the values of the given keys found in the cache. This
+        default implementation gets them one by one.
+        """
+
+        values = {}
+        for key in keys:
+            value = self._get_directly(key, **kwargs)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def _instrument(self):
+        """
+        Time the calls to the cache with the metrics, by wrapping the direct
+        methods of this instance. The asynchronous ones are only wrapped when
+        overridden, as they call the synchronous ones by default.
+        """
+
+        for name in ("get", "set", "add", "delete", "set_many", "get_many"):
+            method = "_%s_directly" % name
+            setattr(self, method, timed(self._metrics, "backend." + name,
+                                        getattr(self, method)))
+
+            method = "_a%s_directly" % name
+            if getattr(type(self), method) is not getattr(AntiDogpiling,
+                                                          method):
+                setattr(self, method, timed(self._metrics,
+                                            "backend.a" + name,
+                                            getattr(self, method)))
+
+    def _count_fetched(self, value):
+        """
+        Count the outcome of fetching a value which is not anti-dogpiled, or
+        which was shared by a concurrent fetch. Only call this with metrics
+        enabled.
+        """
+
+        if value is None:
+            self._metrics.incr(MISS)
+        elif not self._is_anti_dogpiled(value):
+            self._metrics.incr(HARD_HIT)
+        elif value.renewing:
+            self._metrics.incr(STALE_SERVE)
+        else:
+            self._metrics.incr(SOFT_HIT)
+
+    def _set_many_directly(self, values, timeout, **kwargs):
+        """
+        Put several values with the same timeout in the cache directly. This
+        default implementation calls _set_directly once per value. Subclasses
+        with access to a bulk set should override it.
+        """
+
+        for key, value in values.items():
+            self._set_directly(key, value, timeout, **kwargs)
+
+    def _add_directly(self, key, value, timeout, **kwargs):
+        """
+        Add a value to the cache directly, returning True only if the key was
+        not already there, or None if the cache cannot tell, like when the
+        node of the key is down. Leases which cannot be claimed that way are
+        not waited for. A subclass must implement this method in order to use
+        the "lease" renewal mode.
+        """
+
+        raise NotImplementedError()
+
+    def _add_anti_dogpiling(self, value, timeout, grace_time=None,
+                            compute_time=None, tags=None):
         """
         Add a wrapper around the value with data needed later by the
         anti-dogpiling mechanisms. A new value and timeout is returned.
+
+        The compute time is the number of seconds it took to produce the
+        value, used by the "xfetch" renewal mode. The soft timeout is
+        shortened, and the hard timeout lengthened, by the configured jitter.
+        The value is invalidated softly along with any of the given tags.
         """
 
-        soft_timeout = timeout + _now()
         hard_timeout = timeout * self.hard_timeout_factor
+        if self.hard_timeout_jitter[0]:
+            hard_timeout += _jitter(self.hard_timeout_jitter, hard_timeout)
+        hard_timeout = _whole_seconds(hard_timeout)
+
+        if self.soft_timeout_jitter[0]:
+            timeout -= _jitter(self.soft_timeout_jitter, timeout)
+        now = self._clock()
         grace_time = grace_time or self.default_grace_time
 
-        wrapped_value = Wrapper(value, soft_timeout, hard_timeout, grace_time)
+        wrapped_value = Wrapper(value, now + timeout, hard_timeout, grace_time,
+                                compute_time or 0, now, tags or ())
+        wrapped_value.compression = self._compression
 
         return wrapped_value, hard_timeout
 
@@ -142,30 +963,1005 @@ class AntiDogpiling(object):
 
         return isinstance(value, Wrapper)
 
-    def _apply_anti_dogpiling(self, key, value, **kwargs):
+    def _flight_key(self, name, key, kwargs):
         """
-        Apply the anti-dogpiling mechanisms to the provided key and value. Use
-        this when fetching values from the cache.
+        Get the key of a call in flight, unique per operation name, key, and
+        keyword arguments (like the Django version).
         """
 
-        now = _now()
+        return (name, key) + tuple(sorted(kwargs.items()))
 
-        # If no timeout, just return the value
-        if value.soft_timeout >= now:
-            return value.value
+    def _get_coalesced(self, key, **kwargs):
+        """
+        Get a value from the cache directly, sharing the fetch with concurrent
+        callers for the same key if the single_flight option is enabled. A
+        tuple of the value and whether it was shared is returned.
 
-        # We have a soft timeout. The client gets the grace period to produce
-        # and set an updated value while everyone else gets the old value.
-        value.soft_timeout = now + value.grace_time
-        self._set_directly(key, value, value.hard_timeout, **kwargs)
+        When the value is shared, only the caller who fetched it should apply
+        the anti-dogpiling. The others should use the value as it is, since
+        the renewal, if any, is already granted to the fetcher.
+        """
 
-        return None
+        if not self.single_flight:
+            return self._fetch(key, **kwargs), False
+        return self._flights.do(self._flight_key("get", key, kwargs),
+                                self._fetch, key, **kwargs)
 
-    def _soft_invalidate(self, key, value, **kwargs):
+    def _marker_key(self, key):
         """
-        Invalidate an anti-dogpiled value while keeping the properties of
-        anti-dogpiling.
+        Get the key of the invalidation marker of the given key.
         """
 
-        value.soft_timeout = 0
-        self._set_directly(key, value, value.hard_timeout, **kwargs)
+        return "%s%s" % (key, MARKER_SUFFIX)
+
+    def _apply_marker(self, value, marker):
+        """
+        Time out a wrapped value softly if its invalidation marker is newer
+        than its stamp.
+        """
+
+        if (marker is not None and self._is_anti_dogpiled(value) and
+                marker >= value.stamp):
+            value.soft_timeout = 0
+            value.renewing = False
+
+    def _fetch(self, key, **kwargs):
+        """
+        Get a value from the cache directly. In the "marker" invalidation
+        mode, its invalidation marker is fetched in the same round-trip, and
+        applied to it. The markers of its tags and its chunks, if any, are
+        fetched after it (see _complete). If chunks are missing, None is
+        returned.
+        """
+
+        if self.invalidation != "marker":
+            value = self._get_directly(key, **kwargs)
+        else:
+            marker_key = self._marker_key(key)
+            values = self._get_many_directly([key, marker_key], **kwargs)
+            value = values.get(key)
+            self._apply_marker(value, values.get(marker_key))
+
+        if self._is_anti_dogpiled(value) and (value.tags or
+                                              not value.joined):
+            if self._complete({key: value}, **kwargs):
+                return None
+        return value
+
+    def _fetch_many(self, keys, **kwargs):
+        """
+        Get a dict of the values of the given keys found in the cache, like
+        _fetch does for one key.
+        """
+
+        if self.invalidation != "marker":
+            values = self._get_many_directly(keys, **kwargs)
+        else:
+            marker_keys = [self._marker_key(key) for key in keys]
+            values = self._pick_marked(keys, marker_keys,
+                                       self._get_many_directly(
+                                           list(keys) + marker_keys, **kwargs))
+
+        for key in self._complete(values, **kwargs):
+            del values[key]
+        return values
+
+    def _pick_marked(self, keys, marker_keys, values):
+        """
+        Pick the values of the given keys from the values fetched along with
+        their invalidation markers, applying the markers.
+        """
+
+        result = {}
+        for key, marker_key in zip(keys, marker_keys):
+            if key in values:
+                self._apply_marker(values[key], values.get(marker_key))
+                result[key] = values[key]
+        return result
+
+    def _tag_key(self, tag):
+        """
+        Get the key of the invalidation marker of the given tag.
+        """
+
+        return "%s%s" % (TAG_PREFIX, tag)
+
+    def _tagged(self, values):
+        """
+        Get the wrapped values with tags among the given values, and the keys
+        of the markers of their tags.
+        """
+
+        tagged = [value for value in values
+                  if self._is_anti_dogpiled(value) and value.tags]
+        tag_keys = set(self._tag_key(tag) for value in tagged
+                       for tag in value.tags)
+        return tagged, list(tag_keys)
+
+    def _apply_tag_markers(self, tagged, markers):
+        """
+        Apply the newest marker of the tags of each of the given wrapped
+        values, given a dict of the markers by key.
+        """
+
+        for value in tagged:
+            tag_markers = [markers[self._tag_key(tag)] for tag in value.tags
+                           if self._tag_key(tag) in markers]
+            if tag_markers:
+                self._apply_marker(value, max(tag_markers))
+
+    def _unjoined(self, values):
+        """
+        Get the wrapped values left in chunks among the given dict of values,
+        and the keys of their chunks.
+        """
+
+        unjoined = dict((key, value) for key, value in values.items()
+                        if self._is_anti_dogpiled(value) and not value.joined)
+        chunk_keys = [self._chunk_key(key, value.chunks[0], i)
+                      for key, value in unjoined.items()
+                      for i in range(value.chunks[1])]
+        return unjoined, chunk_keys
+
+    def _join_chunks(self, unjoined, fetched):
+        """
+        Join the payloads of the given wrapped values from the fetched chunks.
+        The keys of the values with chunks missing are returned.
+        """
+
+        missing = []
+        for key, value in unjoined.items():
+            token, count = value.chunks
+            chunk_keys = [self._chunk_key(key, token, i) for i in range(count)]
+            if all(chunk_key in fetched for chunk_key in chunk_keys):
+                value._join([fetched[chunk_key] for chunk_key in chunk_keys])
+            else:
+                missing.append(key)
+        return missing
+
+    def _complete(self, values, **kwargs):
+        """
+        Fetch the markers of the tags, and the chunks, of the given dict of
+        values, if any, in one round-trip. The markers are applied, and the
+        payloads joined. The keys of the values with chunks missing, which
+        should be treated as missing, are returned.
+        """
+
+        tagged, tag_keys = self._tagged(values.values())
+        unjoined, chunk_keys = self._unjoined(values)
+        if not tag_keys and not chunk_keys:
+            return []
+
+        fetched = self._get_many_directly(tag_keys + chunk_keys, **kwargs)
+        self._apply_tag_markers(tagged, fetched)
+        return self._join_chunks(unjoined, fetched)
+
+    def _chunk_key(self, key, token, index):
+        """
+        Get the key of a chunk of the payload of the given key.
+        """
+
+        return "%s%s%s:%d" % (key, CHUNK_INFIX, token, index)
+
+    def _chunked_keys(self, keys):
+        """
+        Get the given keys with the keys of chunks replaced by the keys of the
+        values they are chunks of.
+        """
+
+        return list(dict.fromkeys(key.partition(CHUNK_INFIX)[0]
+                                  for key in keys))
+
+    def _split(self, key, value):
+        """
+        Split the payload of a wrapped value into chunks, if chunking is
+        enabled and the payload is larger than the chunk size. A dict of the
+        chunks by key is returned, to be set along with the value, which then
+        carries the manifest of the chunks instead of the payload.
+        """
+
+        if not self.chunk_size or value.chunks is not None:
+            return {}
+        if (isinstance(value._value, (str, bytes)) and
+                len(value._value) <= self.chunk_size):
+            return {}
+
+        flags, data = value._pickled()
+        if len(data) <= self.chunk_size:
+            return {}
+
+        token = "%08x" % random.getrandbits(32)
+        count = int(math.ceil(len(data) / float(self.chunk_size)))
+        value.chunks = (token, count)
+        return dict((self._chunk_key(key, token, i),
+                     data[i * self.chunk_size:(i + 1) * self.chunk_size])
+                    for i in range(count))
+
+    def _set_wrapped(self, key, value, timeout, **kwargs):
+        """
+        Put a wrapped value in the cache, along with its chunks if it is
+        split, in one write.
+        """
+
+        chunks = self._split(key, value)
+        if chunks:
+            chunks[key] = value
+            self._set_many_directly(chunks, timeout, **kwargs)
+        else:
+            self._set_directly(key, value, timeout, **kwargs)
+
+    def soft_invalidate_tag(self, tag, **kwargs):
+        """
+        Invalidate all values with the given tag softly, in one write. The
+        values are renewed like values that have timed out softly, the next
+        time they are fetched. The process-local tier, if any, is cleared, as
+        it does not know the tags.
+        """
+
+        self._set_directly(self._tag_key(tag), self._clock(),
+                           self.invalidation_marker_timeout, **kwargs)
+        if self._l1 is not None:
+            self._l1.clear()
+
+    def _mark_invalidated(self, keys, **kwargs):
+        """
+        Invalidate the values of the given keys softly by writing their
+        invalidation markers, in one write.
+        """
+
+        now = self._clock()
+        markers = dict((self._marker_key(key), now) for key in keys)
+        if len(markers) == 1:
+            self._set_directly(list(markers)[0], now,
+                               self.invalidation_marker_timeout, **kwargs)
+        elif markers:
+            self._set_many_directly(markers, self.invalidation_marker_timeout,
+                                    **kwargs)
+
+        if self._l1 is not None:
+            for key in keys:
+                self._delete_local(key, **kwargs)
+
+    def _local_key(self, key, kwargs):
+        """
+        Get the key of a value in the process-local tier, unique per key and
+        keyword arguments (like the Django version).
+        """
+
+        return (key,) + tuple(sorted(kwargs.items()))
+
+    def _get_local(self, key, **kwargs):
+        """
+        Get an unwrapped value from the process-local tier. None is returned
+        if the tier is disabled, or the value is missing or has timed out
+        softly.
+        """
+
+        if self._l1 is None:
+            return None
+
+        entry = self._l1.get(self._local_key(key, kwargs))
+        if entry is None or entry[1] < self._clock():
+            return None
+        if self._metrics is not None:
+            self._metrics.incr(SOFT_HIT)
+        return entry[0]
+
+    def _set_local(self, key, value, **kwargs):
+        """
+        Put a wrapped value in the process-local tier until its soft timeout,
+        unless the tier is disabled or the value is being renewed.
+        """
+
+        if self._l1 is not None and not value.renewing:
+            self._l1.set(self._local_key(key, kwargs),
+                         (value.value, value.soft_timeout))
+
+    def _delete_local(self, key, **kwargs):
+        """
+        Remove a value from the process-local tier, if enabled.
+        """
+
+        if self._l1 is not None:
+            self._l1.delete(self._local_key(key, kwargs))
+
+    def _lease_key(self, key, value=None):
+        """
+        Get the key of the lease for the given key, and for the given wrapped
+        value when renewing it.
+        """
+
+        if value is None:
+            return "%s%s" % (key, LEASE_SUFFIX)
+        return "%s%s:%s" % (key, LEASE_SUFFIX, value.soft_timeout)
+
+    def _claim_renewal(self, key, value, **kwargs):
+        """
+        Claim the right to renew a value which has timed out softly. Only the
+        "lease" renewal mode can refuse the claim, in which case the old value
+        should be served.
+        """
+
+        if self.renewal == "lease":
+            claimed = self._add_directly(
+                self._lease_key(key, value), True,
+                _whole_seconds(value.grace_time), **kwargs)
+            claimed = claimed is None or bool(claimed)
+        else:
+            claimed = True
+
+        if self._metrics is not None:
+            self._count_claim(value, claimed)
+        return claimed
+
+    def _count_claim(self, value, claimed):
+        """
+        Count the outcome of claiming the renewal of a value. Only call this
+        with metrics enabled.
+        """
+
+        if value.renewing:
+            self._metrics.incr(GRACE_EXPIRED)
+        self._metrics.incr(RENEWAL_GRANTED if claimed else STALE_SERVE)
+
+    def _renew_early(self, value, now):
+        """
+        Decide whether to renew a value which has not yet timed out softly.
+        Only the "xfetch" renewal mode renews early, with a probability which
+        increases with the compute time and as the soft timeout approaches.
+        """
+
+        if self.renewal != "xfetch" or not value.compute_time:
+            return False
+
+        draw = -math.log(1.0 - random.random())
+        return now + value.compute_time * self.xfetch_beta * draw >= \
+            value.soft_timeout
+
+    def _serve_fresh(self, key, value, now, **kwargs):
+        """
+        Get the unwrapped value of a wrapped value which has not timed out
+        softly, keeping it in the process-local tier. None is returned if the
+        value should be renewed early.
+        """
+
+        if self._renew_early(value, now):
+            if self._metrics is not None:
+                self._metrics.incr(RENEWAL_GRANTED)
+            if (self._refresh_pool is not None and
+                    self._refresh_registered(key, value, **kwargs)):
+                return value.value
+            return None
+        if self._metrics is not None:
+            self._metrics.incr(STALE_SERVE if value.renewing else SOFT_HIT)
+        if self._l1 is not None:
+            self._set_local(key, value, **kwargs)
+        return value.value
+
+    def _start_renewal(self, value, now):
+        """
+        Give the client renewing a value the grace period to produce and set
+        an updated value. The value must be written back to the cache, so that
+        everyone else gets the old value in the meantime.
+        """
+
+        value.soft_timeout = now + value.grace_time
+        value.stamp = now
+        value.renewing = True
+
+    def _apply_anti_dogpiling(self, key, value, **kwargs):
+        """
+        Apply the anti-dogpiling mechanisms to the provided key and value. Use
+        this when fetching values from the cache.
+        """
+
+        now = self._clock()
+
+        # If no timeout, just return the value, unless renewing early
+        if value.soft_timeout >= now:
+            return self._serve_fresh(key, value, now, **kwargs)
+
+        # Someone else is already renewing the value
+        if not self._claim_renewal(key, value, **kwargs):
+            return value.value
+
+        # We have a soft timeout. The client gets the grace period to produce
+        # and set an updated value while everyone else gets the old value.
+        self._start_renewal(value, now)
+        if not self._queue_writeback(key, value, **kwargs):
+            self._set_directly(key, value, value.hard_timeout, **kwargs)
+
+        # Serve the old value while refreshing it in the background
+        if (self._refresh_pool is not None and
+                self._refresh_registered(key, value, **kwargs)):
+            return value.value
+
+        return None
+
+    def _apply_anti_dogpiling_many(self, values, **kwargs):
+        """
+        Apply the anti-dogpiling mechanisms to a dict of keys and wrapped
+        values. Use this when fetching several values from the cache at once.
+
+        A dict with the unwrapped values is returned. Keys the client should
+        renew are left out, as if they were not in the cache. The grace period
+        write-backs are batched into one bulk set per distinct hard timeout
+        (or queued for the background writer). In the "lease" renewal mode,
+        each timed out value also costs one add.
+        """
+
+        now = self._clock()
+        result = {}
+        renewed = {}
+        renewals = {}
+
+        for key, value in values.items():
+            if value.soft_timeout >= now:
+                fresh = self._serve_fresh(key, value, now, **kwargs)
+                if fresh is not None:
+                    result[key] = fresh
+            elif not self._claim_renewal(key, value, **kwargs):
+                result[key] = value.value
+            else:
+                self._start_renewal(value, now)
+                renewed[key] = value
+                if not self._queue_writeback(key, value, **kwargs):
+                    renewals.setdefault(value.hard_timeout, {})[key] = value
+
+        for timeout, batch in renewals.items():
+            self._set_many_directly(batch, timeout, **kwargs)
+
+        if self._refresh_pool is not None:
+            for key, value in renewed.items():
+                if self._refresh_registered(key, value, **kwargs):
+                    result[key] = value.value
+
+        return result
+
+    def _queue_writeback(self, key, value, **kwargs):
+        """
+        Queue the write-back of a value being renewed for the background
+        writer, in the "background" write-back mode. False is returned if the
+        value should be written back right away instead.
+        """
+
+        if self._writer is None:
+            return False
+        return self._writer.submit(self._local_key(key, kwargs),
+                                   self._set_many_directly, key, value,
+                                   value.hard_timeout, kwargs)
+
+    def _discard_writebacks(self, keys, **kwargs):
+        """
+        Drop the queued write-backs of the given keys, and wait for any being
+        written. Use this before writing the keys, so that an old value being
+        written back never overwrites a new one.
+        """
+
+        if self._writer is not None:
+            self._writer.discard([self._local_key(key, kwargs)
+                                  for key in keys])
+
+    def _soft_invalidate(self, key, value, **kwargs):
+        """
+        Invalidate an anti-dogpiled value while keeping the properties of
+        anti-dogpiling.
+        """
+
+        value.soft_timeout = 0
+        self._set_directly(key, value, value.hard_timeout, **kwargs)
+        self._delete_local(key, **kwargs)
+
+    def _soft_invalidate_many(self, values, **kwargs):
+        """
+        Invalidate a dict of keys and anti-dogpiled values, batching the
+        write-backs like _apply_anti_dogpiling_many does.
+        """
+
+        batches = {}
+        for key, value in values.items():
+            value.soft_timeout = 0
+            batches.setdefault(value.hard_timeout, {})[key] = value
+            self._delete_local(key, **kwargs)
+
+        for timeout, batch in batches.items():
+            self._set_many_directly(batch, timeout, **kwargs)
+
+    def get_or_set(self, key, producer, timeout, grace_time=None, **kwargs):
+        """
+        Get a value from the cache, or produce and set it if it is missing or
+        due for renewal. The producer is called without arguments, and the
+        time it takes is recorded as the compute time of the value. A producer
+        returning None is not cached.
+
+        Concurrent calls for the same key within this process share one call
+        to the producer. When the value is not in the cache at all, a lease is
+        claimed in the cache first. Everyone failing to claim it polls for the
+        value for up to the grace time, before producing it themselves.
+
+        With background refreshes enabled, the client granted the renewal of
+        a value is served the old value, while the producer is called in the
+        background.
+        """
+
+        value = self._get_local(key, **kwargs)
+        if value is not None:
+            return value
+
+        value, shared = self._get_coalesced(key, **kwargs)
+        if self._metrics is not None and (
+                shared or not self._is_anti_dogpiled(value)):
+            self._count_fetched(value)
+        if self._is_anti_dogpiled(value):
+            if shared:
+                return value.value
+            wrapped_value = value
+            value = self._apply_anti_dogpiling(key, value, **kwargs)
+            if value is not None:
+                return value
+            if (self._refresh_pool is not None and
+                    not wrapped_value.empty and
+                    self._refresh(key, producer, timeout, grace_time,
+                                  **kwargs)):
+                return wrapped_value.value
+            cold = False
+        elif value is not None:
+            return value
+        else:
+            cold = True
+
+        return self._flights.run(self._flight_key("produce", key, kwargs),
+                                 self._produce, key, producer, timeout,
+                                 grace_time, cold, **kwargs)
+
+    def antidogpiled(self, timeout=None, grace_time=None, key_prefix=None,
+                     **kwargs):
+        """
+        Make a decorator caching the return values of a function with
+        get_or_set, with keys built from the function arguments. See
+        antidogpiling.decorators.antidogpiled.
+        """
+
+        return antidogpiled(self, timeout, grace_time=grace_time,
+                            key_prefix=key_prefix, **kwargs)
+
+    def _produce(self, key, producer, timeout, grace_time, cold, **kwargs):
+        """
+        Produce and set a value for get_or_set, claiming the lease first if
+        the value is not in the cache at all. Clients failing to claim it
+        wait for the value, and claim the lease again on every poll, in case
+        its holder gave up without setting a value.
+        """
+
+        if not cold:
+            return self._produce_directly(key, producer, timeout, grace_time,
+                                          **kwargs)
+
+        lease_key = self._lease_key(key)
+        grace_time = grace_time or self.default_grace_time
+        deadline = time.time() + grace_time
+        while True:
+            leased = self._add_directly(lease_key, True,
+                                        _whole_seconds(grace_time), **kwargs)
+            if leased is None:
+                # Nobody can have the lease, so there is nothing to wait for
+                return self._produce_directly(key, producer, timeout,
+                                              grace_time, **kwargs)
+            if leased:
+                try:
+                    return self._produce_directly(key, producer, timeout,
+                                                  grace_time, **kwargs)
+                finally:
+                    self._delete_directly(lease_key, **kwargs)
+            if time.time() >= deadline:
+                break
+
+            # Someone else is producing the value. Wait for it for as long
+            # as they have the lease, fetching its chunks and markers as well.
+            time.sleep(self.lease_poll_interval)
+            value = self._fetch(key, **kwargs)
+            if self._is_anti_dogpiled(value):
+                return value.value
+            if value is not None:
+                return value
+
+        return self._produce_directly(key, producer, timeout, grace_time,
+                                      **kwargs)
+
+    def _produce_directly(self, key, producer, timeout, grace_time, **kwargs):
+        """
+        Call the producer and put its value in the cache with anti-dogpiling.
+        """
+
+        start = time.time()
+        value = producer()
+        compute_time = time.time() - start
+
+        if value is not None:
+            wrapped_value, timeout = self._add_anti_dogpiling(
+                value, timeout, grace_time=grace_time,
+                compute_time=compute_time)
+            self._discard_writebacks((key,), **kwargs)
+            self._set_wrapped(key, wrapped_value, timeout, **kwargs)
+            self._set_local(key, wrapped_value, **kwargs)
+
+        return value
+
+    async def _aget_directly(self, key, **kwargs):
+        """
+        Asynchronous _get_directly. This default implementation blocks.
+        """
+
+        return self._get_directly(key, **kwargs)
+
+    async def _aset_directly(self, key, value, timeout, **kwargs):
+        """
+        Asynchronous _set_directly. This default implementation blocks.
+        """
+
+        self._set_directly(key, value, timeout, **kwargs)
+
+    async def _aset_many_directly(self, values, timeout, **kwargs):
+        """
+        Asynchronous _set_many_directly. This default implementation blocks.
+        """
+
+        self._set_many_directly(values, timeout, **kwargs)
+
+    async def _aget_many_directly(self, keys, **kwargs):
+        """
+        Asynchronous _get_many_directly. This default implementation blocks.
+        """
+
+        return self._get_many_directly(keys, **kwargs)
+
+    async def _afetch(self, key, **kwargs):
+        """
+        Asynchronous _fetch.
+        """
+
+        if self.invalidation != "marker":
+            value = await self._aget_directly(key, **kwargs)
+        else:
+            marker_key = self._marker_key(key)
+            values = await self._aget_many_directly([key, marker_key],
+                                                    **kwargs)
+            value = values.get(key)
+            self._apply_marker(value, values.get(marker_key))
+
+        if self._is_anti_dogpiled(value) and (value.tags or
+                                              not value.joined):
+            if await self._acomplete({key: value}, **kwargs):
+                return None
+        return value
+
+    async def _afetch_many(self, keys, **kwargs):
+        """
+        Asynchronous _fetch_many.
+        """
+
+        if self.invalidation != "marker":
+            values = await self._aget_many_directly(keys, **kwargs)
+        else:
+            marker_keys = [self._marker_key(key) for key in keys]
+            values = self._pick_marked(keys, marker_keys,
+                                       await self._aget_many_directly(
+                                           list(keys) + marker_keys,
+                                           **kwargs))
+
+        for key in await self._acomplete(values, **kwargs):
+            del values[key]
+        return values
+
+    async def _acomplete(self, values, **kwargs):
+        """
+        Asynchronous _complete.
+        """
+
+        tagged, tag_keys = self._tagged(values.values())
+        unjoined, chunk_keys = self._unjoined(values)
+        if not tag_keys and not chunk_keys:
+            return []
+
+        fetched = await self._aget_many_directly(tag_keys + chunk_keys,
+                                                 **kwargs)
+        self._apply_tag_markers(tagged, fetched)
+        return self._join_chunks(unjoined, fetched)
+
+    async def _aset_wrapped(self, key, value, timeout, **kwargs):
+        """
+        Asynchronous _set_wrapped.
+        """
+
+        chunks = self._split(key, value)
+        if chunks:
+            chunks[key] = value
+            await self._aset_many_directly(chunks, timeout, **kwargs)
+        else:
+            await self._aset_directly(key, value, timeout, **kwargs)
+
+    async def asoft_invalidate_tag(self, tag, **kwargs):
+        """
+        Asynchronous soft_invalidate_tag.
+        """
+
+        await self._aset_directly(self._tag_key(tag), self._clock(),
+                                  self.invalidation_marker_timeout, **kwargs)
+        if self._l1 is not None:
+            self._l1.clear()
+
+    async def _amark_invalidated(self, keys, **kwargs):
+        """
+        Asynchronous _mark_invalidated.
+        """
+
+        now = self._clock()
+        markers = dict((self._marker_key(key), now) for key in keys)
+        if len(markers) == 1:
+            await self._aset_directly(list(markers)[0], now,
+                                      self.invalidation_marker_timeout,
+                                      **kwargs)
+        elif markers:
+            await self._aset_many_directly(
+                markers, self.invalidation_marker_timeout, **kwargs)
+
+        if self._l1 is not None:
+            for key in keys:
+                self._delete_local(key, **kwargs)
+
+    async def _aadd_directly(self, key, value, timeout, **kwargs):
+        """
+        Asynchronous _add_directly. This default implementation blocks.
+        """
+
+        return self._add_directly(key, value, timeout, **kwargs)
+
+    async def _adelete_directly(self, key, **kwargs):
+        """
+        Asynchronous _delete_directly. This default implementation blocks.
+        """
+
+        self._delete_directly(key, **kwargs)
+
+    def _spawn_writeback(self, keys, coroutine, **kwargs):
+        """
+        Run a write-back of the values of the given keys as a background
+        task. Write-backs are best effort, so failures are ignored.
+        """
+
+        task = asyncio.ensure_future(coroutine)
+        local_keys = [self._local_key(key, kwargs) for key in keys]
+        for local_key in local_keys:
+            self._writebacks[local_key] = task
+
+        def done(task):
+            for local_key in local_keys:
+                if self._writebacks.get(local_key) is task:
+                    del self._writebacks[local_key]
+            if not task.cancelled():
+                task.exception()
+
+        task.add_done_callback(done)
+        return task
+
+    async def _await_writebacks(self, keys, **kwargs):
+        """
+        Wait for any write-backs of the given keys still running in the
+        background. Use this before writing the keys, so that an old value
+        being written back never overwrites a new one. Write-backs queued
+        for the background writer are discarded as well.
+        """
+
+        self._discard_writebacks(keys, **kwargs)
+        if not self._writebacks:
+            return
+
+        tasks = set()
+        for key in keys:
+            task = self._writebacks.get(self._local_key(key, kwargs))
+            if task is not None:
+                tasks.add(task)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def _aclaim_renewal(self, key, value, **kwargs):
+        """
+        Asynchronous _claim_renewal.
+        """
+
+        if self.renewal == "lease":
+            claimed = await self._aadd_directly(
+                self._lease_key(key, value), True,
+                _whole_seconds(value.grace_time), **kwargs)
+            claimed = claimed is None or bool(claimed)
+        else:
+            claimed = True
+
+        if self._metrics is not None:
+            self._count_claim(value, claimed)
+        return claimed
+
+    async def _aapply_anti_dogpiling(self, key, value, **kwargs):
+        """
+        Asynchronous _apply_anti_dogpiling. The renewal write-back runs as a
+        background task.
+        """
+
+        now = self._clock()
+
+        if value.soft_timeout >= now:
+            return self._serve_fresh(key, value, now, **kwargs)
+
+        if not await self._aclaim_renewal(key, value, **kwargs):
+            return value.value
+
+        self._start_renewal(value, now)
+        self._spawn_writeback(
+            (key,), self._aset_directly(key, value, value.hard_timeout,
+                                        **kwargs), **kwargs)
+
+        return None
+
+    async def _aapply_anti_dogpiling_many(self, values, **kwargs):
+        """
+        Asynchronous _apply_anti_dogpiling_many. The batched renewal
+        write-backs run as background tasks.
+        """
+
+        now = self._clock()
+        result = {}
+        renewals = {}
+
+        for key, value in values.items():
+            if value.soft_timeout >= now:
+                fresh = self._serve_fresh(key, value, now, **kwargs)
+                if fresh is not None:
+                    result[key] = fresh
+            elif not await self._aclaim_renewal(key, value, **kwargs):
+                result[key] = value.value
+            else:
+                self._start_renewal(value, now)
+                renewals.setdefault(value.hard_timeout, {})[key] = value
+
+        for timeout, batch in renewals.items():
+            self._spawn_writeback(
+                list(batch), self._aset_many_directly(batch, timeout,
+                                                      **kwargs), **kwargs)
+
+        return result
+
+    async def _asoft_invalidate(self, key, value, **kwargs):
+        """
+        Asynchronous _soft_invalidate.
+        """
+
+        await self._await_writebacks((key,), **kwargs)
+        value.soft_timeout = 0
+        await self._aset_directly(key, value, value.hard_timeout, **kwargs)
+        self._delete_local(key, **kwargs)
+
+    async def _asoft_invalidate_many(self, values, **kwargs):
+        """
+        Asynchronous _soft_invalidate_many.
+        """
+
+        await self._await_writebacks(values, **kwargs)
+
+        batches = {}
+        for key, value in values.items():
+            value.soft_timeout = 0
+            batches.setdefault(value.hard_timeout, {})[key] = value
+            self._delete_local(key, **kwargs)
+
+        for timeout, batch in batches.items():
+            await self._aset_many_directly(batch, timeout, **kwargs)
+
+    async def aget_or_set(self, key, producer, timeout, grace_time=None,
+                          **kwargs):
+        """
+        Asynchronous get_or_set. The producer may be a coroutine function.
+
+        When a value is due for renewal, the client granted the renewal is
+        served the old value right away, while the new value is produced and
+        set by a background task. Concurrent calls are only coalesced through
+        the lease claimed when the value is not in the cache at all.
+        """
+
+        value = self._get_local(key, **kwargs)
+        if value is not None:
+            return value
+
+        value = await self._afetch(key, **kwargs)
+        if not self._is_anti_dogpiled(value):
+            if self._metrics is not None:
+                self._count_fetched(value)
+            if value is not None:
+                return value
+            return await self._aproduce_cold(key, producer, timeout,
+                                             grace_time, **kwargs)
+
+        now = self._clock()
+        if value.soft_timeout >= now:
+            fresh = self._serve_fresh(key, value, now, **kwargs)
+            if fresh is not None:
+                return fresh
+            renewal = self._aproduce_directly(key, producer, timeout,
+                                              grace_time, **kwargs)
+        elif await self._aclaim_renewal(key, value, **kwargs):
+            self._start_renewal(value, now)
+            renewal = self._arenew(key, value, producer, timeout, grace_time,
+                                   **kwargs)
+        else:
+            return value.value
+
+        if value.empty:
+            return await renewal
+        self._spawn_writeback((key,), renewal, **kwargs)
+        return value.value
+
+    async def _arenew(self, key, value, producer, timeout, grace_time,
+                      **kwargs):
+        """
+        Write back a value being renewed, then produce and set the new value.
+        """
+
+        await self._aset_directly(key, value, value.hard_timeout, **kwargs)
+        return await self._aproduce_directly(key, producer, timeout,
+                                             grace_time, **kwargs)
+
+    async def _aproduce_cold(self, key, producer, timeout, grace_time,
+                             **kwargs):
+        """
+        Asynchronous _produce for values not in the cache at all.
+        """
+
+        lease_key = self._lease_key(key)
+        grace_time = grace_time or self.default_grace_time
+        deadline = time.time() + grace_time
+        while True:
+            leased = await self._aadd_directly(lease_key, True,
+                                               _whole_seconds(grace_time),
+                                               **kwargs)
+            if leased is None:
+                return await self._aproduce_directly(key, producer, timeout,
+                                                     grace_time, **kwargs)
+            if leased:
+                try:
+                    return await self._aproduce_directly(
+                        key, producer, timeout, grace_time, **kwargs)
+                finally:
+                    await self._adelete_directly(lease_key, **kwargs)
+            if time.time() >= deadline:
+                break
+
+            await asyncio.sleep(self.lease_poll_interval)
+            value = await self._afetch(key, **kwargs)
+            if self._is_anti_dogpiled(value):
+                return value.value
+            if value is not None:
+                return value
+
+        return await self._aproduce_directly(key, producer, timeout,
+                                             grace_time, **kwargs)
+
+    async def _aproduce_directly(self, key, producer, timeout, grace_time,
+                                 **kwargs):
+        """
+        Asynchronous _produce_directly. The producer may be a coroutine
+        function.
+        """
+
+        start = time.time()
+        value = producer()
+        if inspect.isawaitable(value):
+            value = await value
+        compute_time = time.time() - start
+
+        if value is not None:
+            wrapped_value, timeout = self._add_anti_dogpiling(
+                value, timeout, grace_time=grace_time,
+                compute_time=compute_time)
+            await self._aset_wrapped(key, wrapped_value, timeout, **kwargs)
+            self._set_local(key, wrapped_value, **kwargs)
+
+        return value
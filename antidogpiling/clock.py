@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Clocks for the anti-dogpiling, given by the clock option.
+
+A clock is a callable returning the current absolute time in seconds since
+epoch, as a float. Soft timeouts are shared by all processes using a cache, so
+all clocks must agree on the epoch. The default is time.time.
+"""
+
+import threading
+import time
+
+
+class MonotonicClock(object):
+    """
+    Clock following time.monotonic from the time.time of its creation, so it
+    never jumps when the system clock is adjusted. It drifts from the system
+    clock by as much as the system clock is adjusted while the process runs.
+    """
+
+    def __init__(self):
+        self._offset = time.time() - time.monotonic()
+
+    def __call__(self):
+        """
+        Get the current time.
+        """
+
+        return time.monotonic() + self._offset
+
+
+class CoarseClock(object):
+    """
+    Clock returning the time of its last tick in the current thread, to read
+    the underlying clock only once per request. Call tick at the start of each
+    request, like in a middleware, and clear at the end of it. Without a tick,
+    the underlying clock is read every time.
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        Set up the clock.
+
+        :param clock: The underlying clock.
+        """
+
+        self.clock = clock
+        self._local = threading.local()
+
+    def __call__(self):
+        """
+        Get the time of the last tick, or the current time if not ticked.
+        """
+
+        now = getattr(self._local, "now", None)
+        if now is None:
+            return self.clock()
+        return now
+
+    def tick(self):
+        """
+        Read the underlying clock, and return its time from now on.
+        """
+
+        self._local.now = self.clock()
+
+    def clear(self):
+        """
+        Stop returning the time of the last tick.
+        """
+
+        self._local.now = None
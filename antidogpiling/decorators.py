@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Caching decorators built on AntiDogpiling.get_or_set.
+
+Use them through the antidogpiled method of a cache::
+
+    @cache.antidogpiled(timeout=300, grace_time=30)
+    def render_product(product_id):
+        ...
+
+The cache keys are built from a prefix (the module and qualified name of the
+function by default) and a digest of the arguments, so arguments must have a
+stable repr across processes. The keys of hashable arguments are memoized.
+"""
+
+import functools
+import hashlib
+
+
+_MEMOIZED_TYPES = frozenset([str, bytes, int, bool, type(None)])
+"""
+The types of the arguments of memoized keys. Equal values of other types can
+have different reprs, like (1,) and (True,), or 0.0 and -0.0.
+"""
+
+
+class KeyBuilder(object):
+    """
+    Builds cache keys from a prefix and function arguments.
+    """
+
+    def __init__(self, prefix, maxsize=1024):
+        """
+        Set up the key builder.
+
+        :param prefix: Prepended to all keys.
+        :param maxsize: The number of keys to memoize.
+        """
+
+        self.prefix = prefix
+        self._memoized = functools.lru_cache(maxsize)(self._build)
+
+    def __call__(self, args, kwargs):
+        """
+        Get the key for the given positional and keyword arguments. Only the
+        keys of strings, integers, and None are memoized.
+        """
+
+        kwargs = tuple(sorted(kwargs.items()))
+
+        # Equal values of different types (like 1 and True) have different
+        # reprs, so the types are part of the memoization key.
+        types = (tuple(type(arg) for arg in args),
+                 tuple(type(value) for _, value in kwargs))
+        if _MEMOIZED_TYPES.issuperset(types[0]) and \
+                _MEMOIZED_TYPES.issuperset(types[1]):
+            return self._memoized(args, kwargs, types)
+        return self._build(args, kwargs, types)
+
+    def _build(self, args, kwargs, types):
+        """
+        Build a key from a digest of the arguments.
+        """
+
+        data = repr((args, kwargs)).encode("utf-8")
+        return "%s:%s" % (self.prefix, hashlib.md5(data).hexdigest())
+
+
+def _default_prefix(func):
+    """
+    Get the default key prefix of a function.
+    """
+
+    return "%s.%s" % (func.__module__, getattr(func, "__qualname__",
+                                               func.__name__))
+
+
+def antidogpiled(cache, timeout=None, grace_time=None, key_prefix=None,
+                 **kwargs):
+    """
+    Make a decorator caching the return values of a function in the given
+    cache with get_or_set. Any additional keyword arguments (like version) are
+    passed on to get_or_set.
+
+    The decorated function gets a cache_key function, returning the key for
+    the given arguments, and an invalidate function, soft-invalidating the
+    value for the given arguments (with the delete method of the cache).
+    """
+
+    def decorator(func):
+        key_builder = KeyBuilder(key_prefix or _default_prefix(func))
+
+        @functools.wraps(func)
+        def wrapper(*args, **func_kwargs):
+            key = key_builder(args, func_kwargs)
+            producer = functools.partial(func, *args, **func_kwargs)
+            return cache.get_or_set(key, producer, timeout,
+                                    grace_time=grace_time, **kwargs)
+
+        def cache_key(*args, **func_kwargs):
+            return key_builder(args, func_kwargs)
+
+        def invalidate(*args, **func_kwargs):
+            cache.delete(key_builder(args, func_kwargs), **kwargs)
+
+        wrapper.cache_key = cache_key
+        wrapper.invalidate = invalidate
+        return wrapper
+
+    return decorator
@@ -1,4 +1,8 @@
+import functools
+
 from antidogpiling import AntiDogpiling
+from antidogpiling.decorators import KeyBuilder
+from antidogpiling.metrics import MISS, TimedBackend
 
 
 class Cache(AntiDogpiling):
@@ -7,9 +11,17 @@ class Cache(AntiDogpiling):
     Django cache backend is inserted as a dynamic mixin. In this way, no Django
     code needs to be re-implmeneted.
 
-    Get many, set many, and delete many are not anti-dogpilie enabled here (did
-    not bother), but they can be used as long as they are not used on
-    anti-dogpiled values.
+    Get many, set many, and delete many are anti-dogpiled like their single
+    key counterparts. A bulk get costs one backend round-trip, plus one bulk
+    set if any of the values are due for renewal.
+
+    With the l1_max_entries option, values are also kept in a process-local
+    tier until their soft timeout. Writes and deletes through this instance
+    update the local tier, while writes and deletes from other processes are
+    only seen after the soft timeout.
+
+    The async cache methods of Django 4.0+ (aadd, aset, aget, adelete, etc.)
+    are anti-dogpiled too, running the renewal write-backs in the background.
 
     If incr and decr were anti-dogpilied one would loose the atomic properties
     of these in Memcached.
@@ -21,10 +33,46 @@ class Cache(AntiDogpiling):
 
             from django.core.cache.backends import locmem
             cache = Cache(locmem.CacheClass, None, params)
+
+        The anti-dogpiling options are read from the params, or from the
+        OPTIONS dict in the params (Django 1.3+). They are removed from the
+        OPTIONS passed on to the Django backend, as some backends pass all
+        their options on to the cache client.
+
+        Django creates one instance per thread, so the per-process state is
+        shared by all instances with the same backend and parameters.
         """
 
-        super(Cache, self).__init__(**params)
+        options = dict(params.get("OPTIONS") or {})
+        adp_options = dict(params)
+        for name in self.OPTION_NAMES:
+            if name in options:
+                adp_options[name] = options.pop(name)
+        if "OPTIONS" in params:
+            params = dict(params, OPTIONS=options)
+
+        adp_options["scope"] = (DjangoBackend, repr(param),
+                                repr(sorted(params.items())))
+        super(Cache, self).__init__(**adp_options)
         self._backend = DjangoBackend(param, params)
+        if self._metrics is not None:
+            self._backend = TimedBackend(self._backend, self._metrics,
+                                         self.TIMED_METHODS)
+
+    TIMED_METHODS = ("add", "set", "get", "delete", "set_many", "get_many",
+                     "delete_many", "aadd", "aset", "aget", "adelete",
+                     "aset_many", "aget_many", "adelete_many")
+    """
+    The backend methods timed with the metrics option.
+    """
+
+    def _instrument(self):
+        """
+        Overriding to time the calls to the backend itself instead, also when
+        not going through the direct methods.
+        """
+
+        pass
 
     def _set_directly(self, key, value, timeout, **kwargs):
         """
@@ -33,50 +81,229 @@ class Cache(AntiDogpiling):
 
         self._backend.set(key, value, timeout=timeout, **kwargs)
 
+    def _get_directly(self, key, **kwargs):
+        """
+        Overriding to support get_or_set.
+        """
+
+        return self._backend.get(key, **kwargs)
+
+    def _delete_directly(self, key, **kwargs):
+        """
+        Overriding to support get_or_set.
+        """
+
+        self._backend.delete(key, **kwargs)
+
+    def _set_many_directly(self, values, timeout, **kwargs):
+        """
+        Overriding to make use of the backend's bulk set.
+        """
+
+        self._backend.set_many(values, timeout=timeout, **kwargs)
+
+    def _get_many_directly(self, keys, **kwargs):
+        """
+        Overriding to get the values in one call to the backend.
+        """
+
+        return self._backend.get_many(keys, **kwargs)
+
+    def _add_directly(self, key, value, timeout, **kwargs):
+        """
+        Overriding to support the "lease" renewal mode.
+        """
+
+        return self._backend.add(key, value, timeout=timeout, **kwargs)
+
+    def _batch_wrapped(self, data, timeout, grace_time, compute_time, tags):
+        """
+        Wrap the values of a bulk set, and batch them with their chunks by
+        hard timeout, as the hard timeout jitter may set them apart. A dict of
+        the wrapped values, and a dict of the batches by hard timeout, are
+        returned.
+        """
+
+        wrapped, batches = {}, {}
+        for key, value in data.items():
+            wrapped[key], hard_timeout = self._add_anti_dogpiling(
+                value, timeout, grace_time=grace_time,
+                compute_time=compute_time, tags=tags)
+            batch = batches.setdefault(hard_timeout, {})
+            batch.update(self._split(key, wrapped[key]))
+            batch[key] = wrapped[key]
+        return wrapped, batches
+
+    def _update_local(self, key, value, **kwargs):
+        """
+        Update the process-local tier with a value just put in the backend.
+        Only anti-dogpiled values can be kept locally, as the soft timeout is
+        needed.
+        """
+
+        if self._is_anti_dogpiled(value):
+            self._set_local(key, value, **kwargs)
+        else:
+            self._delete_local(key, **kwargs)
+
     def add(self, key, value, timeout=None, hard=False, grace_time=None,
-            **kwargs):
+            compute_time=None, tags=None, **kwargs):
         """
-        Cache add with support for anti-dogpiling, enabled by default.
+        Cache add with support for anti-dogpiling, enabled by default. The
+        chunks of a chunked value are only set once the value is added, and
+        the value is deleted again if they fail, so a failed add leaves no
+        chunks behind. Until they are set, the value is missing.
         """
 
         timeout = timeout or self.default_timeout
 
+        self._discard_writebacks((key,), **kwargs)
+        chunks = {}
         if not hard:
-            value, timeout = self._add_anti_dogpiling(value, timeout,
-                                                      grace_time=grace_time)
-        self._backend.add(key, value, timeout=timeout, **kwargs)
+            value, timeout = self._add_anti_dogpiling(
+                value, timeout, grace_time=grace_time,
+                compute_time=compute_time, tags=tags)
+            chunks = self._split(key, value)
+        added = self._backend.add(key, value, timeout=timeout, **kwargs)
+        if added and chunks and self._backend.set_many(
+                chunks, timeout=timeout, **kwargs):
+            self._backend.delete(key, **kwargs)
+            added = False
+        if added and self._l1 is not None:
+            self._update_local(key, value, **kwargs)
+        return added
 
     def set(self, key, value, timeout=None, hard=False, grace_time=None,
-            **kwargs):
+            compute_time=None, tags=None, **kwargs):
         """
-        Cache set with support for anti-dogpiling, enabled by default.
+        Cache set with support for anti-dogpiling, enabled by default. The
+        compute time (seconds spent producing the value) is used by the
+        "xfetch" renewal mode.
         """
 
         timeout = timeout or self.default_timeout
 
-        if not hard:
-            value, timeout = self._add_anti_dogpiling(value, timeout,
-                                                      grace_time=grace_time)
-        self._backend.set(key, value, timeout=timeout, **kwargs)
+        self._discard_writebacks((key,), **kwargs)
+        if hard:
+            self._backend.set(key, value, timeout=timeout, **kwargs)
+        else:
+            value, timeout = self._add_anti_dogpiling(
+                value, timeout, grace_time=grace_time,
+                compute_time=compute_time, tags=tags)
+            self._set_wrapped(key, value, timeout, **kwargs)
+        if self._l1 is not None:
+            self._update_local(key, value, **kwargs)
 
     def get(self, key, default=None, **kwargs):
         """
         Cache get with support for anti-dogpiling.
         """
 
-        value = self._backend.get(key, **kwargs)
+        if self._l1 is not None:
+            value = self._get_local(key, **kwargs)
+            if value is not None:
+                return value
+
+        value, shared = self._get_coalesced(key, **kwargs)
+        if self._metrics is not None and (
+                shared or not self._is_anti_dogpiled(value)):
+            self._count_fetched(value)
         if self._is_anti_dogpiled(value):
-            value = self._apply_anti_dogpiling(key, value, **kwargs)
+            if shared:
+                value = value.value
+            else:
+                value = self._apply_anti_dogpiling(key, value, **kwargs)
         if value is None:
             return default
         return value
 
+    def get_or_set(self, key, producer, timeout=None, grace_time=None,
+                   **kwargs):
+        """
+        Cache get or set with anti-dogpiling, including when the value is not
+        in the cache at all. See AntiDogpiling.get_or_set. Like in Django's
+        own get_or_set, the producer may also be the value itself.
+        """
+
+        if not callable(producer):
+            producer = (lambda value: lambda: value)(producer)
+
+        timeout = timeout or self.default_timeout
+        return super(Cache, self).get_or_set(key, producer, timeout,
+                                             grace_time=grace_time, **kwargs)
+
+    def antidogpiled_view(self, timeout=None, grace_time=None,
+                          key_prefix=None, **kwargs):
+        """
+        Make a decorator caching the responses of a Django view with
+        get_or_set, by host and full path. Only successful responses to GET
+        and HEAD requests are cached, and template responses are rendered
+        before they are cached. Responses setting cookies are not cached, like
+        with Django's cache middleware. Only the content, status, and headers
+        are cached, and each request gets a new response, as middleware may
+        change it. Headers the response varies on (like cookies) are not taken
+        into account, so only use it on views which vary by URL alone.
+        """
+
+        def decorator(view):
+            key_builder = KeyBuilder(key_prefix or "view:%s.%s" % (
+                view.__module__, getattr(view, "__qualname__",
+                                         view.__name__)))
+
+            @functools.wraps(view)
+            def wrapper(request, *args, **view_kwargs):
+                if request.method not in ("GET", "HEAD"):
+                    return view(request, *args, **view_kwargs)
+
+                uncached = []
+
+                def producer():
+                    response = view(request, *args, **view_kwargs)
+                    if callable(getattr(response, "render", None)) and \
+                            not response.is_rendered:
+                        response = response.render()
+                    if (response.status_code != 200 or
+                            getattr(response, "streaming", False) or
+                            response.cookies):
+                        uncached.append(response)
+                        return None
+                    return (response.content, response.status_code,
+                            list(response.items()))
+
+                key = key_builder((request.get_host(),
+                                   request.get_full_path()), {})
+                cached = self.get_or_set(key, producer, timeout,
+                                         grace_time=grace_time, **kwargs)
+                if uncached:
+                    return uncached[0]
+                if cached is None: # Shared with an uncached response
+                    return view(request, *args, **view_kwargs)
+
+                # Imported here, as only the views need django.http
+                from django.http import HttpResponse
+
+                content, status, headers = cached
+                response = HttpResponse(content, status=status)
+                for header, value in headers:
+                    response[header] = value
+                return response
+
+            return wrapper
+
+        return decorator
+
     def delete(self, key, hard=False, **kwargs):
         """
         Cache delete with support for anti-dogpiling (soft invalidation),
-        enabled by default.
+        enabled by default. In the "marker" invalidation mode, only the marker
+        is written, so values set with hard=True must be deleted with
+        hard=True.
         """
 
+        self._discard_writebacks((key,), **kwargs)
+        if not hard and self.invalidation == "marker":
+            self._mark_invalidated((key,), **kwargs)
+            return
         if not hard:
             value = self._backend.get(key, **kwargs)
             if self._is_anti_dogpiled(value):
@@ -84,10 +311,327 @@ class Cache(AntiDogpiling):
                 return
 
         self._backend.delete(key, **kwargs)
+        self._delete_local(key, **kwargs)
+
+    def set_many(self, data, timeout=None, hard=False, grace_time=None,
+                 compute_time=None, tags=None, **kwargs):
+        """
+        Cache set many with support for anti-dogpiling, enabled by default.
+        """
+
+        timeout = timeout or self.default_timeout
+
+        self._discard_writebacks(data, **kwargs)
+        batches = {timeout: data}
+        if not hard and data:
+            data, batches = self._batch_wrapped(data, timeout, grace_time,
+                                                compute_time, tags)
+        failed = []
+        for timeout, batch in batches.items():
+            failed.extend(self._backend.set_many(batch, timeout=timeout,
+                                                 **kwargs) or ())
+        if failed:
+            failed = self._chunked_keys(failed)
+        if self._l1 is not None:
+            for key, value in data.items():
+                if key not in (failed or ()):
+                    self._update_local(key, value, **kwargs)
+        return failed
+
+    def get_many(self, keys, **kwargs):
+        """
+        Cache get many with support for anti-dogpiling. Keys which are due for
+        renewal are left out of the result, just like missing keys.
+        """
+
+        keys = list(keys)
+        result = {}
+        if self._l1 is not None:
+            for key in keys:
+                value = self._get_local(key, **kwargs)
+                if value is not None:
+                    result[key] = value
+            keys = [key for key in keys if key not in result]
+            if not keys:
+                return result
+
+        values = self._fetch_many(keys, **kwargs)
+
+        wrapped = {}
+        for key, value in values.items():
+            if self._is_anti_dogpiled(value):
+                wrapped[key] = value
+            else:
+                result[key] = value
+                if self._metrics is not None:
+                    self._count_fetched(value)
+        if self._metrics is not None and len(keys) > len(values):
+            self._metrics.incr(MISS, len(keys) - len(values))
+
+        if wrapped:
+            result.update(self._apply_anti_dogpiling_many(wrapped, **kwargs))
+        return result
+
+    def delete_many(self, keys, hard=False, **kwargs):
+        """
+        Cache delete many with support for anti-dogpiling (soft invalidation),
+        enabled by default. The markers are written in one write, like by
+        delete.
+        """
+
+        keys = list(keys)
+        self._discard_writebacks(keys, **kwargs)
+
+        if not hard and self.invalidation == "marker":
+            self._mark_invalidated(keys, **kwargs)
+            return
+        if not hard:
+            values = self._backend.get_many(keys, **kwargs)
+            wrapped = dict((key, value) for key, value in values.items()
+                           if self._is_anti_dogpiled(value))
+            if wrapped:
+                self._soft_invalidate_many(wrapped, **kwargs)
+                keys = [key for key in keys if key not in wrapped]
+                if not keys:
+                    return
+
+        self._backend.delete_many(keys, **kwargs)
+        if self._l1 is not None:
+            for key in keys:
+                self._delete_local(key, **kwargs)
+
+    async def _aget_directly(self, key, **kwargs):
+        """
+        Overriding to use the backend's async get.
+        """
+
+        return await self._backend.aget(key, **kwargs)
+
+    async def _aset_directly(self, key, value, timeout, **kwargs):
+        """
+        Overriding to use the backend's async set.
+        """
+
+        await self._backend.aset(key, value, timeout=timeout, **kwargs)
+
+    async def _aset_many_directly(self, values, timeout, **kwargs):
+        """
+        Overriding to use the backend's async bulk set.
+        """
+
+        await self._backend.aset_many(values, timeout=timeout, **kwargs)
+
+    async def _aget_many_directly(self, keys, **kwargs):
+        """
+        Overriding to get the values in one call to the backend.
+        """
+
+        return await self._backend.aget_many(keys, **kwargs)
+
+    async def _aadd_directly(self, key, value, timeout, **kwargs):
+        """
+        Overriding to use the backend's async add.
+        """
+
+        return await self._backend.aadd(key, value, timeout=timeout, **kwargs)
+
+    async def _adelete_directly(self, key, **kwargs):
+        """
+        Overriding to use the backend's async delete.
+        """
+
+        await self._backend.adelete(key, **kwargs)
+
+    async def aadd(self, key, value, timeout=None, hard=False,
+                   grace_time=None, compute_time=None, tags=None, **kwargs):
+        """
+        Async cache add with support for anti-dogpiling, enabled by default.
+        The chunks of a chunked value are set like by add.
+        """
+
+        timeout = timeout or self.default_timeout
+
+        await self._await_writebacks((key,), **kwargs)
+        chunks = {}
+        if not hard:
+            value, timeout = self._add_anti_dogpiling(
+                value, timeout, grace_time=grace_time,
+                compute_time=compute_time, tags=tags)
+            chunks = self._split(key, value)
+        added = await self._backend.aadd(key, value, timeout=timeout,
+                                         **kwargs)
+        if added and chunks and await self._backend.aset_many(
+                chunks, timeout=timeout, **kwargs):
+            await self._backend.adelete(key, **kwargs)
+            added = False
+        if added and self._l1 is not None:
+            self._update_local(key, value, **kwargs)
+        return added
+
+    async def aset(self, key, value, timeout=None, hard=False,
+                   grace_time=None, compute_time=None, tags=None, **kwargs):
+        """
+        Async cache set with support for anti-dogpiling, enabled by default.
+        """
+
+        timeout = timeout or self.default_timeout
+
+        await self._await_writebacks((key,), **kwargs)
+        if hard:
+            await self._backend.aset(key, value, timeout=timeout, **kwargs)
+        else:
+            value, timeout = self._add_anti_dogpiling(
+                value, timeout, grace_time=grace_time,
+                compute_time=compute_time, tags=tags)
+            await self._aset_wrapped(key, value, timeout, **kwargs)
+        if self._l1 is not None:
+            self._update_local(key, value, **kwargs)
+
+    async def aget(self, key, default=None, **kwargs):
+        """
+        Async cache get with support for anti-dogpiling. The renewal
+        write-back runs in the background.
+        """
+
+        if self._l1 is not None:
+            value = self._get_local(key, **kwargs)
+            if value is not None:
+                return value
+
+        value = await self._afetch(key, **kwargs)
+        if self._metrics is not None and not self._is_anti_dogpiled(value):
+            self._count_fetched(value)
+        if self._is_anti_dogpiled(value):
+            value = await self._aapply_anti_dogpiling(key, value, **kwargs)
+        if value is None:
+            return default
+        return value
+
+    async def aget_or_set(self, key, producer, timeout=None, grace_time=None,
+                          **kwargs):
+        """
+        Async cache get or set with anti-dogpiling. See
+        AntiDogpiling.aget_or_set. The producer may be a coroutine function,
+        or the value itself.
+        """
+
+        if not callable(producer):
+            producer = (lambda value: lambda: value)(producer)
+
+        timeout = timeout or self.default_timeout
+        return await super(Cache, self).aget_or_set(
+            key, producer, timeout, grace_time=grace_time, **kwargs)
+
+    async def adelete(self, key, hard=False, **kwargs):
+        """
+        Async cache delete with support for anti-dogpiling (soft
+        invalidation), enabled by default.
+        """
+
+        if not hard and self.invalidation == "marker":
+            await self._amark_invalidated((key,), **kwargs)
+            return
+        if not hard:
+            value = await self._backend.aget(key, **kwargs)
+            if self._is_anti_dogpiled(value):
+                await self._asoft_invalidate(key, value, **kwargs)
+                return
+
+        await self._await_writebacks((key,), **kwargs)
+        await self._backend.adelete(key, **kwargs)
+        self._delete_local(key, **kwargs)
+
+    async def aset_many(self, data, timeout=None, hard=False, grace_time=None,
+                        compute_time=None, tags=None, **kwargs):
+        """
+        Async cache set many with support for anti-dogpiling, enabled by
+        default.
+        """
+
+        timeout = timeout or self.default_timeout
+
+        await self._await_writebacks(data, **kwargs)
+        batches = {timeout: data}
+        if not hard and data:
+            data, batches = self._batch_wrapped(data, timeout, grace_time,
+                                                compute_time, tags)
+        failed = []
+        for timeout, batch in batches.items():
+            failed.extend(await self._backend.aset_many(
+                batch, timeout=timeout, **kwargs) or ())
+        if failed:
+            failed = self._chunked_keys(failed)
+        if self._l1 is not None:
+            for key, value in data.items():
+                if key not in (failed or ()):
+                    self._update_local(key, value, **kwargs)
+        return failed
+
+    async def aget_many(self, keys, **kwargs):
+        """
+        Async cache get many with support for anti-dogpiling. The renewal
+        write-backs run in the background.
+        """
+
+        keys = list(keys)
+        result = {}
+        if self._l1 is not None:
+            for key in keys:
+                value = self._get_local(key, **kwargs)
+                if value is not None:
+                    result[key] = value
+            keys = [key for key in keys if key not in result]
+            if not keys:
+                return result
+
+        values = await self._afetch_many(keys, **kwargs)
+
+        wrapped = {}
+        for key, value in values.items():
+            if self._is_anti_dogpiled(value):
+                wrapped[key] = value
+            else:
+                result[key] = value
+                if self._metrics is not None:
+                    self._count_fetched(value)
+        if self._metrics is not None and len(keys) > len(values):
+            self._metrics.incr(MISS, len(keys) - len(values))
+
+        if wrapped:
+            result.update(await self._aapply_anti_dogpiling_many(wrapped,
+                                                                 **kwargs))
+        return result
+
+    async def adelete_many(self, keys, hard=False, **kwargs):
+        """
+        Async cache delete many with support for anti-dogpiling (soft
+        invalidation), enabled by default.
+        """
+
+        keys = list(keys)
+
+        if not hard and self.invalidation == "marker":
+            await self._amark_invalidated(keys, **kwargs)
+            return
+        if not hard:
+            values = await self._backend.aget_many(keys, **kwargs)
+            wrapped = dict((key, value) for key, value in values.items()
+                           if self._is_anti_dogpiled(value))
+            if wrapped:
+                await self._asoft_invalidate_many(wrapped, **kwargs)
+                keys = [key for key in keys if key not in wrapped]
+                if not keys:
+                    return
+
+        await self._await_writebacks(keys, **kwargs)
+        await self._backend.adelete_many(keys, **kwargs)
+        if self._l1 is not None:
+            for key in keys:
+                self._delete_local(key, **kwargs)
 
     def __getattr__(self, name):
         """
-        Forward unrecognized attribute access (incr, decr, get_many, etc) to
+        Forward unrecognized attribute access (incr, decr, has_key, etc) to
         the backend.
         """
 
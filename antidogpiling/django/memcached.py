@@ -1,3 +1,14 @@
+"""
+Anti-dogpiled Memcached backends.
+
+Memcached's add is atomic, so these backends work well with the "lease"
+renewal mode, letting exactly one client through to renew a value that has
+timed out softly. Enable it with the renewal option::
+
+    'OPTIONS': {
+        'renewal': 'lease',
+    },
+"""
 from antidogpiling.django.common import Cache
 from django.core.cache.backends import memcached
 
@@ -0,0 +1,315 @@
+"""
+Anti-dogpiled cache backend spreading the keys over several nodes, like
+Memcached servers, by ketama consistent hashing (see antidogpiling.ring).
+
+Each node is a Django cache backend of its own, Memcached by default. Bulk
+gets, sets, and deletes are split per node, into one call per node, and the
+calls to the nodes are made concurrently, by a pool of a worker per node shared
+by the process. While all workers are busy, like with a node hanging, the calls
+are made in the calling thread instead of waiting for a worker. As the renewal
+write-backs of a bulk get are written with one bulk set, they take one call per
+node as well.
+
+A node failing a call is considered down for RETRY_TIMEOUT seconds. Its keys
+are then misses, and writes to it are dropped, rather than raising exceptions.
+Adds to it fail, but the leases of get_or_set on it are not waited for, so
+clients go on to produce the values instead of waiting for leases nobody can
+get. With the single_flight option, the
+clients of the process still share one call to the producer per key. The keys
+of a node that is down are not moved to the other nodes, which would only
+have them produced again once the node is back. Example::
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'antidogpiling.django.multinode.MultiNodeCache',
+            'LOCATION': ['10.0.0.1:11211', '10.0.0.2:11211'],
+            'OPTIONS': {
+                'NODE_BACKEND':
+                    'django.core.cache.backends.memcached.PyMemcacheCache',
+                'RETRY_TIMEOUT': 30,
+                'single_flight': True,
+            },
+        },
+    }
+"""
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from antidogpiling import _import, _shared
+from antidogpiling.django.common import Cache
+from antidogpiling.ring import HashRing
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+
+DEFAULT_NODE_BACKEND = "django.core.cache.backends.memcached.PyMemcacheCache"
+
+
+class ConsistentHashingBackend(BaseCache):
+    """
+    Django cache backend spreading the keys over several node backends.
+    """
+
+    def __init__(self, servers, params):
+        """
+        Set up a node backend per server, given as a list or as a string
+        separated by semicolons or commas. The options of this backend are
+        read from the OPTIONS dict in the params: NODE_BACKEND, the node
+        backend class or its dotted path, RETRY_TIMEOUT, and WEIGHTS, a dict
+        of the weights of the servers. The other options are passed on to the
+        node backends.
+        """
+
+        super(ConsistentHashingBackend, self).__init__(params)
+        if isinstance(servers, str):
+            servers = servers.replace(",", ";").split(";")
+        servers = [server.strip() for server in servers if server.strip()]
+
+        options = dict(params.get("OPTIONS") or {})
+        node_backend = options.pop("NODE_BACKEND", DEFAULT_NODE_BACKEND)
+        if isinstance(node_backend, str):
+            node_backend = _import(node_backend)
+        self.retry_timeout = float(options.pop("RETRY_TIMEOUT", 30))
+        self._ring = HashRing(servers, options.pop("WEIGHTS", None))
+
+        node_params = dict(params, OPTIONS=options)
+        self._nodes = dict((server, node_backend(server, node_params))
+                           for server in servers)
+
+        # Shared by the instances of all threads
+        scope = ("antidogpiling.multinode", tuple(servers))
+        self._down = _shared(scope, dict) # Server: Time to retry
+        self._executor = _shared(scope, ThreadPoolExecutor, len(servers))
+        self._idle = _shared(scope, threading.Semaphore, len(servers))
+
+    def is_down(self, key, version=None):
+        """
+        Check whether the node of a key is down.
+        """
+
+        return self._down.get(self._node(key, version), 0) > time.time()
+
+    def _node(self, key, version=None):
+        """
+        Get the server of a key, by the key as made for the nodes, so
+        different versions and key prefixes of a key are spread too.
+        """
+
+        return self._ring.get_node(self.make_key(key, version))
+
+    def _call(self, server, fallback, method, *args, **kwargs):
+        """
+        Call a method of a node backend. The fallback is returned if the node
+        is down, or fails the call, which marks it as down.
+        """
+
+        if self._down.get(server, 0) > time.time():
+            return fallback
+        try:
+            return getattr(self._nodes[server], method)(*args, **kwargs)
+        except Exception:
+            self._down[server] = time.time() + self.retry_timeout
+            return fallback
+
+    def _group(self, keys, version=None):
+        """
+        Group keys by their node, as a dict of servers and lists of keys.
+        """
+
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._node(key, version), []).append(key)
+        return groups
+
+    def _call_nodes(self, calls):
+        """
+        Make several calls with _call concurrently, given as tuples of its
+        arguments and a dict of keyword arguments, and get their results in
+        the same order. The first call is made in this thread, and so are the
+        calls finding all workers busy, like with a node hanging, so they
+        never queue behind the calls of other clients.
+        """
+
+        if not calls:
+            return []
+        futures = []
+        for args, kwargs in calls[1:]:
+            if self._idle.acquire(False):
+                futures.append(self._executor.submit(self._call_worker, args,
+                                                     kwargs))
+            else:
+                futures.append(None)
+        args, kwargs = calls[0]
+        results = [self._call(*args, **kwargs)]
+        for future, (args, kwargs) in zip(futures, calls[1:]):
+            if future is None:
+                results.append(self._call(*args, **kwargs))
+            else:
+                results.append(future.result())
+        return results
+
+    def _call_worker(self, args, kwargs):
+        """
+        Make a call with _call in a worker, and free the worker.
+        """
+
+        try:
+            return self._call(*args, **kwargs)
+        finally:
+            self._idle.release()
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Add a value on its node. Adds to nodes which are down fail.
+        """
+
+        return self._call(self._node(key, version), False, "add", key, value,
+                          timeout, version=version)
+
+    def get(self, key, default=None, version=None):
+        """
+        Get a value from its node.
+        """
+
+        return self._call(self._node(key, version), default, "get", key,
+                          default, version=version)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Set a value on its node.
+        """
+
+        self._call(self._node(key, version), None, "set", key, value, timeout,
+                   version=version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Update the timeout of a value on its node.
+        """
+
+        return self._call(self._node(key, version), False, "touch", key,
+                          timeout, version=version)
+
+    def delete(self, key, version=None):
+        """
+        Delete a value from its node.
+        """
+
+        return self._call(self._node(key, version), False, "delete", key,
+                          version=version)
+
+    def incr(self, key, delta=1, version=None):
+        """
+        Increment a value on its node. Failures are raised, as there is no
+        sensible fallback.
+        """
+
+        return self._nodes[self._node(key, version)].incr(key, delta,
+                                                          version=version)
+
+    def decr(self, key, delta=1, version=None):
+        """
+        Decrement a value on its node. Failures are raised, like with incr.
+        """
+
+        return self._nodes[self._node(key, version)].decr(key, delta,
+                                                          version=version)
+
+    def has_key(self, key, version=None):
+        """
+        Check for a key on its node.
+        """
+
+        return self._call(self._node(key, version), False, "has_key", key,
+                          version=version)
+
+    def get_many(self, keys, version=None):
+        """
+        Get the values in one call per node, concurrently. The keys of nodes
+        which are down are left out.
+        """
+
+        groups = self._group(keys, version)
+        values = {}
+        for result in self._call_nodes([
+                ((server, {}, "get_many", group), {"version": version})
+                for server, group in groups.items()]):
+            values.update(result)
+        return values
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Set the values in one call per node, concurrently. The keys failed,
+        including the keys of nodes which are down, are returned.
+        """
+
+        groups = self._group(data, version)
+        failed = []
+        for result in self._call_nodes([
+                ((server, group, "set_many",
+                  dict((key, data[key]) for key in group), timeout),
+                 {"version": version})
+                for server, group in groups.items()]):
+            failed.extend(result or ())
+        return failed
+
+    def delete_many(self, keys, version=None):
+        """
+        Delete the values in one call per node, concurrently.
+        """
+
+        groups = self._group(keys, version)
+        self._call_nodes([((server, None, "delete_many", group),
+                           {"version": version})
+                          for server, group in groups.items()])
+
+    def clear(self):
+        """
+        Delete all values, on all nodes.
+        """
+
+        self._call_nodes([((server, None, "clear"), {})
+                          for server in self._nodes])
+
+    def close(self, **kwargs):
+        """
+        Close the connections of the node backends.
+        """
+
+        for node in self._nodes.values():
+            node.close(**kwargs)
+
+
+class MultiNodeCache(Cache):
+    """
+    Cache backend with support for anti-dogpiling, spreading the keys over
+    several nodes by consistent hashing.
+    """
+
+    def __init__(self, servers, params):
+        super(MultiNodeCache, self).__init__(ConsistentHashingBackend,
+                                             servers, params)
+
+    def _add_directly(self, key, value, timeout, **kwargs):
+        """
+        Overriding to tell adds to nodes which are down apart, by returning
+        None for them, so their leases are not waited for.
+        """
+
+        added = super(MultiNodeCache, self)._add_directly(key, value, timeout,
+                                                          **kwargs)
+        if not added and self._backend.is_down(key, kwargs.get("version")):
+            return None
+        return added
+
+    async def _aadd_directly(self, key, value, timeout, **kwargs):
+        """
+        Asynchronous _add_directly.
+        """
+
+        added = await super(MultiNodeCache, self)._aadd_directly(
+            key, value, timeout, **kwargs)
+        if not added and self._backend.is_down(key, kwargs.get("version")):
+            return None
+        return added
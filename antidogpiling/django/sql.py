@@ -0,0 +1,68 @@
+import contextlib
+
+from antidogpiling.sql import UPSERTS, SQLCache
+from django.db import IntegrityError, connections, transaction
+
+
+class DatabaseCache(SQLCache):
+    """
+    Native anti-dogpiled database cache backend, on a Django database
+    connection, claiming the renewals in place (see antidogpiling.sql). Values
+    are set with upserts on SQLite, PostgreSQL, and MySQL.
+
+    Unlike the Django database backend, it does not support key versions and
+    prefixes (the version argument), nor the async methods other than
+    aget_or_set, and the table is created with the create_table method instead
+    of the createcachetable command. Only values set with hard=True can be
+    incremented.
+    """
+
+    def __init__(self, table, params):
+        """
+        Initialize like a Django cache backend. The anti-dogpiling options,
+        MAX_ENTRIES, and DATABASE, the alias of the database to use, are read
+        from the OPTIONS dict in the params.
+        """
+
+        options = dict(params.get("OPTIONS") or {})
+        self.database = options.pop("DATABASE", "default")
+        adp_options = dict((name, options[name]) for name in self.OPTION_NAMES
+                           if name in options)
+        adp_options["scope"] = (DatabaseCache, self.database, table)
+        connection = connections[self.database]
+        super(DatabaseCache, self).__init__(
+            None, connection.ops.quote_name(table), paramstyle="format",
+            vendor=connection.vendor if connection.vendor in UPSERTS else None,
+            max_entries=options.get("MAX_ENTRIES", 0),
+            default_timeout=params.get("TIMEOUT", 300), **adp_options)
+
+    def _connection(self):
+        """
+        Overriding to use the Django connection of the current thread.
+        """
+
+        return connections[self.database]
+
+    def _integrity_error(self):
+        """
+        Overriding for the exceptions wrapped by Django.
+        """
+
+        return IntegrityError
+
+    @contextlib.contextmanager
+    def _cursor(self):
+        """
+        Overriding to run the statements in an atomic block.
+        """
+
+        with transaction.atomic(using=self.database):
+            with self._connection().cursor() as cursor:
+                yield cursor
+
+    def close(self, **kwargs):
+        """
+        Nothing to close, as Django manages the connection.
+        """
+
+        pass
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Anti-dogpiled cache in files, one per key, claiming the renewals in the file
+headers.
+
+Each file starts with a fixed-size header with the timeouts and flags of the
+wrapper, followed by the tags and the (pickled, and possibly compressed)
+value. Reads memory-map the file under a shared lock, and only copy the value
+out of the map when it is to be used. The renewal of a value which has timed
+out softly is claimed by updating the soft timeout in the header in place,
+under an exclusive lock, if the stamp is still the one read, so exactly one
+client wins it, and the value is never written back (see
+antidogpiling.native). Values are written to a temporary file which replaces
+the old one, so readers never see half-written values.
+
+The locks are fcntl locks, so the backend is for POSIX systems, with the
+directory on a local file system. Expired files are only deleted by cull,
+which is run by sets with the max_entries option once there are more files
+than that. Like with the Django file-based backend, it then deletes a share of
+the files given by cull_frequency, so the next sets need not cull again.
+"""
+
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+
+from antidogpiling import Wrapper
+from antidogpiling.native import NativeCache, StoredWrapper
+
+
+MAGIC = b"ADP1"
+
+SUFFIX = ".adpcache"
+
+HEADER = struct.Struct("<4sBBxxIIdddddd")
+"""
+The header of a file: the magic, whether the value is anti-dogpiled, the
+renewing flag, the flags of the payload, the length of the tags, the soft
+timeout, the stamp, the hard timeout, the grace time, the compute time, and
+the expiry time. The values set with hard=True only have the flags and the
+expiry time.
+"""
+
+RENEWING = struct.Struct("<B")
+RENEWING_OFFSET = 5
+
+SOFT_TIMEOUT_AND_STAMP = struct.Struct("<dd")
+SOFT_TIMEOUT_OFFSET = 16
+
+
+class FileCache(NativeCache):
+    """
+    Anti-dogpiled cache in files.
+    """
+
+    def __init__(self, directory, max_entries=0, cull_frequency=3,
+                 default_timeout=300, **kwargs):
+        """
+        Set up the cache, creating the directory if missing. The
+        anti-dogpiling options are given as keyword arguments.
+
+        :param directory: The directory of the files.
+        :param max_entries: Cull the values when a set finds more than this
+                many. The default is 0, for no limit.
+        :param cull_frequency: Cull 1/cull_frequency of max_entries, besides
+                the expired values, or all the values with 0.
+        :param default_timeout: The default (soft) timeout, in seconds.
+        """
+
+        super(FileCache, self).__init__(default_timeout, **kwargs)
+        self.directory = os.path.abspath(directory)
+        self.max_entries = int(max_entries)
+        self.cull_frequency = int(cull_frequency)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _path(self, key):
+        """
+        Get the path of the file of a key.
+        """
+
+        name = hashlib.md5(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + SUFFIX)
+
+    def _paths(self):
+        """
+        Get the paths of all the files of the cache.
+        """
+
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(SUFFIX)]
+
+    def _remove(self, path):
+        """
+        Remove a file, unless already removed.
+        """
+
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _write(self, value, timeout, now):
+        """
+        Write a value to a new temporary file, and get its path.
+        """
+
+        if self._is_anti_dogpiled(value):
+            flags, data = value._pickled()
+            tags = "\0".join(value.tags).encode("utf-8")
+            header = HEADER.pack(
+                MAGIC, 1, int(value.renewing), flags, len(tags),
+                value.soft_timeout, value.stamp, value.hard_timeout,
+                value.grace_time, value.compute_time, now + timeout)
+        else:
+            flags, tags = Wrapper.PICKLED, b""
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            header = HEADER.pack(MAGIC, 0, 0, flags, 0, 0, 0, 0, 0, 0,
+                                 now + timeout)
+
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                f.write(tags)
+                f.write(data)
+        except BaseException:
+            self._remove(path)
+            raise
+        return path
+
+    def _read(self, path, now):
+        """
+        Read the value of a file: a StoredWrapper, the value itself if not
+        anti-dogpiled, or None if missing or expired. The renewal of a value
+        which has timed out softly is claimed right away, and the wrapper of
+        a value claimed gets a soft timeout of 0, so the renewal is followed
+        by the anti-dogpiling mechanisms. Its payload is left out unless the
+        old value may be served, by a background refresh or to the clients
+        sharing the fetch (the single_flight option).
+        """
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            view = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            try:
+                (magic, wrapped, renewing, flags, tags_length, soft_timeout,
+                 stamp, hard_timeout, grace_time, compute_time,
+                 expires) = HEADER.unpack_from(view)
+                if magic != MAGIC or expires <= now:
+                    return None
+                if not wrapped:
+                    return pickle.loads(view[HEADER.size:])
+
+                offset = HEADER.size + tags_length
+                tags = view[HEADER.size:offset]
+                due = soft_timeout < now
+                data = None
+                if (not due or self._refresh_pool is not None or
+                        self.single_flight):
+                    data = view[offset:]
+            finally:
+                view.close()
+        finally:
+            os.close(fd)
+
+        wrapper = StoredWrapper(None, soft_timeout, hard_timeout, grace_time,
+                                compute_time, stamp,
+                                tags.decode("utf-8").split("\0") if tags
+                                else ())
+        wrapper.renewing = bool(renewing)
+        if due:
+            if not self._claim(path, stamp, grace_time, now):
+                return self._read(path, now)
+            wrapper.soft_timeout = 0
+            wrapper.claimed = True
+        if data is not None:
+            wrapper._load(flags, data)
+        return wrapper
+
+    def _claim(self, path, stamp, grace_time, now):
+        """
+        Claim the renewal of the value of a file, by updating the soft timeout
+        and stamp in the header, if the file has not been replaced and still
+        has the given stamp.
+        """
+
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino != os.stat(path).st_ino:
+                    return False
+            except OSError:
+                return False
+
+            header = os.pread(fd, HEADER.size, 0)
+            if len(header) < HEADER.size or HEADER.unpack(header)[6] != stamp:
+                return False
+            os.pwrite(fd, RENEWING.pack(1), RENEWING_OFFSET)
+            os.pwrite(fd, SOFT_TIMEOUT_AND_STAMP.pack(now + grace_time, now),
+                      SOFT_TIMEOUT_OFFSET)
+            return True
+        finally:
+            os.close(fd)
+
+    def _store_many(self, values, timeout):
+        """
+        Replace the files of the values.
+        """
+
+        now = self._clock()
+        for key, value in values.items():
+            os.replace(self._write(value, timeout, now), self._path(key))
+        self._cull_if_full()
+
+    def _add_directly(self, key, value, timeout, **kwargs):
+        """
+        Overriding to support add and get_or_set. The file is linked into
+        place, so only one client adds a value.
+        """
+
+        now = self._clock()
+        path = self._path(key)
+        temporary = self._write(value, timeout, now)
+        try:
+            self._remove_expired(path, now)
+            try:
+                os.link(temporary, path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                return False
+        finally:
+            self._remove(temporary)
+        self._cull_if_full()
+        return True
+
+    def _get_many_directly(self, keys, **kwargs):
+        """
+        Overriding as required by the NativeCache class.
+        """
+
+        now = self._clock()
+        values = {}
+        for key in keys:
+            value = self._read(self._path(key), now)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def _claim_directly(self, key, value):
+        """
+        Claim the renewal of a value in its header, for values invalidated by
+        the markers of their tags.
+        """
+
+        return self._claim(self._path(key), value.stamp, value.grace_time,
+                           self._clock())
+
+    def _invalidate_directly(self, keys):
+        """
+        Invalidate the values in their headers, and delete the ones not
+        anti-dogpiled.
+        """
+
+        for key in keys:
+            path = self._path(key)
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                header = os.pread(fd, HEADER.size, 0)
+                if len(header) == HEADER.size and HEADER.unpack(header)[1]:
+                    os.pwrite(fd, RENEWING.pack(0), RENEWING_OFFSET)
+                    os.pwrite(fd, struct.pack("<d", 0), SOFT_TIMEOUT_OFFSET)
+                    continue
+            finally:
+                os.close(fd)
+            self._remove(path)
+
+    def _delete_many_directly(self, keys):
+        """
+        Delete the files of the values.
+        """
+
+        for key in keys:
+            self._remove(self._path(key))
+
+    def _remove_expired(self, path, now):
+        """
+        Remove a file if it has expired, under an exclusive lock, unless it
+        has been replaced meanwhile. So clients racing to add a value never
+        remove the file added by another.
+        """
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino != os.stat(path).st_ino:
+                    return
+            except OSError:
+                return
+
+            header = os.pread(fd, HEADER.size, 0)
+            if len(header) < HEADER.size or HEADER.unpack(header)[-1] <= now:
+                self._remove(path)
+        finally:
+            os.close(fd)
+
+    def _expires(self, path):
+        """
+        Get the expiry time in the header of a file, or 0 if missing.
+        """
+
+        try:
+            with open(path, "rb") as f:
+                header = f.read(HEADER.size)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+        if len(header) < HEADER.size:
+            return 0
+        return HEADER.unpack(header)[-1]
+
+    def _cull_if_full(self):
+        """
+        Cull the values if there are more than max_entries, counting the files
+        without opening them.
+        """
+
+        if self.max_entries and len(self._paths()) > self.max_entries:
+            self.cull()
+
+    def cull(self):
+        """
+        Delete the expired values, and if there are more than max_entries
+        left, the values expiring first down to max_entries, less
+        1/cull_frequency of it.
+        """
+
+        now = self._clock()
+        entries = []
+        for path in self._paths():
+            expires = self._expires(path)
+            if expires <= now:
+                self._remove_expired(path, now)
+            else:
+                entries.append((expires, path))
+
+        if self.max_entries and len(entries) > self.max_entries:
+            keep = 0
+            if self.cull_frequency:
+                keep = self.max_entries - (self.max_entries //
+                                           self.cull_frequency)
+            entries.sort()
+            for _, path in entries[:len(entries) - keep]:
+                self._remove(path)
+
+    def clear(self):
+        """
+        Delete all values.
+        """
+
+        for path in self._paths():
+            self._remove(path)
+        if self._l1 is not None:
+            self._l1.clear()
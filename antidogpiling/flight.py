@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Coalescing of concurrent calls within one process (single flight).
+
+Calls for the same key are let through one at a time: the first caller runs
+the call, while everyone arriving before it completes waits for its future and
+shares the result (or exception).
+
+The table of calls in flight is bounded, and only holds weak references to
+the futures, which are kept alive by the callers alone. When the table is
+full, calls are run directly without coalescing.
+"""
+
+import threading
+import weakref
+
+from concurrent.futures import Future
+
+
+class FlightTable(object):
+    """
+    Table of calls in flight, by key.
+    """
+
+    def __init__(self, max_size=1000):
+        """
+        Start with no calls in flight.
+
+        :param max_size: The maximum number of keys in flight at once.
+        """
+
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._flights = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        """
+        Get the number of calls in flight.
+        """
+
+        return len(self._flights)
+
+    def run(self, key, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs), unless a call for the same key is already
+        in flight, in which case its result is awaited and returned instead.
+        """
+
+        return self.do(key, func, *args, **kwargs)[0]
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Like run, but return a tuple of the result and whether it was shared
+        with (run by) another caller.
+        """
+
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader and len(self._flights) < self.max_size:
+                future = self._flights[key] = Future()
+
+        if not leader:
+            return future.result(), True
+        if future is None:
+            return func(*args, **kwargs), False
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self._land(key)
+            future.set_exception(e)
+            raise
+
+        self._land(key)
+        future.set_result(result)
+        return result, False
+
+    def _land(self, key):
+        """
+        Remove a completed call from the table.
+        """
+
+        with self._lock:
+            self._flights.pop(key, None)
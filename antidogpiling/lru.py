@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+A thread-safe, in-process LRU cache with an optional memory limit.
+"""
+
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Mapping of keys to values, evicting the least recently used entries when
+    there are too many of them, or when they take up too much memory.
+
+    The memory used by an entry is estimated by the sizeof function, which is
+    only called when there is a memory limit.
+    """
+
+    def __init__(self, max_entries, max_bytes=0, sizeof=None):
+        """
+        Start with an empty cache.
+
+        :param max_entries: The maximum number of entries.
+        :param max_bytes: The maximum total size of the entries, or 0 for no
+                limit.
+        :param sizeof: Function estimating the size of a value in bytes.
+        """
+
+        if max_bytes and sizeof is None:
+            raise ValueError("A sizeof function is required with max_bytes")
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # Key: (value, size)
+
+    def __len__(self):
+        """
+        Get the number of entries.
+        """
+
+        return len(self._entries)
+
+    def __contains__(self, key):
+        """
+        Check for a key, without marking it as used.
+        """
+
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Get a value, marking it as the most recently used.
+        """
+
+        with self._lock:
+            try:
+                entry = self._entries[key]
+            except KeyError:
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        """
+        Set a value as the most recently used, evicting the least recently
+        used values as needed. A value larger than the memory limit on its
+        own is not stored.
+        """
+
+        size = self.sizeof(value) if self.max_bytes else 0
+
+        with self._lock:
+            self._put(key, value, size)
+
+    def compare_and_set(self, key, expected, value):
+        """
+        Set a value like set, but only if the current value is the expected
+        one (by identity), or if the key is missing and None is expected.
+        Whether the value was set is returned.
+        """
+
+        size = self.sizeof(value) if self.max_bytes else 0
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry[0] if entry is not None else None) is not expected:
+                return False
+            self._put(key, value, size)
+            return True
+
+    def compare_and_delete(self, key, expected):
+        """
+        Delete a value, but only if it is the expected one (by identity).
+        Whether the value was deleted is returned.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] is not expected:
+                return False
+            self._pop(key)
+            return True
+
+    def delete(self, key):
+        """
+        Delete a value, if present.
+        """
+
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        """
+        Delete all values.
+        """
+
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _put(self, key, value, size):
+        """
+        Set a value of the given size while holding the lock, evicting the
+        least recently used values as needed.
+        """
+
+        self._pop(key)
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        self._entries[key] = (value, size)
+        self.size += size
+
+        while (len(self._entries) > self.max_entries or
+               (self.max_bytes and self.size > self.max_bytes)):
+            self.size -= self._entries.popitem(last=False)[1][1]
+
+    def _pop(self, key):
+        """
+        Remove an entry while holding the lock.
+        """
+
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Anti-dogpiled cache in the memory of the process, keeping the values by
+reference.
+
+Unlike the Django local-memory backend, nothing is pickled: the wrappers are
+kept as they are, and never changed once stored. Reads get a copy of the
+wrapper, sharing the value. The renewal of a value which has timed out softly
+is claimed when it is read, by swapping in a wrapper with the new soft
+timeout if the stored one is still the one read, so exactly one thread wins it
+(see antidogpiling.native). Soft invalidations swap in new wrappers as well.
+
+As the values are shared, callers must not change the values they get, unless
+the copy option is set, copying the values when read. The values are kept in
+an LRU cache (see antidogpiling.lru), with an optional memory limit.
+"""
+
+import copy
+import sys
+
+from antidogpiling import Wrapper, _shared
+from antidogpiling.lru import LRUCache
+from antidogpiling.native import NativeCache, StoredWrapper
+
+
+def _sizeof(entry, seen=None):
+    """
+    Estimate the size of an entry by sys.getsizeof, recursing into wrappers
+    and the built-in containers.
+    """
+
+    if seen is None:
+        seen = set()
+    if id(entry) in seen:
+        return 0
+    seen.add(id(entry))
+
+    if isinstance(entry, Wrapper):
+        return sys.getsizeof(entry) + _sizeof(entry._value, seen)
+    size = sys.getsizeof(entry)
+    if isinstance(entry, dict):
+        for key, value in entry.items():
+            size += _sizeof(key, seen) + _sizeof(value, seen)
+    elif isinstance(entry, (list, tuple, set, frozenset)):
+        for item in entry:
+            size += _sizeof(item, seen)
+    return size
+
+
+class MemoryCache(NativeCache):
+    """
+    Anti-dogpiled cache in the memory of the process.
+    """
+
+    def __init__(self, name="", max_entries=300, max_bytes=0, copy=False,
+                 default_timeout=300, **kwargs):
+        """
+        Set up the cache. The anti-dogpiling options are given as keyword
+        arguments.
+
+        :param name: The name of the cache. Caches with the same name and
+                limits share the values.
+        :param max_entries: The maximum number of values.
+        :param max_bytes: The maximum total size of the values, estimated with
+                sys.getsizeof, or 0 for no limit.
+        :param copy: Whether to copy the values when read, for callers
+                changing them.
+        :param default_timeout: The default (soft) timeout, in seconds.
+        """
+
+        super(MemoryCache, self).__init__(default_timeout, **kwargs)
+        self.copy = copy
+        self._store = _shared(("antidogpiling.memory", name), LRUCache,
+                              int(max_entries), int(max_bytes), _sizeof)
+
+    def _wrap(self, value, **kwargs):
+        """
+        Get a new StoredWrapper of the value of a wrapper, with the same
+        attributes unless given.
+        """
+
+        wrapper = StoredWrapper(
+            value._value, kwargs.get("soft_timeout", value.soft_timeout),
+            value.hard_timeout, value.grace_time, value.compute_time,
+            kwargs.get("stamp", value.stamp), value.tags)
+        wrapper._payload = value._payload
+        wrapper.compression = value.compression
+        wrapper.renewing = kwargs.get("renewing", value.renewing)
+        return wrapper
+
+    def _read(self, key, now):
+        """
+        Read a value: a copy of its wrapper, the value itself if not
+        anti-dogpiled, or None if missing or expired. The renewal of a value
+        which has timed out softly is claimed right away, and the wrapper of
+        a value claimed gets a soft timeout of 0, so the renewal is followed
+        by the anti-dogpiling mechanisms.
+        """
+
+        entry = self._store.get(key)
+        if entry is None:
+            return None
+
+        value, expires = entry
+        if expires <= now:
+            self._store.compare_and_delete(key, entry)
+            return None
+        if not self._is_anti_dogpiled(value):
+            return copy.deepcopy(value) if self.copy else value
+
+        wrapper = self._wrap(value)
+        if self.copy:
+            wrapper._value = copy.deepcopy(value._value)
+        if value.soft_timeout < now:
+            renewed = self._wrap(value, soft_timeout=now + value.grace_time,
+                                 stamp=now, renewing=True)
+            if not self._store.compare_and_set(key, entry,
+                                               (renewed, expires)):
+                return self._read(key, now)
+            wrapper.soft_timeout = 0
+            wrapper.claimed = True
+        return wrapper
+
+    def _store_many(self, values, timeout):
+        """
+        Store the values by reference, with new wrappers.
+        """
+
+        expires = self._clock() + timeout
+        for key, value in values.items():
+            if self._is_anti_dogpiled(value):
+                value = self._wrap(value)
+            self._store.set(key, (value, expires))
+
+    def _add_directly(self, key, value, timeout, **kwargs):
+        """
+        Overriding to support add and get_or_set. The value is swapped in, so
+        only one client adds it.
+        """
+
+        now = self._clock()
+        if self._is_anti_dogpiled(value):
+            value = self._wrap(value)
+        entry = self._store.get(key)
+        if entry is not None and entry[1] > now:
+            return False
+        return self._store.compare_and_set(key, entry, (value, now + timeout))
+
+    def _get_many_directly(self, keys, **kwargs):
+        """
+        Overriding as required by the NativeCache class.
+        """
+
+        now = self._clock()
+        values = {}
+        for key in keys:
+            value = self._read(key, now)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def _claim_directly(self, key, value):
+        """
+        Claim the renewal of a value by swapping in a new wrapper, for values
+        invalidated by the markers of their tags.
+        """
+
+        entry = self._store.get(key)
+        if entry is None or not self._is_anti_dogpiled(entry[0]) or (
+                entry[0].stamp != value.stamp):
+            return False
+
+        now = self._clock()
+        renewed = self._wrap(entry[0], soft_timeout=now + value.grace_time,
+                             stamp=now, renewing=True)
+        return self._store.compare_and_set(key, entry, (renewed, entry[1]))
+
+    def _invalidate_directly(self, keys):
+        """
+        Invalidate the values by swapping in new wrappers, and delete the ones
+        not anti-dogpiled.
+        """
+
+        for key in keys:
+            while True:
+                entry = self._store.get(key)
+                if entry is None:
+                    break
+                if not self._is_anti_dogpiled(entry[0]):
+                    self._store.delete(key)
+                    break
+                invalidated = self._wrap(entry[0], soft_timeout=0,
+                                         renewing=False)
+                if self._store.compare_and_set(key, entry,
+                                               (invalidated, entry[1])):
+                    break
+
+    def _delete_many_directly(self, keys):
+        """
+        Delete the values.
+        """
+
+        for key in keys:
+            self._store.delete(key)
+
+    def clear(self):
+        """
+        Delete all values.
+        """
+
+        self._store.clear()
+        if self._l1 is not None:
+            self._l1.clear()
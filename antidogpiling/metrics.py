@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the anti-dogpiling.
+
+With the metrics option set, the outcome of every get is counted as one of the
+following events, and the calls to the cache backend are timed (as
+"backend.<method>"):
+
+- hard_hit: A value set with hard=True (not anti-dogpiled) was found.
+- soft_hit: A value was found which has not timed out softly.
+- stale_serve: An old value was served while someone else renews it.
+- renewal_granted: The client was let through to renew a value.
+- miss: No value was found.
+
+In addition, grace_expired is counted when a value is found whose grace period
+ran out without a new value being set, before deciding who renews it.
+
+Metrics are disabled by default, in which case the cost is one attribute check
+per get. The adapters below send the metrics on to statsd or Prometheus, while
+LocalMetrics keeps them in the process, for testing and debugging.
+"""
+
+import functools
+import inspect
+import threading
+import time
+
+
+HARD_HIT = "hard_hit"
+SOFT_HIT = "soft_hit"
+STALE_SERVE = "stale_serve"
+RENEWAL_GRANTED = "renewal_granted"
+GRACE_EXPIRED = "grace_expired"
+MISS = "miss"
+
+
+class Metrics(object):
+    """
+    Base class of the metrics, discarding everything.
+    """
+
+    def incr(self, name, count=1):
+        """
+        Count an event.
+        """
+
+        pass
+
+    def timing(self, name, seconds):
+        """
+        Record the duration of a call, in seconds.
+        """
+
+        pass
+
+
+class LocalMetrics(Metrics):
+    """
+    Metrics kept in the process: counts of the events, and the number and
+    total duration of the calls, by name.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.timings = {} # Name: (Number of calls, total seconds)
+        self._lock = threading.Lock()
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def timing(self, name, seconds):
+        with self._lock:
+            calls, total = self.timings.get(name, (0, 0.0))
+            self.timings[name] = (calls + 1, total + seconds)
+
+
+class StatsdMetrics(Metrics):
+    """
+    Metrics sent to a statsd client, like the one of the statsd package. The
+    client needs incr(name, count) and timing(name, milliseconds) methods.
+    """
+
+    def __init__(self, client, prefix="antidogpiling"):
+        """
+        Set up the adapter.
+
+        :param client: The statsd client.
+        :param prefix: Prepended to the metric names, with a dot.
+        """
+
+        self.client = client
+        self.prefix = prefix
+
+    def incr(self, name, count=1):
+        self.client.incr("%s.%s" % (self.prefix, name), count)
+
+    def timing(self, name, seconds):
+        self.client.timing("%s.%s" % (self.prefix, name), seconds * 1000)
+
+
+class PrometheusMetrics(Metrics):
+    """
+    Metrics recorded by a Prometheus counter of the events, labeled "event",
+    and a histogram of the call durations, labeled "call". They are created
+    with the prometheus_client package unless given.
+    """
+
+    def __init__(self, counter=None, histogram=None,
+                 namespace="antidogpiling", registry=None):
+        """
+        Set up the adapter.
+
+        :param counter: The counter, or None to create one.
+        :param histogram: The histogram, or None to create one.
+        :param namespace: The namespace of the created metrics.
+        :param registry: The registry of the created metrics, or None for the
+                default registry.
+        """
+
+        if counter is None or histogram is None:
+            import prometheus_client
+            kwargs = {"namespace": namespace}
+            if registry is not None:
+                kwargs["registry"] = registry
+
+        if counter is None:
+            counter = prometheus_client.Counter(
+                "events", "Outcomes of the anti-dogpiled gets.", ["event"],
+                **kwargs)
+        if histogram is None:
+            histogram = prometheus_client.Histogram(
+                "call_seconds", "Durations of the cache backend calls.",
+                ["call"], **kwargs)
+
+        self.counter = counter
+        self.histogram = histogram
+
+    def incr(self, name, count=1):
+        self.counter.labels(event=name).inc(count)
+
+    def timing(self, name, seconds):
+        self.histogram.labels(call=name).observe(seconds)
+
+
+def timed(metrics, name, func):
+    """
+    Wrap a function or coroutine function, recording the duration of each
+    call with the given metrics and name.
+    """
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.timing(name, time.perf_counter() - start)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.timing(name, time.perf_counter() - start)
+
+    return wrapper
+
+
+class TimedBackend(object):
+    """
+    Proxy of a cache backend, timing the calls of the given methods as
+    "backend.<method>". Everything else is passed through.
+    """
+
+    def __init__(self, backend, metrics, methods):
+        self._backend = backend
+        self._metrics = metrics
+        self._methods = frozenset(methods)
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if name in self._methods:
+            return timed(self._metrics, "backend." + name, attr)
+        return attr
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Base of the native backends, which keep the values themselves, instead of
+wrapping a Django backend.
+
+The native backends keep the timeouts of a value apart from its payload, so
+the renewal of a value can be claimed in place, by updating its soft timeout
+in the cache atomically, without writing the value back. Exactly one client is
+granted each renewal, and the "lease" renewal mode makes no difference. The
+values are never chunked, as the native backends do not limit their size, so
+the chunk_size option makes no difference either.
+"""
+
+from antidogpiling import AntiDogpiling, Wrapper
+from antidogpiling.metrics import MISS
+
+
+class StoredWrapper(Wrapper):
+    """
+    Wrapper read from a native backend. When the renewal of the value is
+    claimed in place, the wrapper is marked as claimed, and is never written
+    back, as the cache already has the new soft timeout.
+    """
+
+    __slots__ = ("claimed",)
+
+    def __init__(self, *args, **kwargs):
+        super(StoredWrapper, self).__init__(*args, **kwargs)
+        self.claimed = False
+
+
+class NativeCache(AntiDogpiling):
+    """
+    Cache methods of the native backends, built on the direct methods.
+
+    Subclasses must implement _store_many, _add_directly, _get_many_directly,
+    _delete_many_directly, and _invalidate_directly, returning the wrapped
+    values they read as StoredWrappers. They claim the renewals in place with
+    _claim_directly, or when fetching the values, marking them as claimed.
+    """
+
+    def __init__(self, default_timeout=300, **kwargs):
+        """
+        Set up the cache. The anti-dogpiling options are given as keyword
+        arguments.
+
+        :param default_timeout: The default (soft) timeout, in seconds.
+        """
+
+        super(NativeCache, self).__init__(**kwargs)
+        self.default_timeout = default_timeout
+
+    def _split(self, key, value):
+        """
+        Overriding to never split the values into chunks.
+        """
+
+        return {}
+
+    def _store_many(self, values, timeout):
+        """
+        Put several values with the same (hard) timeout in the cache.
+        """
+
+        raise NotImplementedError()
+
+    def _invalidate_directly(self, keys):
+        """
+        Invalidate the anti-dogpiled values of the given keys softly, in
+        place, and delete the others.
+        """
+
+        raise NotImplementedError()
+
+    def _delete_many_directly(self, keys):
+        """
+        Delete the values of the given keys.
+        """
+
+        raise NotImplementedError()
+
+    def _claim_directly(self, key, value):
+        """
+        Claim the renewal of a value in place, if no one else has. This
+        default implementation refuses, for backends claiming the renewals
+        when fetching the values.
+        """
+
+        return False
+
+    def _set_directly(self, key, value, timeout, **kwargs):
+        """
+        Overriding as required by the AntiDogpiling class. Values claimed in
+        place are not written back.
+        """
+
+        self._set_many_directly({key: value}, timeout)
+
+    def _set_many_directly(self, values, timeout, **kwargs):
+        """
+        Overriding to put the values in one call. Values claimed in place are
+        not written back.
+        """
+
+        values = dict((key, value) for key, value in values.items()
+                      if not getattr(value, "claimed", False))
+        if values:
+            self._store_many(values, timeout)
+
+    def _get_directly(self, key, **kwargs):
+        """
+        Overriding to support get_or_set.
+        """
+
+        return self._get_many_directly([key]).get(key)
+
+    def _delete_directly(self, key, **kwargs):
+        """
+        Overriding to support get_or_set.
+        """
+
+        self._delete_many_directly([key])
+
+    def _claim_renewal(self, key, value, **kwargs):
+        """
+        Overriding to claim the renewal in place, unless already claimed when
+        the value was fetched.
+        """
+
+        if not value.claimed:
+            value.claimed = bool(self._claim_directly(key, value))
+        if self._metrics is not None:
+            self._count_claim(value, value.claimed)
+        return value.claimed
+
+    async def _aclaim_renewal(self, key, value, **kwargs):
+        """
+        Asynchronous _claim_renewal. This implementation blocks.
+        """
+
+        return self._claim_renewal(key, value, **kwargs)
+
+    def _update_local(self, key, value):
+        """
+        Update the process-local tier with a value just put in the cache.
+        """
+
+        if self._is_anti_dogpiled(value):
+            self._set_local(key, value)
+        else:
+            self._delete_local(key)
+
+    def add(self, key, value, timeout=None, hard=False, grace_time=None,
+            compute_time=None, tags=None):
+        """
+        Add a value, unless the key is in the cache, with anti-dogpiling
+        unless hard is True. Whether the value was added is returned.
+        """
+
+        timeout = timeout or self.default_timeout
+
+        if not hard:
+            value, timeout = self._add_anti_dogpiling(
+                value, timeout, grace_time=grace_time,
+                compute_time=compute_time, tags=tags)
+        added = self._add_directly(key, value, timeout)
+        if added and self._l1 is not None:
+            self._update_local(key, value)
+        return added
+
+    def set(self, key, value, timeout=None, hard=False, grace_time=None,
+            compute_time=None, tags=None):
+        """
+        Set a value, with anti-dogpiling unless hard is True.
+        """
+
+        self.set_many({key: value}, timeout, hard=hard, grace_time=grace_time,
+                      compute_time=compute_time, tags=tags)
+
+    def get(self, key, default=None):
+        """
+        Get a value. The client granted the renewal of a value gets the
+        default.
+        """
+
+        if self._l1 is not None:
+            value = self._get_local(key)
+            if value is not None:
+                return value
+
+        value, shared = self._get_coalesced(key)
+        if self._metrics is not None and (
+                shared or not self._is_anti_dogpiled(value)):
+            self._count_fetched(value)
+        if self._is_anti_dogpiled(value):
+            if shared:
+                value = value.value
+            else:
+                value = self._apply_anti_dogpiling(key, value)
+        if value is None:
+            return default
+        return value
+
+    def get_or_set(self, key, producer, timeout=None, grace_time=None):
+        """
+        Get a value, or produce and set it. See AntiDogpiling.get_or_set. The
+        producer may also be the value itself.
+        """
+
+        if not callable(producer):
+            producer = (lambda value: lambda: value)(producer)
+
+        timeout = timeout or self.default_timeout
+        return super(NativeCache, self).get_or_set(key, producer, timeout,
+                                                   grace_time=grace_time)
+
+    async def aget_or_set(self, key, producer, timeout=None, grace_time=None):
+        """
+        Asynchronous get_or_set. The producer may be a coroutine function, or
+        the value itself.
+        """
+
+        if not callable(producer):
+            producer = (lambda value: lambda: value)(producer)
+
+        timeout = timeout or self.default_timeout
+        return await super(NativeCache, self).aget_or_set(
+            key, producer, timeout, grace_time=grace_time)
+
+    def set_many(self, data, timeout=None, hard=False, grace_time=None,
+                 compute_time=None, tags=None):
+        """
+        Set several values, in one call.
+        """
+
+        timeout = timeout or self.default_timeout
+
+        batches = {timeout: data}
+        if not hard and data:
+            wrapped, batches = {}, {}
+            for key, value in data.items():
+                wrapped[key], hard_timeout = self._add_anti_dogpiling(
+                    value, timeout, grace_time=grace_time,
+                    compute_time=compute_time, tags=tags)
+                batches.setdefault(hard_timeout, {})[key] = wrapped[key]
+            data = wrapped
+        # One call per hard timeout, as the jitter may set the values apart
+        for timeout, batch in batches.items():
+            if batch:
+                self._store_many(batch, timeout)
+        if self._l1 is not None:
+            for key, value in data.items():
+                self._update_local(key, value)
+
+    def get_many(self, keys):
+        """
+        Get several values, in one call. Keys which are due for renewal are
+        left out of the result, just like missing keys.
+        """
+
+        keys = list(keys)
+        result = {}
+        if self._l1 is not None:
+            for key in keys:
+                value = self._get_local(key)
+                if value is not None:
+                    result[key] = value
+            keys = [key for key in keys if key not in result]
+            if not keys:
+                return result
+
+        values = self._fetch_many(keys)
+        if self._metrics is not None and len(keys) > len(values):
+            self._metrics.incr(MISS, len(keys) - len(values))
+
+        wrapped = {}
+        for key, value in values.items():
+            if self._is_anti_dogpiled(value):
+                wrapped[key] = value
+            else:
+                result[key] = value
+                if self._metrics is not None:
+                    self._count_fetched(value)
+
+        if wrapped:
+            result.update(self._apply_anti_dogpiling_many(wrapped))
+        return result
+
+    def delete(self, key, hard=False):
+        """
+        Invalidate a value softly, in place, or delete it if hard is True or
+        the value is not anti-dogpiled.
+        """
+
+        self.delete_many([key], hard=hard)
+
+    def delete_many(self, keys, hard=False):
+        """
+        Invalidate or delete several values, in one call.
+        """
+
+        keys = list(keys)
+        if not keys:
+            return
+        if hard:
+            self._delete_many_directly(keys)
+        else:
+            self._invalidate_directly(keys)
+        for key in keys:
+            self._delete_local(key)
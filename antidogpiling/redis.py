@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Anti-dogpiled cache on Redis, deciding the renewals on the server.
+
+Each value is kept in a hash, with the timeouts and the flags of the wrapper
+in fields of their own next to the payload, and the hard timeout as the expiry
+of the key. A get is one call to a Lua script, which checks the soft timeout
+and the markers of the tags, and grants the renewal of a value which has timed
+out softly by bumping its soft timeout in place, atomically (see
+antidogpiling.native). The client granted the renewal is not sent the payload,
+unless it may be served the old value by a background refresh, or shares the
+fetch with concurrent gets (the single_flight option), who are served the old
+value. Soft invalidations update the soft timeout in place as well.
+
+The client is a redis-py client (redis.Redis) without decode_responses, or
+anything with the same register_script, pipeline, set, and delete methods. The
+invalidation and chunk_size options make no difference, and the tag markers are
+looked up by the script, so Redis Cluster is only supported without tags.
+"""
+
+import pickle
+
+from antidogpiling import TAG_PREFIX, Wrapper
+from antidogpiling.native import NativeCache, StoredWrapper
+
+
+GET_SCRIPT = """
+local fields = redis.call('HMGET', KEYS[1], 'soft', 'hard', 'grace',
+                          'compute', 'stamp', 'renewing', 'flags', 'tags',
+                          'value')
+if not fields[7] then
+    return false
+end
+if not fields[1] then
+    return {0, fields}
+end
+
+local now = tonumber(ARGV[1])
+local soft = tonumber(fields[1])
+if soft >= now and fields[8] then
+    for tag in string.gmatch(fields[8], '[^%z]+') do
+        local marker = tonumber(redis.call('GET', ARGV[2] .. tag))
+        if marker and marker >= tonumber(fields[5]) then
+            soft = -1
+            break
+        end
+    end
+end
+if soft >= now then
+    return {0, fields}
+end
+
+redis.call('HSET', KEYS[1],
+           'soft', string.format('%.17g', now + tonumber(fields[3])),
+           'stamp', ARGV[1], 'renewing', 1)
+if ARGV[3] ~= '1' then
+    fields[9] = false
+end
+return {1, fields}
+"""
+"""
+Get a value, granting its renewal if it has timed out softly, or if the marker
+of one of its tags is newer than its stamp. The arguments are the current time,
+the prefix of the tag markers, and whether to send the payload to the client
+granted the renewal. The reply is whether the renewal was granted, and the
+fields of the value as they were before. Values set with hard=True only have
+the flags and the value.
+"""
+
+STORE_SCRIPT = """
+if ARGV[1] == '1' and redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+"""
+Replace a value, or add it if the first argument is 1 and the key is missing.
+The arguments are the flag, the hard timeout in seconds, and the fields and
+their values. Whether the value was stored is returned.
+"""
+
+INVALIDATE_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], 'soft') == 1 then
+    redis.call('HSET', KEYS[1], 'soft', 0, 'renewing', 0)
+    return 1
+end
+return redis.call('DEL', KEYS[1])
+"""
+"""
+Invalidate a value softly, in place, or delete it if it is not anti-dogpiled.
+"""
+
+
+class RedisCache(NativeCache):
+    """
+    Anti-dogpiled cache on Redis.
+    """
+
+    def __init__(self, client, default_timeout=300, **kwargs):
+        """
+        Set up the cache. The anti-dogpiling options are given as keyword
+        arguments.
+
+        :param client: The Redis client.
+        :param default_timeout: The default (soft) timeout, in seconds.
+        """
+
+        super(RedisCache, self).__init__(default_timeout, **kwargs)
+        self.client = client
+        self._get_script = client.register_script(GET_SCRIPT)
+        self._store_script = client.register_script(STORE_SCRIPT)
+        self._invalidate_script = client.register_script(INVALIDATE_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """
+        Make a cache with a client connecting to the given URL, like
+        "redis://localhost:6379/0", using the redis package.
+        """
+
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def _fields(self, value):
+        """
+        Get the fields of the hash of a value, as a list of names and values.
+        """
+
+        if not self._is_anti_dogpiled(value):
+            return ["flags", Wrapper.PICKLED,
+                    "value", pickle.dumps(value, pickle.HIGHEST_PROTOCOL)]
+
+        flags, data = value._pickled()
+        fields = ["soft", value.soft_timeout, "hard", value.hard_timeout,
+                  "grace", value.grace_time, "compute", value.compute_time,
+                  "stamp", value.stamp, "renewing", int(value.renewing),
+                  "flags", flags, "value", data]
+        if value.tags:
+            fields += ["tags", "\0".join(value.tags)]
+        return fields
+
+    def _read(self, reply):
+        """
+        Get the value from the reply of the get script: a StoredWrapper, the
+        value itself if not anti-dogpiled, or None if missing. Wrappers
+        granted for renewal get a soft timeout of 0, so the renewal is
+        followed by the anti-dogpiling mechanisms.
+        """
+
+        if not reply:
+            return None
+
+        granted, fields = reply
+        (soft, hard, grace, compute, stamp, renewing, flags, tags,
+         data) = fields
+        if soft is None:
+            return pickle.loads(data)
+
+        if tags:
+            tags = tags.decode("utf-8").split("\0")
+        wrapper = StoredWrapper(None, float(soft), int(hard), float(grace),
+                                float(compute), float(stamp), tags or ())
+        wrapper.renewing = renewing == b"1"
+        if granted:
+            wrapper.soft_timeout = 0
+            wrapper.claimed = True
+        if data is not None:
+            wrapper._load(int(flags), data)
+        return wrapper
+
+    def _get_args(self):
+        """
+        Get the arguments of the get script. The payload of a value granted
+        for renewal is needed to serve the old value, by a background refresh
+        or to the clients sharing the fetch.
+        """
+
+        return [repr(self._clock()), TAG_PREFIX,
+                int(self._refresh_pool is not None or self.single_flight)]
+
+    def _store(self, key, value, timeout, add=False, client=None):
+        """
+        Run the store script for a value, on the given pipeline if any.
+        """
+
+        return self._store_script(
+            keys=[key], args=[int(add), int(timeout)] + self._fields(value),
+            client=client)
+
+    def _store_many(self, values, timeout):
+        """
+        Store the values in one round-trip.
+        """
+
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            self._store(key, value, timeout, client=pipe)
+        pipe.execute()
+
+    def _add_directly(self, key, value, timeout, **kwargs):
+        """
+        Overriding to support get_or_set.
+        """
+
+        return bool(self._store(key, value, timeout, add=True))
+
+    def _get_directly(self, key, **kwargs):
+        """
+        Overriding to get the value with the get script, which decides the
+        renewal.
+        """
+
+        return self._read(self._get_script(keys=[key],
+                                           args=self._get_args()))
+
+    def _get_many_directly(self, keys, **kwargs):
+        """
+        Overriding to get the values with the get script, in one round-trip.
+        """
+
+        pipe = self.client.pipeline(transaction=False)
+        args = self._get_args()
+        for key in keys:
+            self._get_script(keys=[key], args=args, client=pipe)
+
+        values = {}
+        for key, reply in zip(keys, pipe.execute()):
+            value = self._read(reply)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def _delete_many_directly(self, keys):
+        """
+        Delete the values in one round-trip.
+        """
+
+        self.client.delete(*keys)
+
+    def _invalidate_directly(self, keys):
+        """
+        Invalidate the values with the invalidate script, in one round-trip.
+        """
+
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            self._invalidate_script(keys=[key], client=pipe)
+        pipe.execute()
+
+    def _fetch(self, key, **kwargs):
+        """
+        Overriding, as the get script applies the markers of the tags.
+        """
+
+        return self._get_directly(key, **kwargs)
+
+    def _fetch_many(self, keys, **kwargs):
+        """
+        Overriding, as the get script applies the markers of the tags.
+        """
+
+        return self._get_many_directly(keys, **kwargs)
+
+    async def _afetch(self, key, **kwargs):
+        """
+        Asynchronous _fetch.
+        """
+
+        return await self._aget_directly(key, **kwargs)
+
+    async def _afetch_many(self, keys, **kwargs):
+        """
+        Asynchronous _fetch_many.
+        """
+
+        return await self._aget_many_directly(keys, **kwargs)
+
+    def soft_invalidate_tag(self, tag):
+        """
+        Invalidate all values with the given tag softly, by writing the marker
+        of the tag, read by the get script.
+        """
+
+        self.client.set(self._tag_key(tag), repr(self._clock()),
+                        ex=self.invalidation_marker_timeout)
+        if self._l1 is not None:
+            self._l1.clear()
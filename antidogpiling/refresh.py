@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Background refreshing of values for stale-while-revalidate.
+
+A refresh pool is a bounded queue of refresh jobs, run by a fixed number of
+daemon threads. Jobs are deduplicated by key, so a value being refreshed is
+not queued again, and jobs are shed when the queue is full.
+"""
+
+import queue
+import threading
+
+
+class RefreshPool(object):
+    """
+    Pool of threads refreshing values in the background.
+    """
+
+    def __init__(self, workers, queue_size=100):
+        """
+        Set up the pool. The worker threads are started on the first job.
+
+        :param workers: The number of worker threads.
+        :param queue_size: The maximum number of jobs waiting for a worker.
+        """
+
+        self.workers = workers
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._pending = set() # Keys queued or being refreshed
+        self._threads = []
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) to refresh the value of the given key.
+        True is returned if the job was queued, or if a job for the key is
+        already queued or running. False is returned if the job was shed
+        because the queue is full.
+        """
+
+        with self._lock:
+            if key in self._pending:
+                return True
+            try:
+                self._queue.put_nowait((key, func, args, kwargs))
+            except queue.Full:
+                return False
+            self._pending.add(key)
+            if not self._threads:
+                self._start()
+        return True
+
+    def pending(self):
+        """
+        Get the number of jobs queued or running.
+        """
+
+        return len(self._pending)
+
+    def join(self):
+        """
+        Wait for all jobs queued so far to complete.
+        """
+
+        self._queue.join()
+
+    def _start(self):
+        """
+        Start the worker threads.
+        """
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name="antidogpiling-refresh-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        """
+        Run jobs, forever. Refreshes are best effort, so failures are ignored;
+        the value will be renewed by a client after the grace period.
+        """
+
+        while True:
+            key, func, args, kwargs = self._queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                self._queue.task_done()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Ketama consistent hashing of keys onto nodes.
+
+The ring is laid out like libketama lays it out: each node gets 40 MD5 hashes
+of "<node>-<index>" (scaled by its share of the total weight), each giving 4
+points on the ring, and a key goes to the node of the first point at or after
+the hash of the key. The shares are rounded to single precision, as libketama
+computes them in floats, so the nodes picked agree with other ketama clients
+given the same node names and weights, and adding or removing a node only
+moves the keys of its share of the ring.
+"""
+
+import bisect
+import hashlib
+import math
+import struct
+
+
+HASHES_PER_NODE = 40
+
+POINTS_PER_HASH = 4
+
+_POINT = struct.Struct("<I")
+
+_FLOAT = struct.Struct("<f")
+
+
+def _digest(text):
+    """
+    Get the MD5 digest of a string or bytes.
+    """
+
+    if not isinstance(text, bytes):
+        text = text.encode("utf-8")
+    return hashlib.md5(text).digest()
+
+
+def _float32(number):
+    """
+    Round a number to single precision, like a C float.
+    """
+
+    return _FLOAT.unpack(_FLOAT.pack(number))[0]
+
+
+class HashRing(object):
+    """
+    Consistent hashing ring of nodes, given by their names, like
+    "127.0.0.1:11211".
+    """
+
+    def __init__(self, nodes, weights=None):
+        """
+        Lay out the ring.
+
+        :param nodes: The names of the nodes.
+        :param weights: Dict of the weights of the nodes, 1 by default.
+        """
+
+        nodes = list(nodes)
+        weights = weights or {}
+        total = sum(weights.get(node, 1) for node in nodes)
+
+        ring = []
+        for node in nodes:
+            share = _float32(float(weights.get(node, 1)) / total)
+            for index in range(int(math.floor(_float32(
+                    share * HASHES_PER_NODE * len(nodes))))):
+                digest = _digest("%s-%d" % (node, index))
+                for point in range(POINTS_PER_HASH):
+                    ring.append((_POINT.unpack_from(digest, point * 4)[0],
+                                 node))
+        ring.sort()
+
+        self.nodes = nodes
+        self._points = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def hash(self, key):
+        """
+        Get the position of a key on the ring.
+        """
+
+        return _POINT.unpack_from(_digest(key))[0]
+
+    def get_node(self, key):
+        """
+        Get the node of a key.
+        """
+
+        if not self._points:
+            raise ValueError("No nodes in the ring")
+        index = bisect.bisect_left(self._points, self.hash(key))
+        return self._nodes[index % len(self._nodes)]
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+Anti-dogpiled cache in an SQL database, through a DB-API connection.
+
+Each value is kept in a row, with the timeouts of the wrapper in columns of
+their own next to the payload, and the hard timeout as an absolute expiry
+time. The renewal of a value which has timed out softly is claimed with one
+conditional UPDATE of its soft timeout, matching the stamp the value was read
+with, so exactly one client wins it, and the payload is never written back
+(see antidogpiling.native). Bulk gets, soft invalidations, deletes, and culls
+are single set-based statements, and so are sets, as upserts, given the vendor
+of the database.
+
+Create the table with create_table. Expired rows are only deleted by cull,
+which is run on every set with the max_entries option.
+"""
+
+import contextlib
+import pickle
+import re
+
+from antidogpiling import Wrapper, _whole_seconds
+from antidogpiling.native import NativeCache, StoredWrapper
+
+
+COLUMNS = ("cache_key", "value", "flags", "soft_timeout", "hard_timeout",
+           "grace_time", "compute_time", "stamp", "renewing", "tags",
+           "expires")
+"""
+The columns of the cache table. All but the first four are NULL for values
+set with hard=True.
+"""
+
+SCHEMA = (
+    """
+    CREATE TABLE {table} (
+        cache_key VARCHAR(255) NOT NULL PRIMARY KEY,
+        value {blob} NOT NULL,
+        flags INTEGER NOT NULL,
+        soft_timeout DOUBLE PRECISION,
+        hard_timeout INTEGER,
+        grace_time DOUBLE PRECISION,
+        compute_time DOUBLE PRECISION,
+        stamp DOUBLE PRECISION,
+        renewing INTEGER,
+        tags VARCHAR(1024),
+        expires DOUBLE PRECISION NOT NULL
+    )
+    """,
+    "CREATE INDEX {name}_soft_timeout ON {table} (soft_timeout)",
+    "CREATE INDEX {name}_expires ON {table} (expires)",
+)
+"""
+The statements creating the cache table. The indexes are named after the
+table name, with any quotes and other non-word characters replaced.
+"""
+
+PARAMSTYLES = {"qmark": "?", "format": "%s", "pyformat": "%s"}
+"""
+The placeholders of the supported DB-API parameter styles.
+"""
+
+_INSERT = "INSERT INTO {table} (%s) VALUES ({ps})" % ", ".join(COLUMNS)
+
+_ON_CONFLICT = "%s ON CONFLICT (cache_key) DO UPDATE SET %s" % (
+    _INSERT, ", ".join("%s = excluded.%s" % (column, column)
+                       for column in COLUMNS[1:]))
+
+UPSERTS = {
+    "sqlite": _ON_CONFLICT,
+    "postgresql": _ON_CONFLICT,
+    "mysql": "%s ON DUPLICATE KEY UPDATE %s" % (
+        _INSERT, ", ".join("%s = VALUES(%s)" % (column, column)
+                           for column in COLUMNS[1:])),
+}
+"""
+The statements inserting or replacing a row, by database vendor.
+"""
+
+
+class SQLCache(NativeCache):
+    """
+    Anti-dogpiled cache in an SQL database.
+    """
+
+    def __init__(self, connection, table="antidogpiling_cache",
+                 paramstyle="qmark", vendor=None, max_entries=0,
+                 default_timeout=300, **kwargs):
+        """
+        Set up the cache. The anti-dogpiling options are given as keyword
+        arguments.
+
+        :param connection: The DB-API connection, like a sqlite3 connection.
+        :param table: The name of the cache table.
+        :param paramstyle: The parameter style of the database module, like
+                "qmark" for sqlite3, or "format" for psycopg2 and MySQLdb.
+        :param vendor: The database vendor, "sqlite", "postgresql", or
+                "mysql", to set values with upserts. Otherwise, the rows are
+                deleted and inserted, and a set racing with a concurrent set
+                of the same key is dropped, as if it had come first.
+        :param max_entries: Cull the oldest values beyond this many on every
+                set. The default is 0, for no limit.
+        :param default_timeout: The default (soft) timeout, in seconds.
+        """
+
+        super(SQLCache, self).__init__(default_timeout, **kwargs)
+        self.connection = connection
+        self.table = table
+        self.max_entries = int(max_entries)
+        if paramstyle not in PARAMSTYLES:
+            raise ValueError("Unsupported parameter style: %r" %
+                             (paramstyle,))
+        self._placeholder = PARAMSTYLES[paramstyle]
+        if vendor is not None and vendor not in UPSERTS:
+            raise ValueError("Unsupported database vendor: %r" % (vendor,))
+        self._upsert = UPSERTS.get(vendor)
+
+    def _sql(self, statement, count=1):
+        """
+        Fill in the table name and the placeholders of a statement. The
+        {ps} field is filled with count comma-separated placeholders.
+        """
+
+        return statement.format(
+            table=self.table, p=self._placeholder,
+            ps=", ".join([self._placeholder] * count))
+
+    def _connection(self):
+        """
+        Get the connection to use.
+        """
+
+        return self.connection
+
+    def _integrity_error(self):
+        """
+        Get the exception raised when adding a key already in the table.
+        """
+
+        return self._connection().IntegrityError
+
+    @contextlib.contextmanager
+    def _cursor(self):
+        """
+        Run the statements of a block in a transaction, with a cursor.
+        """
+
+        connection = self._connection()
+        cursor = connection.cursor()
+        try:
+            yield cursor
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def create_table(self, blob_type="BLOB"):
+        """
+        Create the cache table, and its indexes.
+
+        :param blob_type: The column type of the payloads, like "BYTEA" for
+                PostgreSQL or "LONGBLOB" for MySQL.
+        """
+
+        name = re.sub(r"\W+", "_", self.table).strip("_")
+        with self._cursor() as cursor:
+            for statement in SCHEMA:
+                cursor.execute(statement.format(table=self.table, name=name,
+                                                blob=blob_type))
+
+    def _row(self, key, value, timeout, now):
+        """
+        Get the row of a value, in the order of COLUMNS.
+        """
+
+        expires = now + timeout
+        if not self._is_anti_dogpiled(value):
+            return (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                    Wrapper.PICKLED, None, None, None, None, None, None, None,
+                    expires)
+
+        flags, data = value._pickled()
+        return (key, data, flags, value.soft_timeout, value.hard_timeout,
+                value.grace_time, value.compute_time, value.stamp,
+                int(value.renewing), "\0".join(value.tags) or None, expires)
+
+    def _read(self, row):
+        """
+        Get the value of a row: a StoredWrapper, or the value itself if not
+        anti-dogpiled.
+        """
+
+        (data, flags, soft_timeout, hard_timeout, grace_time, compute_time,
+         stamp, renewing, tags) = row
+        if soft_timeout is None:
+            return pickle.loads(bytes(data))
+
+        wrapper = StoredWrapper(None, soft_timeout, hard_timeout, grace_time,
+                                compute_time, stamp,
+                                tags.split("\0") if tags else ())
+        wrapper.renewing = bool(renewing)
+        wrapper._load(flags, bytes(data))
+        return wrapper
+
+    def _store_many(self, values, timeout):
+        """
+        Replace the rows of the values in one transaction, with an upsert if
+        the vendor is known. Otherwise, the rows are deleted and inserted, and
+        the values are dropped if a concurrent set inserts one of the keys in
+        between.
+        """
+
+        now = self._clock()
+        keys = list(values)
+        rows = [self._row(key, value, timeout, now)
+                for key, value in values.items()]
+        if self._upsert is not None:
+            with self._cursor() as cursor:
+                cursor.executemany(self._sql(self._upsert, len(COLUMNS)),
+                                   rows)
+        else:
+            try:
+                with self._cursor() as cursor:
+                    cursor.execute(self._sql(
+                        "DELETE FROM {table} WHERE cache_key IN ({ps})",
+                        len(keys)), keys)
+                    cursor.executemany(self._sql(_INSERT, len(COLUMNS)), rows)
+            except self._integrity_error():
+                pass
+        if self.max_entries:
+            self.cull()
+
+    def _add_directly(self, key, value, timeout, **kwargs):
+        """
+        Overriding to support add and get_or_set. The primary key makes sure
+        only one client adds a value.
+        """
+
+        now = self._clock()
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                "DELETE FROM {table} WHERE cache_key = {p} AND "
+                "expires <= {p}"), (key, now))
+        try:
+            with self._cursor() as cursor:
+                cursor.execute(self._sql(_INSERT, len(COLUMNS)),
+                               self._row(key, value, timeout, now))
+        except self._integrity_error():
+            return False
+        if self.max_entries:
+            self.cull()
+        return True
+
+    def _get_many_directly(self, keys, **kwargs):
+        """
+        Overriding to get the values with one query.
+        """
+
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                "SELECT %s FROM {table} WHERE expires > {p} AND cache_key IN "
+                "({ps})" % ", ".join(COLUMNS[:-1]), len(keys)),
+                [self._clock()] + keys)
+            rows = cursor.fetchall()
+        return dict((row[0], self._read(row[1:])) for row in rows)
+
+    def _claim_directly(self, key, value):
+        """
+        Claim the renewal of a value with a conditional update of its soft
+        timeout, which only succeeds if it still has the stamp it was read
+        with. The payload is left as it is.
+        """
+
+        now = self._clock()
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                "UPDATE {table} SET soft_timeout = {p}, stamp = {p}, "
+                "renewing = 1 WHERE cache_key = {p} AND stamp = {p}"),
+                (now + value.grace_time, now, key, value.stamp))
+            return cursor.rowcount == 1
+
+    def has_key(self, key):
+        """
+        Check whether a key is in the cache, without claiming the renewal of
+        its value.
+        """
+
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                "SELECT cache_key FROM {table} WHERE cache_key = {p} AND "
+                "expires > {p}"), (key, self._clock()))
+            return cursor.fetchone() is not None
+
+    __contains__ = has_key
+
+    def incr(self, key, delta=1):
+        """
+        Increment a value set with hard=True, keeping its expiry time. The new
+        value is only written if the row still has the value read, so
+        concurrent increments are retried rather than lost. ValueError is
+        raised if the key is missing, or its value is anti-dogpiled.
+        """
+
+        while True:
+            with self._cursor() as cursor:
+                cursor.execute(self._sql(
+                    "SELECT value, soft_timeout FROM {table} WHERE "
+                    "cache_key = {p} AND expires > {p}"), (key, self._clock()))
+                row = cursor.fetchone()
+                if row is None or row[1] is not None:
+                    raise ValueError("Key %r not found, or anti-dogpiled" %
+                                     (key,))
+
+                data = bytes(row[0])
+                value = pickle.loads(data) + delta
+                cursor.execute(self._sql(
+                    "UPDATE {table} SET value = {p} WHERE cache_key = {p} AND "
+                    "value = {p}"),
+                    (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), key, data))
+                if cursor.rowcount == 1:
+                    return value
+
+    def decr(self, key, delta=1):
+        """
+        Decrement a value set with hard=True, like incr.
+        """
+
+        return self.incr(key, -delta)
+
+    def touch(self, key, timeout=None):
+        """
+        Give a value a new timeout, from now, without writing the value. An
+        anti-dogpiled value gets new soft and hard timeouts, like when set.
+        Whether the key was in the cache is returned.
+        """
+
+        timeout = timeout or self.default_timeout
+        hard_timeout = _whole_seconds(timeout * self.hard_timeout_factor)
+        now = self._clock()
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                "UPDATE {table} SET expires = {p} WHERE cache_key = {p} AND "
+                "soft_timeout IS NULL AND expires > {p}"),
+                (now + timeout, key, now))
+            touched = cursor.rowcount
+            cursor.execute(self._sql(
+                "UPDATE {table} SET soft_timeout = {p}, hard_timeout = {p}, "
+                "renewing = 0, expires = {p} WHERE cache_key = {p} AND "
+                "soft_timeout IS NOT NULL AND expires > {p}"),
+                (now + timeout, hard_timeout, now + hard_timeout, key, now))
+            return touched + cursor.rowcount == 1
+
+    def _invalidate_directly(self, keys):
+        """
+        Invalidate the values in place, and delete the ones not anti-dogpiled,
+        in one transaction.
+        """
+
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                "UPDATE {table} SET soft_timeout = 0, renewing = 0 WHERE "
+                "soft_timeout IS NOT NULL AND cache_key IN ({ps})",
+                len(keys)), keys)
+            cursor.execute(self._sql(
+                "DELETE FROM {table} WHERE soft_timeout IS NULL AND "
+                "cache_key IN ({ps})", len(keys)), keys)
+
+    def _delete_many_directly(self, keys):
+        """
+        Delete the values with one statement.
+        """
+
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                "DELETE FROM {table} WHERE cache_key IN ({ps})", len(keys)),
+                keys)
+
+    def cull(self):
+        """
+        Delete the expired values, and the values expiring first beyond
+        max_entries, if set.
+        """
+
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                "DELETE FROM {table} WHERE expires <= {p}"), (self._clock(),))
+            if not self.max_entries:
+                return
+
+            cursor.execute(self._sql("SELECT COUNT(*) FROM {table}"))
+            excess = cursor.fetchone()[0] - self.max_entries
+            if excess > 0:
+                cursor.execute(self._sql(
+                    "SELECT expires FROM {table} ORDER BY expires "
+                    "LIMIT 1 OFFSET %d" % excess))
+                cursor.execute(self._sql(
+                    "DELETE FROM {table} WHERE expires < {p}"),
+                    cursor.fetchone())
+
+    def clear(self):
+        """
+        Delete all values.
+        """
+
+        with self._cursor() as cursor:
+            cursor.execute(self._sql("DELETE FROM {table}"))
+        if self._l1 is not None:
+            self._l1.clear()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Background writing of the grace period write-backs.
+
+A write-behind queue holds the values to write back, by key, and a daemon
+thread writes them in batches: everything queued while the previous batch was
+being written is written with one bulk set per cache, timeout, and keyword
+arguments. A newer write-back of a key replaces the queued one, and queued
+write-backs are discarded before a new value of the key is set.
+"""
+
+import threading
+
+
+class WriteBehind(object):
+    """
+    Queue of write-backs, written in batches by a background thread.
+    """
+
+    def __init__(self, queue_size=1000):
+        """
+        Set up the queue. The writer thread is started on the first
+        write-back.
+
+        :param queue_size: The maximum number of write-backs waiting for the
+                writer.
+        """
+
+        self.queue_size = queue_size
+        self._cond = threading.Condition()
+        self._queued = {} # Key: (Bulk set, key, value, timeout, kwargs)
+        self._writing = frozenset() # Keys being written
+        self._thread = None
+
+    def submit(self, local_key, set_many, key, value, timeout, kwargs):
+        """
+        Queue a write-back, to be written by set_many({key: value}, timeout,
+        **kwargs) along with the other write-backs of the same batch. The
+        local key identifies the value within the process, like with the
+        process-local tier. False is returned, and nothing queued, if the
+        queue is full.
+        """
+
+        with self._cond:
+            if (local_key not in self._queued and
+                    len(self._queued) >= self.queue_size):
+                return False
+            self._queued[local_key] = (set_many, key, value, timeout, kwargs)
+            if self._thread is None:
+                self._start()
+            self._cond.notify_all()
+        return True
+
+    def discard(self, local_keys):
+        """
+        Drop the queued write-backs of the given keys, and wait for any being
+        written. Use this before writing the keys, so that an old value being
+        written back never overwrites a new one.
+        """
+
+        with self._cond:
+            if not self._queued and not self._writing:
+                return
+            for local_key in local_keys:
+                self._queued.pop(local_key, None)
+            while not self._writing.isdisjoint(local_keys):
+                self._cond.wait()
+
+    def pending(self):
+        """
+        Get the number of write-backs queued or being written.
+        """
+
+        return len(self._queued) + len(self._writing)
+
+    def join(self):
+        """
+        Wait for all write-backs queued so far to be written.
+        """
+
+        with self._cond:
+            while self._queued or self._writing:
+                self._cond.wait()
+
+    def _start(self):
+        """
+        Start the writer thread.
+        """
+
+        self._thread = threading.Thread(target=self._work,
+                                        name="antidogpiling-writeback")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self):
+        """
+        Write batches, forever. Write-backs are best effort, so failures are
+        ignored; the value will be renewed by another client.
+        """
+
+        while True:
+            with self._cond:
+                while not self._queued:
+                    self._cond.wait()
+                queued, self._queued = self._queued, {}
+                self._writing = frozenset(queued)
+
+            batches = {}
+            for set_many, key, value, timeout, kwargs in queued.values():
+                batch_key = (set_many, timeout, tuple(sorted(kwargs.items())))
+                batches.setdefault(batch_key, ({}, kwargs))[0][key] = value
+
+            for (set_many, timeout, _), (batch, kwargs) in batches.items():
+                try:
+                    set_many(batch, timeout, **kwargs)
+                except Exception:
+                    pass
+
+            with self._cond:
+                self._writing = frozenset()
+                self._cond.notify_all()
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the anti-dogpiling hot paths and stampede behavior.
+
+Run from the root of the repository (Django is required for the locmem and
+filebased backends)::
+
+    python -m benchmarks.bench
+    python -m benchmarks.bench --backends memcached --latency 0.001
+
+Three things are reported:
+
+- The latency per operation (in microseconds) of the anti-dogpiled cache
+  operations on each backend, and of the core operations (wrapping, pickling
+  of wrappers, and the attribute forwarding of the Django backends).
+- The number of bytes per cache entry, for the pickled anti-dogpiled values
+  compared to the raw values.
+- The number of regenerations per expiry event: how many out of a number of
+  concurrent clients are let through to renew a value that has timed out
+  softly, per renewal mode. The clients are spread over a number of simulated
+  processes, each with its own calls in flight.
+
+The memcached backend is an in-process stand-in, pickling values into a dict
+shared by all instances with the same location, with a simulated network
+latency per round-trip. It needs neither Django nor a Memcached server.
+"""
+
+import argparse
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+from antidogpiling import Wrapper
+from antidogpiling.django.common import Cache
+from antidogpiling.flight import FlightTable
+
+
+class MemcachedStandIn(object):
+    """
+    In-process stand-in for a Django Memcached backend. Each call costs one
+    simulated round-trip, and the round-trips and bytes sent are counted.
+    """
+
+    _stores = {}
+    _locks = {} # Location: Lock of its store, shared like the store
+    _stores_lock = threading.Lock()
+
+    def __init__(self, server, params):
+        options = params.get("OPTIONS") or {}
+        self.default_timeout = params.get("TIMEOUT", 300)
+        self.latency = float(options.get("latency", 0))
+        self.round_trips = 0
+        self.bytes_sent = 0
+        with self._stores_lock:
+            self._store = self._stores.setdefault(server, {})
+            self._lock = self._locks.setdefault(server, threading.Lock())
+
+    def _round_trip(self, data=b""):
+        self.round_trips += 1
+        self.bytes_sent += len(data)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _dump(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _load(self, key):
+        entry = self._store.get(key)
+        if entry is None or entry[0] < time.time():
+            return None
+        return pickle.loads(entry[1])
+
+    def add(self, key, value, timeout=None, version=None):
+        data = self._dump(value)
+        self._round_trip(data)
+        with self._lock:
+            if self._load(key) is not None:
+                return False
+            self._store[key] = (time.time() + (timeout or 300), data)
+            return True
+
+    def set(self, key, value, timeout=None, version=None):
+        data = self._dump(value)
+        self._round_trip(data)
+        self._store[key] = (time.time() + (timeout or 300), data)
+
+    def get(self, key, default=None, version=None):
+        self._round_trip()
+        value = self._load(key)
+        return default if value is None else value
+
+    def delete(self, key, version=None):
+        self._round_trip()
+        self._store.pop(key, None)
+
+    def get_many(self, keys, version=None):
+        self._round_trip()
+        values = {}
+        for key in keys:
+            value = self._load(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set_many(self, data, timeout=None, version=None):
+        dumped = dict((key, self._dump(value)) for key, value in data.items())
+        self._round_trip(b"".join(dumped.values()))
+        for key, value in dumped.items():
+            self._store[key] = (time.time() + (timeout or 300), value)
+        return []
+
+    def delete_many(self, keys, version=None):
+        self._round_trip()
+        for key in keys:
+            self._store.pop(key, None)
+
+
+def _configure_django():
+    """
+    Configure minimal Django settings, if not already configured.
+    """
+
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure()
+
+
+def make_cache(backend, options=None, location="bench"):
+    """
+    Make an anti-dogpiled cache of the named backend.
+    """
+
+    params = {"OPTIONS": dict(options or {})}
+
+    if backend == "memcached":
+        return Cache(MemcachedStandIn, location, params)
+
+    _configure_django()
+    if backend == "locmem":
+        from antidogpiling.django import locmem
+        return locmem.LocMemCache(location, params)
+    if backend == "filebased":
+        from antidogpiling.django import filebased
+        return filebased.FileBasedCache(location, params)
+    raise ValueError("Unknown backend: %r" % (backend,))
+
+
+def measure(func, number):
+    """
+    Get the best time per call of func, in microseconds.
+    """
+
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e6
+
+
+def bench_core(number):
+    """
+    Measure the core operations.
+    """
+
+    cache = make_cache("memcached", location="core")
+    wrapper = cache._add_anti_dogpiling("x" * 100, 300)[0]
+    data = pickle.dumps(wrapper, pickle.HIGHEST_PROTOCOL)
+    raw = pickle.dumps("x" * 100, pickle.HIGHEST_PROTOCOL)
+
+    return [
+        ("_add_anti_dogpiling",
+         measure(lambda: cache._add_anti_dogpiling("x", 300), number)),
+        ("pickle raw value",
+         measure(lambda: pickle.dumps("x" * 100, -1), number)),
+        ("pickle wrapper",
+         measure(lambda: pickle.dumps(wrapper, -1), number)),
+        ("unpickle raw value", measure(lambda: pickle.loads(raw), number)),
+        ("unpickle wrapper", measure(lambda: pickle.loads(data), number)),
+        ("backend attribute",
+         measure(lambda: cache._backend.default_timeout, number)),
+        ("Cache.__getattr__ forwarding",
+         measure(lambda: cache.default_timeout, number)),
+    ]
+
+
+def bench_backend(backend, number, options=None):
+    """
+    Measure the anti-dogpiled cache operations on a backend.
+    """
+
+    location = _location(backend)
+    cache = make_cache(backend, options, location=location)
+    keys = ["key%d" % i for i in range(100)]
+    cache.set_many(dict((key, "x" * 100) for key in keys), 300)
+    cache.set("hard", "x" * 100, 300, hard=True)
+    stale = Wrapper("x" * 100, 0, 300, 60)
+
+    def reset():
+        cache._set_directly("stale", stale, 300)
+
+    def renew():
+        reset()
+        cache.get("stale")
+
+    results = [
+        ("set", measure(lambda: cache.set("key0", "x" * 100, 300), number)),
+        ("set hard",
+         measure(lambda: cache.set("hard", "x" * 100, 300, hard=True),
+                 number)),
+        ("get", measure(lambda: cache.get("key0"), number)),
+        ("get hard", measure(lambda: cache.get("hard"), number)),
+        ("get missing", measure(lambda: cache.get("missing"), number)),
+        ("get renewal",
+         measure(renew, number) - measure(reset, number)),
+        ("get_many (100 keys)",
+         measure(lambda: cache.get_many(keys), max(number // 100, 1))),
+        ("get_or_set",
+         measure(lambda: cache.get_or_set("key0", "x", 300), number)),
+        ("delete (soft)", measure(lambda: cache.delete("key1"), number)),
+    ]
+
+    if backend == "filebased":
+        shutil.rmtree(location, ignore_errors=True)
+    return results
+
+
+def _location(backend):
+    """
+    Get a location for a backend.
+    """
+
+    if backend == "filebased":
+        return tempfile.mkdtemp(prefix="antidogpiling-bench-")
+    return "bench-%s" % backend
+
+
+def bench_bytes():
+    """
+    Measure the bytes per entry of pickled raw and wrapped values.
+    """
+
+    values = [
+        ("int", 42),
+        ("short string", "x" * 10),
+        ("dict of 10 items", dict(("key%d" % i, i) for i in range(10))),
+        ("10 KB string", "x" * 10240),
+    ]
+    cache = make_cache("memcached", location="bytes")
+
+    results = []
+    for name, value in values:
+        wrapper = cache._add_anti_dogpiling(value, 300)[0]
+        results.append((name,
+                        len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+                        len(pickle.dumps(wrapper, pickle.HIGHEST_PROTOCOL))))
+    return results
+
+
+def bench_stampede(clients, processes, events, latency, produce_time):
+    """
+    Count the regenerations per expiry event with concurrent clients spread
+    over simulated processes, for each renewal mode, with get and with
+    get_or_set.
+    """
+
+    results = []
+    for mode in ("grace", "lease", "xfetch"):
+        for method in ("get", "get_or_set"):
+            location = "stampede-%s-%s" % (mode, method)
+            options = {"renewal": mode, "latency": latency}
+            caches = [make_cache("memcached", options, location)
+                      for _ in range(clients)]
+            flights = [FlightTable() for _ in range(processes)]
+            for i, cache in enumerate(caches):
+                cache._flights = flights[i % processes]
+
+            regenerations = 0
+            for event in range(events):
+                key = "hot%d" % event
+                caches[0]._set_directly(
+                    key, Wrapper("old", time.time() - 1, 300, 60,
+                                 produce_time), 300)
+                regenerations += _stampede(caches, key, method, produce_time)
+
+            results.append((mode, method, float(regenerations) / events))
+    return results
+
+
+def _stampede(caches, key, method, produce_time):
+    """
+    Let one client per cache get a key at the same time, counting the
+    regenerations.
+    """
+
+    barrier = threading.Barrier(len(caches))
+    lock = threading.Lock()
+    regenerations = []
+
+    def produce():
+        with lock:
+            regenerations.append(1)
+        time.sleep(produce_time)
+        return "new"
+
+    def client(cache):
+        barrier.wait()
+        if method == "get":
+            if cache.get(key) is None:
+                produce()
+        else:
+            cache.get_or_set(key, produce, 300)
+
+    threads = [threading.Thread(target=client, args=(cache,))
+               for cache in caches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(regenerations)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--backends", default="locmem,filebased,memcached",
+                        help="comma separated backends to benchmark")
+    parser.add_argument("--number", type=int, default=2000,
+                        help="operations per measurement")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="simulated memcached round-trip latency (s)")
+    parser.add_argument("--clients", type=int, default=50,
+                        help="concurrent clients per expiry event")
+    parser.add_argument("--processes", type=int, default=10,
+                        help="simulated processes of the clients")
+    parser.add_argument("--events", type=int, default=5,
+                        help="expiry events per renewal mode")
+    parser.add_argument("--produce-time", type=float, default=0.01,
+                        help="time to produce a value (s)")
+    args = parser.parse_args(argv)
+
+    print("Core operations (us/op)")
+    for name, us in bench_core(args.number * 10):
+        print("  %-32s %10.2f" % (name, us))
+
+    for backend in args.backends.split(","):
+        print("\n%s backend (us/op)" % backend)
+        options = {"latency": args.latency} if backend == "memcached" else {}
+        for name, us in bench_backend(backend, args.number, options):
+            print("  %-32s %10.2f" % (name, us))
+
+    print("\nBytes per entry (raw / anti-dogpiled)")
+    for name, raw, wrapped in bench_bytes():
+        print("  %-32s %6d / %6d" % (name, raw, wrapped))
+
+    print("\nRegenerations per expiry event (%d clients in %d processes, "
+          "%.1f ms latency)" % (args.clients, args.processes,
+                                max(args.latency, 0.001) * 1000))
+    for mode, method, regenerations in bench_stampede(
+            args.clients, args.processes, args.events,
+            max(args.latency, 0.001), args.produce_time):
+        print("  %-8s %-12s %10.2f" % (mode, method, regenerations))
+
+    for location in list(MemcachedStandIn._stores):
+        del MemcachedStandIn._stores[location]
+        MemcachedStandIn._locks.pop(location, None)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,121 @@
+import asyncio
+import fcntl
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import threading
 import time
+import zlib
 
-from mock import Mock
-from unittest import TestCase
+from mock import Mock, patch
+from unittest import TestCase, skipIf
 
-from antidogpiling import Wrapper
+from antidogpiling import AntiDogpiling, Wrapper, _restore
+from antidogpiling.clock import CoarseClock, MonotonicClock
+from antidogpiling.decorators import KeyBuilder
+from antidogpiling.filebased import HEADER, FileCache
+from antidogpiling.flight import FlightTable
+from antidogpiling.lru import LRUCache
+from antidogpiling.memory import MemoryCache
+from antidogpiling.metrics import (LocalMetrics, PrometheusMetrics,
+                                   StatsdMetrics)
+from antidogpiling.redis import (GET_SCRIPT, INVALIDATE_SCRIPT, STORE_SCRIPT,
+                                 RedisCache)
+from antidogpiling.refresh import RefreshPool
+from antidogpiling.ring import HashRing
+from antidogpiling.sql import SQLCache
+from antidogpiling.writeback import WriteBehind
 from antidogpiling.django.common import Cache
 
+try:
+    import django
+except ImportError: # Only the Django backends need Django
+    django = None
+
+if django is not None:
+    from django.conf import settings
+    from django.db import connections
+    from antidogpiling.django.sql import DatabaseCache
+    from antidogpiling.django.multinode import (ConsistentHashingBackend,
+                                                MultiNodeCache)
+
+requires_django = skipIf(django is None, "Django is not installed")
+
+
+def setup_django():
+    """
+    Configure Django for the tests needing settings, once, with an in-memory
+    SQLite database.
+    """
+
+    if not settings.configured:
+        settings.configure(DATABASES={"default": {
+            "ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}})
+        django.setup()
+
+try:
+    import fakeredis
+    import lupa
+except ImportError: # Only the tests of the Redis scripts need them
+    fakeredis = None
+
+requires_lua = skipIf(fakeredis is None,
+                      "fakeredis and lupa are not installed")
+
+
+def whole_seconds():
+    """
+    Clock truncated to whole seconds, for the tests comparing timeouts with
+    int(time.time()).
+    """
+
+    return int(time.time())
+
+
+def run_coalesced(cache, func, count=4):
+    """
+    Run func in count threads while the fetches of the cache are blocked, so
+    they are coalesced with the single_flight option, and return the results.
+    """
+
+    release = threading.Event()
+    fetch = cache._fetch
+
+    def blocking_fetch(*args, **kwargs):
+        release.wait(5)
+        return fetch(*args, **kwargs)
+
+    cache._fetch = blocking_fetch
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(func()))
+               for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    while len(cache._flights) < 1:
+        time.sleep(0.001)
+    time.sleep(0.05) # Let the last clients reach the flight table
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    del cache._fetch
+    return results
+
 
 class MockBackendMixin(object):
     """
     Mocks a cache backend which is to be mixed with the Cache class.
     """
 
+    default_timeout = 300
+
     def __init__(self, *args, **kwargs):
         self._cache = Mock()
+        self._cache.set_many.return_value = [] # No keys failed
 
     def add(self, key, value, timeout=None, version=None):
-        self._cache.add(key, value, timeout, version=version)
+        return self._cache.add(key, value, timeout, version=version)
 
     def set(self, key, value, timeout=None, version=None):
         self._cache.set(key, value, timeout, version=version)
@@ -30,6 +129,36 @@ class MockBackendMixin(object):
     def delete(self, key, version=None):
         self._cache.delete(key, version=version)
 
+    def set_many(self, data, timeout=None, version=None):
+        return self._cache.set_many(data, timeout, version=version)
+
+    def get_many(self, keys, version=None):
+        return self._cache.get_many(keys, version=version)
+
+    def delete_many(self, keys, version=None):
+        self._cache.delete_many(keys, version=version)
+
+    async def aadd(self, *args, **kwargs):
+        return self.add(*args, **kwargs)
+
+    async def aset(self, *args, **kwargs):
+        self.set(*args, **kwargs)
+
+    async def aget(self, *args, **kwargs):
+        return self.get(*args, **kwargs)
+
+    async def adelete(self, *args, **kwargs):
+        self.delete(*args, **kwargs)
+
+    async def aset_many(self, *args, **kwargs):
+        return self.set_many(*args, **kwargs)
+
+    async def aget_many(self, *args, **kwargs):
+        return self.get_many(*args, **kwargs)
+
+    async def adelete_many(self, *args, **kwargs):
+        self.delete_many(*args, **kwargs)
+
 
 class CacheMixinTestCase(TestCase):
     """
@@ -37,7 +166,8 @@ class CacheMixinTestCase(TestCase):
     """
 
     def setUp(self):
-        self.cache = Cache(MockBackendMixin, None, {})
+        self.cache = Cache(MockBackendMixin, None,
+                           {"OPTIONS": {"clock": whole_seconds}})
         self.mock = self.cache._cache
 
     def test_add_soft(self):
@@ -328,3 +458,4383 @@ class CacheMixinTestCase(TestCase):
         # Check other methods
         self.assertFalse(self.mock.get.called)
         self.assertFalse(self.mock.set.called)
+
+
+class CacheManyTestCase(TestCase):
+    """
+    Tests for the bulk methods of the Cache and AntiDogpiling classes.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None,
+                           {"OPTIONS": {"clock": whole_seconds}})
+        self.mock = self.cache._cache
+
+    def test_set_many_soft(self):
+        """
+        Test setting several values with anti-dogpiling. All values should be
+        wrapped and set in one bulk call with the hard timeout.
+        """
+
+        now = int(time.time())
+        self.cache.set_many({"foo": "bar", "baz": "qux"}, timeout=2)
+
+        self.assertEquals(1, self.mock.set_many.call_count)
+        args = self.mock.set_many.call_args
+        self.assertEquals(16, args[0][1])
+        data = args[0][0]
+        self.assertEquals(set(["foo", "baz"]), set(data))
+        self.assertEquals("bar", data["foo"].value)
+        self.assertEquals("qux", data["baz"].value)
+        self.assertEquals(2, data["foo"].soft_timeout - now)
+        self.assertEquals(16, data["foo"].hard_timeout)
+
+    def test_set_many_hard(self):
+        """
+        Test setting several values without anti-dogpiling.
+        """
+
+        self.cache.set_many({"foo": "bar"}, timeout=1, hard=True, version=2)
+        self.mock.set_many.assert_called_with({"foo": "bar"}, 1, version=2)
+
+    def test_get_many(self):
+        """
+        Test getting a mix of fresh, softly timed out and non-anti-dogpiled
+        values. Fresh values should be unwrapped, the timed out value should be
+        left out and written back in one bulk set with a grace period.
+        """
+
+        now = int(time.time())
+        stale = Wrapper("old", now - 10, 1000, 60)
+        self.mock.get_many = Mock(return_value={
+            "fresh": Wrapper("new", now + 100, 1000, 60),
+            "stale": stale,
+            "raw": 42,
+        })
+
+        values = self.cache.get_many(["fresh", "stale", "raw", "missing"])
+        self.assertEquals({"fresh": "new", "raw": 42}, values)
+
+        self.assertEquals(1, self.mock.get_many.call_count)
+        self.mock.set_many.assert_called_with({"stale": stale}, 1000,
+                                              version=None)
+        self.assertEquals(60, stale.soft_timeout - now)
+        self.assertFalse(self.mock.set.called)
+
+    def test_get_many_batches_per_hard_timeout(self):
+        """
+        Test that renewals are batched into one bulk set per hard timeout.
+        """
+
+        now = int(time.time())
+        self.mock.get_many = Mock(return_value={
+            "a": Wrapper("a", now - 10, 1000, 60),
+            "b": Wrapper("b", now - 10, 1000, 60),
+            "c": Wrapper("c", now - 10, 2000, 60),
+        })
+
+        self.assertEquals({}, self.cache.get_many(["a", "b", "c"]))
+        self.assertEquals(2, self.mock.set_many.call_count)
+        calls = dict((args[0][1], set(args[0][0]))
+                     for args in self.mock.set_many.call_args_list)
+        self.assertEquals({1000: set(["a", "b"]), 2000: set(["c"])}, calls)
+
+    def test_get_many_all_fresh(self):
+        """
+        Test that getting only fresh values costs one backend call.
+        """
+
+        now = int(time.time())
+        self.mock.get_many = Mock(return_value={
+            "foo": Wrapper("bar", now + 100, 1000, 60),
+        })
+
+        self.assertEquals({"foo": "bar"}, self.cache.get_many(["foo"]))
+        self.assertFalse(self.mock.set_many.called)
+
+    def test_delete_many_soft(self):
+        """
+        Test that soft-deleting several values soft-invalidates the
+        anti-dogpiled ones in one bulk set, and deletes the rest.
+        """
+
+        now = int(time.time())
+        wrapped = Wrapper("bar", now + 100, 1000, 60)
+        self.mock.get_many = Mock(return_value={"foo": wrapped, "raw": 1})
+
+        self.cache.delete_many(["foo", "raw", "missing"])
+
+        self.mock.set_many.assert_called_with({"foo": wrapped}, 1000,
+                                              version=None)
+        self.assertEquals(0, wrapped.soft_timeout)
+        self.mock.delete_many.assert_called_with(["raw", "missing"],
+                                                 version=None)
+
+    def test_delete_many_soft_only_adp(self):
+        """
+        Test that no bulk delete is done when all values are anti-dogpiled.
+        """
+
+        now = int(time.time())
+        self.mock.get_many = Mock(return_value={
+            "foo": Wrapper("bar", now + 100, 1000, 60),
+        })
+
+        self.cache.delete_many(["foo"])
+        self.assertEquals(1, self.mock.set_many.call_count)
+        self.assertFalse(self.mock.delete_many.called)
+
+    def test_delete_many_hard(self):
+        """
+        Test that hard-deleting several values just deletes them.
+        """
+
+        self.cache.delete_many(["foo", "bar"], hard=True)
+        self.mock.delete_many.assert_called_with(["foo", "bar"], version=None)
+        self.assertFalse(self.mock.get_many.called)
+
+
+class LeaseRenewalTestCase(TestCase):
+    """
+    Tests for the "lease" renewal mode.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None,
+                           {"OPTIONS": {"renewal": "lease",
+                                        "clock": whole_seconds}})
+        self.mock = self.cache._cache
+
+    def test_options(self):
+        """
+        Test that the anti-dogpiling options are read from OPTIONS, and not
+        passed on to the backend.
+        """
+
+        params = {"OPTIONS": {"renewal": "lease", "MAX_ENTRIES": 10}}
+        backend_params = []
+
+        def Backend(param, params):
+            backend_params.append(params)
+            return MockBackendMixin()
+
+        cache = Cache(Backend, None, params)
+        self.assertEquals("lease", cache.renewal)
+        self.assertEquals({"OPTIONS": {"MAX_ENTRIES": 10}}, backend_params[0])
+        self.assertEquals({"renewal": "lease", "MAX_ENTRIES": 10},
+                          params["OPTIONS"])
+
+    def test_unknown_renewal_mode(self):
+        """
+        Test that an unknown renewal mode is refused.
+        """
+
+        self.assertRaises(ValueError, Cache, MockBackendMixin, None,
+                          {"renewal": "foo"})
+
+    def test_get_lease_granted(self):
+        """
+        Test that the client claiming the lease gets to renew the value.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now - 10, 1000, 30))
+        self.mock.add = Mock(return_value=True)
+
+        self.assertEquals(None, self.cache.get("foo"))
+        self.mock.add.assert_called_with("foo:adp-lease:%d" % (now - 10),
+                                         True, 30, version=None)
+        self.assertEquals(1, self.mock.set.call_count)
+        self.assertEquals(30, self.mock.set.call_args[0][1].soft_timeout - now)
+
+    def test_get_lease_refused(self):
+        """
+        Test that a client failing to claim the lease gets the old value, and
+        does not write anything back.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now - 10, 1000, 30))
+        self.mock.add = Mock(return_value=False)
+
+        self.assertEquals("bar", self.cache.get("foo", version=2))
+        self.mock.add.assert_called_with("foo:adp-lease:%d" % (now - 10),
+                                         True, 30, version=2)
+        self.assertFalse(self.mock.set.called)
+
+    def test_get_fresh_no_lease(self):
+        """
+        Test that no lease is claimed for a fresh value.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now + 10, 1000, 30))
+
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertFalse(self.mock.add.called)
+
+    def test_get_many_lease(self):
+        """
+        Test that bulk gets claim one lease per timed out value.
+        """
+
+        now = int(time.time())
+        self.mock.get_many = Mock(return_value={
+            "a": Wrapper("a", now - 10, 1000, 30),
+            "b": Wrapper("b", now - 10, 1000, 30),
+        })
+        self.mock.add = Mock(side_effect=lambda key, *args, **kwargs:
+                             key.startswith("a:adp-lease:"))
+
+        self.assertEquals({"b": "b"}, self.cache.get_many(["a", "b"]))
+        self.assertEquals(2, self.mock.add.call_count)
+        self.assertEquals(["a"], list(self.mock.set_many.call_args[0][0]))
+
+
+class XFetchRenewalTestCase(TestCase):
+    """
+    Tests for the "xfetch" renewal mode.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None,
+                           {"OPTIONS": {"renewal": "xfetch",
+                                        "xfetch_beta": 2}})
+        self.mock = self.cache._cache
+
+    def test_set_compute_time(self):
+        """
+        Test that the compute time is recorded in the wrapper.
+        """
+
+        self.cache.set("foo", "bar", timeout=10, compute_time=0.5)
+        self.assertEquals(0.5, self.mock.set.call_args[0][1].compute_time)
+
+    @patch("antidogpiling.random.random", Mock(return_value=0.99))
+    def test_get_renew_early(self):
+        """
+        Test that a high draw renews a value early, without a write-back.
+        (-log(0.01) * 2 * 3 seconds is far beyond the 10 seconds left.)
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now + 10, 1000, 60,
+                                                  3))
+
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertFalse(self.mock.set.called)
+
+    @patch("antidogpiling.random.random", Mock(return_value=0.5))
+    def test_get_no_early_renewal(self):
+        """
+        Test that a moderate draw does not renew early. (-log(0.5) * 2 * 3
+        seconds is below the 10 seconds left.)
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now + 10, 1000, 60,
+                                                  3))
+
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertFalse(self.mock.set.called)
+
+    @patch("antidogpiling.random.random", Mock(return_value=0.99))
+    def test_get_without_compute_time(self):
+        """
+        Test that values without a compute time are never renewed early.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now + 1, 1000, 60))
+
+        self.assertEquals("bar", self.cache.get("foo"))
+
+    def test_get_soft_timeout(self):
+        """
+        Test that a value reaching its soft timeout is renewed like in the
+        "grace" renewal mode.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now - 1, 1000, 60,
+                                                  3))
+
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals(1, self.mock.set.call_count)
+
+    @patch("antidogpiling.random.random", Mock(return_value=0.99))
+    def test_get_many_renew_early(self):
+        """
+        Test that bulk gets renew early without write-backs too.
+        """
+
+        now = int(time.time())
+        self.mock.get_many = Mock(return_value={
+            "a": Wrapper("a", now + 10, 1000, 60, 3),
+            "b": Wrapper("b", now + 10, 1000, 60),
+        })
+
+        self.assertEquals({"b": "b"}, self.cache.get_many(["a", "b"]))
+        self.assertFalse(self.mock.set_many.called)
+
+
+class GetOrSetTestCase(TestCase):
+    """
+    Tests for get_or_set.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None,
+                           {"lease_poll_interval": 0.01,
+                            "clock": whole_seconds})
+        self.mock = self.cache._cache
+        self.mock.get = Mock(return_value=None)
+        self.mock.add = Mock(return_value=True)
+
+    def test_hit(self):
+        """
+        Test that a fresh value is returned without producing anything.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now + 10, 1000, 60))
+        producer = Mock()
+
+        self.assertEquals("bar", self.cache.get_or_set("foo", producer, 10))
+        self.assertFalse(producer.called)
+        self.assertFalse(self.mock.set.called)
+
+    def test_cold_miss(self):
+        """
+        Test that a value not in the cache is produced under a lease, which
+        is released afterwards.
+        """
+
+        now = int(time.time())
+        value = self.cache.get_or_set("foo", lambda: "bar", 10, grace_time=5)
+        self.assertEquals("bar", value)
+
+        self.mock.add.assert_called_with("foo:adp-lease", True, 5,
+                                         version=None)
+        self.mock.delete.assert_called_with("foo:adp-lease", version=None)
+        args = self.mock.set.call_args
+        self.assertEquals("foo", args[0][0])
+        self.assertEquals("bar", args[0][1].value)
+        self.assertEquals(10, args[0][1].soft_timeout - now)
+        self.assertEquals(80, args[0][2])
+        self.assertTrue(args[0][1].compute_time >= 0)
+
+    def test_cold_miss_lease_taken(self):
+        """
+        Test that a client failing to claim the lease waits for the value
+        produced by the lease holder.
+        """
+
+        now = int(time.time())
+        self.mock.add = Mock(return_value=False)
+        self.mock.get = Mock(side_effect=[
+            None, None, Wrapper("bar", now + 10, 1000, 60)])
+        producer = Mock()
+
+        self.assertEquals("bar", self.cache.get_or_set("foo", producer, 10))
+        self.assertFalse(producer.called)
+        self.assertEquals(3, self.mock.get.call_count)
+
+    def test_cold_miss_lease_expired(self):
+        """
+        Test that a client failing to claim the lease produces the value
+        itself after the grace time.
+        """
+
+        self.mock.add = Mock(return_value=False)
+
+        value = self.cache.get_or_set("foo", lambda: "bar", 10,
+                                      grace_time=0.05)
+        self.assertEquals("bar", value)
+        self.assertEquals(1, self.mock.set.call_count)
+        self.assertFalse(self.mock.delete.called)
+
+    def wait_for_holder(self, holder_producer):
+        """
+        Run get_or_set in a thread holding the lease with the given producer,
+        and in another client waiting for it, on caches in the same memory.
+        Return the value of the waiting client, and how long it took.
+        """
+
+        name = self.id()
+        holder = MemoryCache(name, default_grace_time=5)
+        waiter = MemoryCache(name, default_grace_time=5,
+                             lease_poll_interval=0.01)
+        started = threading.Event()
+
+        def produce():
+            started.set()
+            time.sleep(0.2)
+            return holder_producer()
+
+        def hold():
+            try:
+                holder.get_or_set("foo", produce, 10)
+            except ValueError:
+                pass
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        started.wait(5)
+        start = time.time()
+        value = waiter.get_or_set("foo", lambda: "bar", 10)
+        elapsed = time.time() - start
+        thread.join()
+        return value, elapsed
+
+    def test_cold_miss_holder_none(self):
+        """
+        Test that a waiting client produces the value as soon as the lease is
+        released by a holder producing nothing.
+        """
+
+        value, elapsed = self.wait_for_holder(lambda: None)
+        self.assertEquals("bar", value)
+        self.assertTrue(elapsed < 2)
+
+    def test_cold_miss_holder_failure(self):
+        """
+        Test that a waiting client produces the value as soon as the lease is
+        released by a holder failing to produce it.
+        """
+
+        def fail():
+            raise ValueError()
+
+        value, elapsed = self.wait_for_holder(fail)
+        self.assertEquals("bar", value)
+        self.assertTrue(elapsed < 2)
+
+    def test_cold_miss_lease_released_async(self):
+        """
+        Test that an async waiting client produces the value as soon as the
+        lease is released without a value.
+        """
+
+        cache = MemoryCache(self.id(), default_grace_time=5,
+                            lease_poll_interval=0.01)
+        cache._add_directly("foo:adp-lease", True, 5)
+        timer = threading.Timer(0.2, cache._delete_directly,
+                                ("foo:adp-lease",))
+        timer.start()
+        start = time.time()
+        self.assertEquals("bar", asyncio.run(
+            cache.aget_or_set("foo", lambda: "bar", 10)))
+        self.assertTrue(time.time() - start < 2)
+        timer.join()
+
+    def test_renewal(self):
+        """
+        Test that the client granted the renewal produces the value without
+        a cold lease.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("old", now - 1, 1000, 60))
+
+        self.assertEquals("new", self.cache.get_or_set("foo", lambda: "new",
+                                                       10))
+        self.assertFalse(self.mock.add.called)
+        self.assertEquals(2, self.mock.set.call_count)
+        self.assertEquals("new", self.mock.set.call_args[0][1].value)
+
+    def test_plain_value(self):
+        """
+        Test that a plain value works as the producer, like in Django.
+        """
+
+        self.assertEquals("bar", self.cache.get_or_set("foo", "bar", 10))
+        self.assertEquals("bar", self.mock.set.call_args[0][1].value)
+
+    def test_none_not_cached(self):
+        """
+        Test that a producer returning None is not cached.
+        """
+
+        self.assertEquals(None, self.cache.get_or_set("foo", lambda: None, 10))
+        self.assertFalse(self.mock.set.called)
+
+    def test_producer_error(self):
+        """
+        Test that the lease is released when the producer fails.
+        """
+
+        def producer():
+            raise KeyError("foo")
+
+        self.assertRaises(KeyError, self.cache.get_or_set, "foo", producer, 10)
+        self.mock.delete.assert_called_with("foo:adp-lease", version=None)
+        self.assertEquals(0, len(self.cache._flights))
+
+    def test_coalescing(self):
+        """
+        Test that concurrent calls for the same key within the process share
+        one call to the producer.
+        """
+
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def producer():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "bar"
+
+        results = []
+
+        def client():
+            results.append(self.cache.get_or_set("foo", producer, 10))
+
+        threads = [threading.Thread(target=client) for _ in range(8)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while self.mock.get.call_count < len(threads):
+            time.sleep(0.001)
+        time.sleep(0.05) # Let the last clients reach the flight table
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEquals(1, len(calls))
+        self.assertEquals(["bar"] * 8, results)
+        self.assertEquals(1, self.mock.add.call_count)
+        self.assertEquals(1, self.mock.set.call_count)
+
+
+class SingleFlightTestCase(TestCase):
+    """
+    Tests for the single flight coalescing.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None,
+                           {"OPTIONS": {"single_flight": "true"}})
+        self.mock = self.cache._cache
+
+    def test_shared(self):
+        """
+        Test that the calls in flight are shared by the instances of the same
+        backend and parameters, like the per-thread instances in Django.
+        """
+
+        other = Cache(MockBackendMixin, None,
+                      {"OPTIONS": {"single_flight": "true"}})
+        self.assertTrue(other._flights is self.cache._flights)
+
+        other = Cache(MockBackendMixin, "elsewhere",
+                      {"OPTIONS": {"single_flight": "true"}})
+        self.assertFalse(other._flights is self.cache._flights)
+
+    def run_clients(self, func, count=8):
+        """
+        Run func in count threads while the backend get is blocked, and
+        return the results.
+        """
+
+        release = threading.Event()
+        get = self.mock.get
+
+        def blocking_get(*args, **kwargs):
+            release.wait(5)
+            return get(*args, **kwargs)
+
+        self.mock.get = Mock(side_effect=blocking_get)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func()))
+                   for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        while len(self.cache._flights) < 1:
+            time.sleep(0.001)
+        time.sleep(0.05) # Let the last clients reach the flight table
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_get_shared(self):
+        """
+        Test that concurrent gets share one backend fetch, and that only the
+        fetcher is granted the renewal of a softly timed out value.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("old", now - 1, 1000, 60))
+
+        results = self.run_clients(lambda: self.cache.get("foo"))
+
+        self.assertEquals(1, self.mock.get.call_count)
+        self.assertEquals([None] + ["old"] * 7, sorted(results, key=bool))
+        self.assertEquals(1, self.mock.set.call_count)
+        self.assertEquals(0, len(self.cache._flights))
+
+    def test_get_or_set_shared(self):
+        """
+        Test that concurrent get_or_set calls share one backend fetch and one
+        producer call.
+        """
+
+        self.mock.get = Mock(return_value=None)
+        self.mock.add = Mock(return_value=True)
+        producer = Mock(side_effect=lambda: time.sleep(0.05) or "bar")
+
+        results = self.run_clients(
+            lambda: self.cache.get_or_set("foo", producer, 10))
+
+        self.assertEquals(["bar"] * 8, results)
+        self.assertEquals(1, producer.call_count)
+
+    def test_disabled(self):
+        """
+        Test that gets are not coalesced by default.
+        """
+
+        cache = Cache(MockBackendMixin, None, {})
+        self.assertFalse(cache.single_flight)
+        cache._cache.get = Mock(return_value="bar")
+        self.assertEquals("bar", cache.get("foo"))
+        self.assertEquals(0, len(cache._flights))
+
+
+class FlightTableTestCase(TestCase):
+    """
+    Tests for the FlightTable class.
+    """
+
+    def test_do(self):
+        """
+        Test that a call not in flight is run and not shared.
+        """
+
+        table = FlightTable()
+        self.assertEquals(("bar", False), table.do("foo", lambda: "bar"))
+        self.assertEquals(0, len(table))
+
+    def test_bounded(self):
+        """
+        Test that calls are run directly when the table is full.
+        """
+
+        table = FlightTable(max_size=1)
+        inner = []
+
+        def outer():
+            inner.append(table.do("bar", lambda: len(table)))
+            return len(table)
+
+        self.assertEquals((1, False), table.do("foo", outer))
+        self.assertEquals([(1, False)], inner)
+        self.assertEquals(0, len(table))
+
+    def test_exception_shared(self):
+        """
+        Test that the exception of a call is raised to everyone sharing it.
+        """
+
+        table = FlightTable()
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise KeyError("foo")
+
+        def client(func):
+            try:
+                table.run("foo", func)
+            except KeyError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=client, args=(fail,))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=client, args=(Mock(),))
+        follower.start()
+        time.sleep(0.05)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEquals(2, len(errors))
+        self.assertTrue(errors[0] is errors[1])
+        self.assertEquals(0, len(table))
+
+
+class LocalTierTestCase(TestCase):
+    """
+    Tests for the process-local tier (L1).
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None,
+                           {"OPTIONS": {"l1_max_entries": 2}})
+        self.cache._l1.clear() # Shared with the caches of other tests
+        self.mock = self.cache._cache
+
+    def test_shared(self):
+        """
+        Test that the tier is shared by the instances of the same backend and
+        parameters, like the per-thread instances in Django.
+        """
+
+        other = Cache(MockBackendMixin, None,
+                      {"OPTIONS": {"l1_max_entries": 2}})
+        self.assertTrue(other._l1 is self.cache._l1)
+
+        other = Cache(MockBackendMixin, "elsewhere",
+                      {"OPTIONS": {"l1_max_entries": 2}})
+        self.assertFalse(other._l1 is self.cache._l1)
+
+    def test_get_local(self):
+        """
+        Test that a fresh value is served locally after the first get.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now + 10, 1000, 60))
+
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals(1, self.mock.get.call_count)
+
+        # The version is part of the local key
+        self.assertEquals("bar", self.cache.get("foo", version=2))
+        self.assertEquals(2, self.mock.get.call_count)
+
+    def test_get_local_soft_timeout(self):
+        """
+        Test that a local value is only served until its soft timeout.
+        """
+
+        now = int(time.time())
+        self.cache._l1.set(("foo",), ("old", now - 1))
+        self.mock.get = Mock(return_value=Wrapper("new", now + 10, 1000, 60))
+
+        self.assertEquals("new", self.cache.get("foo"))
+        self.assertEquals(1, self.mock.get.call_count)
+
+    def test_get_renewing_not_local(self):
+        """
+        Test that values being renewed by someone else are not kept locally.
+        """
+
+        now = int(time.time())
+        value = Wrapper("old", now + 10, 1000, 60)
+        value.renewing = True
+        self.mock.get = Mock(return_value=value)
+
+        self.assertEquals("old", self.cache.get("foo"))
+        self.assertEquals("old", self.cache.get("foo"))
+        self.assertEquals(2, self.mock.get.call_count)
+
+    def test_get_hard_not_local(self):
+        """
+        Test that non-anti-dogpiled values are not kept locally.
+        """
+
+        self.mock.get = Mock(return_value="bar")
+
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals(2, self.mock.get.call_count)
+
+    def test_set_and_delete(self):
+        """
+        Test that sets update the local tier, and deletes evict from it.
+        """
+
+        self.cache.set("foo", "bar", timeout=10)
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertFalse(self.mock.get.called)
+
+        self.mock.get = Mock(return_value=None)
+        self.cache.delete("foo")
+        self.assertEquals(None, self.cache.get("foo"))
+
+        self.cache.set("foo", "bar", timeout=10)
+        self.cache.set("foo", "baz", timeout=10, hard=True)
+        self.assertEquals(None, self.cache.get("foo"))
+
+    def test_soft_invalidation(self):
+        """
+        Test that soft invalidation evicts from the local tier.
+        """
+
+        now = int(time.time())
+        self.cache.set("foo", "bar", timeout=10)
+        self.mock.get = Mock(return_value=Wrapper("bar", now + 10, 1000, 60))
+        self.cache.delete("foo")
+        self.assertFalse(("foo",) in self.cache._l1)
+
+    def test_many(self):
+        """
+        Test that bulk gets only fetch the values missing locally.
+        """
+
+        now = int(time.time())
+        self.mock.set_many = Mock(return_value=[])
+        self.cache.set_many({"a": "a"}, timeout=10)
+        self.mock.get_many = Mock(return_value={
+            "b": Wrapper("b", now + 10, 1000, 60)})
+
+        self.assertEquals({"a": "a", "b": "b"},
+                          self.cache.get_many(["a", "b"]))
+        self.mock.get_many.assert_called_with(["b"], version=None)
+        self.assertEquals({"a": "a", "b": "b"},
+                          self.cache.get_many(["a", "b"]))
+        self.assertEquals(1, self.mock.get_many.call_count)
+
+        self.cache.delete_many(["a", "b"], hard=True)
+        self.assertEquals(0, len(self.cache._l1))
+
+    def test_get_or_set(self):
+        """
+        Test that get_or_set serves and updates the local tier.
+        """
+
+        self.mock.get = Mock(return_value=None)
+        self.mock.add = Mock(return_value=True)
+
+        self.assertEquals("bar", self.cache.get_or_set("foo", "bar", 10))
+        self.assertEquals("bar", self.cache.get_or_set("foo", "baz", 10))
+        self.assertEquals(1, self.mock.get.call_count)
+
+
+class LRUCacheTestCase(TestCase):
+    """
+    Tests for the LRUCache class.
+    """
+
+    def test_max_entries(self):
+        """
+        Test that the least recently used entry is evicted.
+        """
+
+        lru = LRUCache(2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+
+        self.assertEquals(1, lru.get("a"))
+        self.assertEquals(None, lru.get("b"))
+        self.assertEquals(3, lru.get("c"))
+
+    def test_max_bytes(self):
+        """
+        Test that entries are evicted to stay below the memory limit, and
+        that too large values are not stored.
+        """
+
+        lru = LRUCache(10, 10, len)
+        lru.set("a", "xxxx")
+        lru.set("b", "xxxx")
+        lru.set("c", "xxxx")
+        self.assertEquals(["b", "c"], [k for k in "abc" if k in lru])
+        self.assertEquals(8, lru.size)
+
+        lru.set("d", "x" * 11)
+        self.assertFalse("d" in lru)
+
+        lru.set("b", "x")
+        self.assertEquals(5, lru.size)
+        lru.delete("c")
+        self.assertEquals(1, lru.size)
+        lru.clear()
+        self.assertEquals((0, 0), (len(lru), lru.size))
+
+    def test_sizeof_required(self):
+        """
+        Test that a memory limit requires a sizeof function.
+        """
+
+        self.assertRaises(ValueError, LRUCache, 10, 10)
+
+    def test_compare_and_set(self):
+        """
+        Test that values are only swapped if the current value is the
+        expected one.
+        """
+
+        lru = LRUCache(10)
+        value = ["a"]
+        self.assertFalse(lru.compare_and_set("a", value, "b"))
+        self.assertTrue(lru.compare_and_set("a", None, value))
+        self.assertFalse(lru.compare_and_set("a", None, "b"))
+        self.assertFalse(lru.compare_and_set("a", ["a"], "b"))
+        self.assertTrue(lru.compare_and_set("a", value, "b"))
+        self.assertEquals("b", lru.get("a"))
+
+        self.assertFalse(lru.compare_and_delete("a", value))
+        self.assertTrue(lru.compare_and_delete("a", "b"))
+        self.assertFalse("a" in lru)
+
+
+class WrapperTestCase(TestCase):
+    """
+    Tests for the serialization of the Wrapper class.
+    """
+
+    # Wrapper("bar", 1234567890, 800, 60) pickled by version 1.1.3
+    OLD_PICKLES = (
+        b"ccopy_reg\n_reconstructor\np0\n(cantidogpiling\nWrapper\np1\n"
+        b"c__builtin__\nobject\np2\nNtp3\nRp4\n(dp5\nVvalue\np6\nVbar\np7\n"
+        b"sVsoft_timeout\np8\nI1234567890\nsVhard_timeout\np9\nI800\n"
+        b"sVgrace_time\np10\nI60\nsb.",
+        b"\x80\x02cantidogpiling\nWrapper\nq\x00)\x81q\x01}q\x02(X\x05\x00"
+        b"\x00\x00valueq\x03X\x03\x00\x00\x00barq\x04X\x0c\x00\x00\x00"
+        b"soft_timeoutq\x05J\xd2\x02\x96IX\x0c\x00\x00\x00hard_timeoutq\x06"
+        b"M \x03X\n\x00\x00\x00grace_timeq\x07K<ub.",
+        b"\x80\x04\x95h\x00\x00\x00\x00\x00\x00\x00\x8c\rantidogpiling\x94"
+        b"\x8c\x07Wrapper\x94\x93\x94)\x81\x94}\x94(\x8c\x05value\x94\x8c\x03"
+        b"bar\x94\x8c\x0csoft_timeout\x94J\xd2\x02\x96I\x8c\x0chard_timeout"
+        b"\x94M \x03\x8c\ngrace_time\x94K<ub.",
+    )
+
+    def assertWrapper(self, wrapper, value, soft_timeout, hard_timeout,
+                      grace_time, compute_time=0, renewing=False):
+        self.assertEquals(Wrapper, type(wrapper))
+        self.assertEquals((value, soft_timeout, hard_timeout, grace_time,
+                           compute_time, renewing),
+                          (wrapper.value, wrapper.soft_timeout,
+                           wrapper.hard_timeout, wrapper.grace_time,
+                           wrapper.compute_time, wrapper.renewing))
+
+    def test_round_trip(self):
+        """
+        Test that all the wrapper values survive pickling, with all
+        protocols.
+        """
+
+        wrapper = Wrapper({"foo": ("bar",)}, 1234567890.5, 800, 60.5, 0.25,
+                          1234567000.25)
+        wrapper.renewing = True
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(wrapper, protocol))
+            self.assertWrapper(copy, {"foo": ("bar",)}, 1234567890.5, 800,
+                               60.5, 0.25, True)
+            self.assertEquals(1234567000.25, copy.stamp)
+
+    def test_old_format(self):
+        """
+        Test that wrappers pickled by earlier versions are still unpickled.
+        """
+
+        for data in self.OLD_PICKLES:
+            self.assertWrapper(pickle.loads(data), "bar", 1234567890, 800, 60)
+
+    def test_compact(self):
+        """
+        Test that the new format is smaller than the old one, with the binary
+        protocols used by the caches.
+        """
+
+        wrapper = Wrapper("bar", 1234567890, 800, 60)
+        for protocol, data in zip((2, 4), self.OLD_PICKLES[1:]):
+            self.assertTrue(len(pickle.dumps(wrapper, protocol)) < len(data))
+        self.assertFalse(hasattr(wrapper, "__dict__"))
+
+    def test_format_version_1(self):
+        """
+        Test that wrappers pickled with the version 1 header, without a stamp,
+        are still unpickled.
+        """
+
+        header = Wrapper.OLD_HEADERS[1].pack(1, Wrapper.RENEWING, 1234567890,
+                                             800, 60, 0.5)
+
+        class OldWrapper(object):
+            def __reduce__(self):
+                return _restore, (header, "bar")
+
+        wrapper = pickle.loads(pickle.dumps(OldWrapper(), 4))
+        self.assertWrapper(wrapper, "bar", 1234567890, 800, 60, 0.5, True)
+        self.assertEquals(0, wrapper.stamp)
+
+    def test_unknown_format_version(self):
+        """
+        Test that headers of unknown format versions are refused.
+        """
+
+        data = pickle.dumps(Wrapper("bar", 1234567890, 800, 60), 4)
+        data = data.replace(b"\x02\x00A\xd2", b"\x09\x00A\xd2")
+        self.assertRaises(ValueError, pickle.loads, data)
+
+
+class AsyncCacheTestCase(TestCase):
+    """
+    Tests for the async methods of the Cache and AntiDogpiling classes.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None,
+                           {"OPTIONS": {"clock": whole_seconds}})
+        self.mock = self.cache._cache
+
+    def run_async(self, coroutine):
+        """
+        Run a coroutine, and then any write-backs left in the background.
+        """
+
+        async def run():
+            result = await coroutine
+            while self.cache._writebacks:
+                await asyncio.wait(set(self.cache._writebacks.values()))
+            return result
+
+        return asyncio.run(run())
+
+    def test_aset_and_aadd(self):
+        """
+        Test that async sets and adds wrap the values.
+        """
+
+        now = int(time.time())
+        self.run_async(self.cache.aset("foo", "bar", timeout=2))
+        args = self.mock.set.call_args
+        self.assertEquals("bar", args[0][1].value)
+        self.assertEquals(2, args[0][1].soft_timeout - now)
+        self.assertEquals(16, args[0][2])
+
+        self.mock.add = Mock(return_value=True)
+        self.assertTrue(self.run_async(self.cache.aadd("foo", "bar", 1,
+                                                       hard=True)))
+        self.mock.add.assert_called_with("foo", "bar", 1, version=None)
+
+    def test_aget(self):
+        """
+        Test that async gets unwrap fresh values, and write back softly timed
+        out values in the background.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now + 10, 1000, 60))
+        self.assertEquals("bar", self.run_async(self.cache.aget("foo")))
+
+        self.mock.get = Mock(return_value=Wrapper("bar", now - 1, 1000, 60))
+        self.assertEquals("default", self.run_async(
+            self.cache.aget("foo", default="default", version=2)))
+        args = self.mock.set.call_args
+        self.assertEquals(60, args[0][1].soft_timeout - now)
+        self.assertTrue(args[0][1].renewing)
+        self.assertEquals(2, args[1]["version"])
+
+    def test_aset_waits_for_writeback(self):
+        """
+        Test that a set never gets overwritten by a write-back still running
+        in the background.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("old", now - 1, 1000, 60))
+        aset_directly = self.cache._aset_directly
+
+        async def slow_aset_directly(*args, **kwargs):
+            await asyncio.sleep(0.05)
+            await aset_directly(*args, **kwargs)
+
+        self.cache._aset_directly = slow_aset_directly
+
+        async def client():
+            self.assertEquals(None, await self.cache.aget("foo"))
+            await self.cache.aset("foo", "new", 10)
+
+        self.run_async(client())
+        values = [args[0][1].value for args in self.mock.set.call_args_list]
+        self.assertEquals(["old", "new"], values)
+
+    def test_aget_or_set_renewal(self):
+        """
+        Test that the client granted the renewal is served the old value
+        right away, while a background task produces the new value.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("old", now - 1, 1000, 60))
+
+        async def producer():
+            await asyncio.sleep(0.01)
+            return "new"
+
+        self.assertEquals("old", self.run_async(
+            self.cache.aget_or_set("foo", producer, 10)))
+        values = [args[0][1].value for args in self.mock.set.call_args_list]
+        self.assertEquals(["old", "new"], values)
+        self.assertTrue(self.mock.set.call_args_list[0][0][1].renewing)
+        self.assertFalse(self.mock.set.call_args_list[1][0][1].renewing)
+
+    def test_aget_or_set_cold(self):
+        """
+        Test that a value not in the cache is produced under a lease.
+        """
+
+        self.mock.get = Mock(return_value=None)
+        self.mock.add = Mock(return_value=True)
+
+        async def producer():
+            return "bar"
+
+        self.assertEquals("bar", self.run_async(
+            self.cache.aget_or_set("foo", producer, 10)))
+        self.mock.add.assert_called_with("foo:adp-lease", True, 60,
+                                         version=None)
+        self.mock.delete.assert_called_with("foo:adp-lease", version=None)
+        self.assertEquals("bar", self.mock.set.call_args[0][1].value)
+
+    def test_aget_or_set_plain_value(self):
+        """
+        Test that a plain value works as the producer.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now + 10, 1000, 60))
+        self.assertEquals("bar", self.run_async(
+            self.cache.aget_or_set("foo", "baz", 10)))
+        self.assertFalse(self.mock.set.called)
+
+    def test_aget_many(self):
+        """
+        Test that async bulk gets write back renewals in the background.
+        """
+
+        now = int(time.time())
+        self.mock.get_many = Mock(return_value={
+            "fresh": Wrapper("new", now + 100, 1000, 60),
+            "stale": Wrapper("old", now - 10, 1000, 60),
+            "raw": 42,
+        })
+
+        self.assertEquals({"fresh": "new", "raw": 42}, self.run_async(
+            self.cache.aget_many(["fresh", "stale", "raw"])))
+        self.assertEquals(["stale"],
+                          list(self.mock.set_many.call_args[0][0]))
+
+    def test_adelete(self):
+        """
+        Test that async deletes soft-invalidate anti-dogpiled values, and
+        delete others.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now + 10, 1000, 60))
+        self.run_async(self.cache.adelete("foo"))
+        self.assertEquals(0, self.mock.set.call_args[0][1].soft_timeout)
+        self.assertFalse(self.mock.delete.called)
+
+        self.run_async(self.cache.adelete("foo", hard=True))
+        self.mock.delete.assert_called_with("foo", version=None)
+
+    def test_adelete_many(self):
+        """
+        Test that async bulk deletes soft-invalidate anti-dogpiled values, and
+        delete the others.
+        """
+
+        now = int(time.time())
+        self.mock.get_many = Mock(return_value={
+            "foo": Wrapper("bar", now + 10, 1000, 60)})
+        self.run_async(self.cache.adelete_many(["foo", "raw"]))
+        self.assertEquals(0, self.mock.set_many.call_args[0][0]["foo"]
+                          .soft_timeout)
+        self.mock.delete_many.assert_called_with(["raw"], version=None)
+
+
+def produce_fragment(key):
+    """
+    Producer registered by dotted path in the tests.
+    """
+
+    return "fragment %s" % key
+
+
+class StaleWhileRevalidateTestCase(TestCase):
+    """
+    Tests for the background refreshes (stale-while-revalidate).
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None, {"OPTIONS": {
+            "refresh_workers": 1,
+            "refresh_producers": {"fragment:*": "tests.produce_fragment"},
+            "clock": whole_seconds,
+        }})
+        self.cache._refresh_pool = RefreshPool(1, 1)
+        self.mock = self.cache._cache
+
+    def block_pool(self):
+        """
+        Occupy the worker and fill the queue, returning an event releasing
+        them.
+        """
+
+        release = threading.Event()
+        started = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        self.cache._refresh_pool.submit("block1", block)
+        started.wait(5)
+        self.cache._refresh_pool.submit("block2", Mock())
+        return release
+
+    def test_options(self):
+        """
+        Test the refresh options.
+        """
+
+        self.assertEquals("renew", self.cache.refresh_shedding)
+        self.assertTrue(self.cache._refresh_pool is not None)
+        self.assertEquals((produce_fragment, None, None),
+                          self.cache._find_producer("fragment:foo"))
+        self.assertEquals(None, self.cache._find_producer("foo"))
+        self.assertRaises(ValueError, Cache, MockBackendMixin, None,
+                          {"refresh_shedding": "foo"})
+        self.assertEquals(None, Cache(MockBackendMixin, None,
+                                      {})._refresh_pool)
+
+        # Shared by the instances of a cache only, as keys are deduplicated
+        params = {"OPTIONS": {"refresh_workers": 2}}
+        pool = Cache(MockBackendMixin, None, params)._refresh_pool
+        self.assertTrue(pool is Cache(MockBackendMixin, None,
+                                      params)._refresh_pool)
+        self.assertFalse(pool is Cache(MockBackendMixin, "elsewhere",
+                                       params)._refresh_pool)
+
+    def test_find_producer(self):
+        """
+        Test that exact keys win over prefixes, and longer prefixes over
+        shorter ones.
+        """
+
+        self.cache.register_producer("fragment:a*", len, 10)
+        self.cache.register_producer("fragment:ab", repr, 20, 5)
+
+        self.assertEquals((len, 10, None),
+                          self.cache._find_producer("fragment:ac"))
+        self.assertEquals((repr, 20, 5),
+                          self.cache._find_producer("fragment:ab"))
+        self.assertEquals(produce_fragment,
+                          self.cache._find_producer("fragment:b")[0])
+
+    def test_get_refresh(self):
+        """
+        Test that the client granted the renewal is served the old value,
+        while the value is refreshed in the background with the timeout of
+        the old value.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("old", now - 1, 80, 60))
+
+        self.assertEquals("old", self.cache.get("fragment:foo"))
+        self.cache._refresh_pool.join()
+
+        values = [args[0][1].value for args in self.mock.set.call_args_list]
+        self.assertEquals(["old", "fragment fragment:foo"], values)
+        self.assertEquals(10, self.mock.set.call_args[0][1].soft_timeout -
+                          now)
+
+    def test_get_refresh_timeout(self):
+        """
+        Test that the timeout of the old value is recovered below a second,
+        and without the hard timeout jitter, drawn in the middle here.
+        """
+
+        self.cache._clock = time.time
+        now = time.time()
+        self.mock.get = Mock(return_value=Wrapper("old", now - 1, 4, 60))
+        self.cache.get("fragment:foo")
+        self.cache._refresh_pool.join()
+        self.assertAlmostEqual(0.5, self.mock.set.call_args[0][1].soft_timeout
+                               - now, 1)
+
+        self.cache.hard_timeout_jitter = (0.5, True)
+        self.mock.get = Mock(return_value=Wrapper("old", now - 1, 100, 60))
+        with patch("random.uniform", lambda low, high: high / 2):
+            self.cache.get("fragment:foo")
+            self.cache._refresh_pool.join()
+        self.assertEquals(100, self.mock.set.call_args[0][2])
+        self.assertAlmostEqual(10, self.mock.set.call_args[0][1].soft_timeout
+                               - now, 1)
+
+    def test_get_unregistered(self):
+        """
+        Test that values without a producer are renewed by the client.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("old", now - 1, 80, 60))
+
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals(0, self.cache._refresh_pool.pending())
+
+    def test_get_shed_renew(self):
+        """
+        Test that the client renews the value when the refresh is shed with
+        the "renew" policy.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("old", now - 1, 80, 60))
+
+        release = self.block_pool()
+        try:
+            self.assertEquals(None, self.cache.get("fragment:foo"))
+        finally:
+            release.set()
+
+    def test_get_shed_stale(self):
+        """
+        Test that the client is served the old value when the refresh is shed
+        with the "stale" policy.
+        """
+
+        now = int(time.time())
+        self.cache.refresh_shedding = "stale"
+        self.mock.get = Mock(return_value=Wrapper("old", now - 1, 80, 60))
+
+        release = self.block_pool()
+        try:
+            self.assertEquals("old", self.cache.get("fragment:foo"))
+            self.assertEquals(1, self.mock.set.call_count)
+        finally:
+            release.set()
+
+    def test_get_many_refresh(self):
+        """
+        Test that bulk gets serve old values being refreshed.
+        """
+
+        now = int(time.time())
+        self.mock.get_many = Mock(return_value={
+            "fragment:a": Wrapper("old", now - 1, 80, 60),
+            "b": Wrapper("old", now - 1, 80, 60),
+        })
+
+        self.assertEquals({"fragment:a": "old"},
+                          self.cache.get_many(["fragment:a", "b"]))
+        self.cache._refresh_pool.join()
+        self.assertEquals("fragment fragment:a",
+                          self.mock.set.call_args[0][1].value)
+
+    def test_get_or_set_refresh(self):
+        """
+        Test that get_or_set refreshes with its own producer in the
+        background.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("old", now - 1, 80, 60))
+
+        self.assertEquals("old", self.cache.get_or_set("foo", lambda: "new",
+                                                       10))
+        self.cache._refresh_pool.join()
+        self.assertEquals("new", self.mock.set.call_args[0][1].value)
+
+
+class RefreshPoolTestCase(TestCase):
+    """
+    Tests for the RefreshPool class.
+    """
+
+    def test_dedupe_and_shed(self):
+        """
+        Test that jobs for keys already pending are deduplicated, and that
+        jobs are shed when the queue is full.
+        """
+
+        pool = RefreshPool(1, 1)
+        release = threading.Event()
+        started = threading.Event()
+        calls = []
+
+        def job(name):
+            calls.append(name)
+            started.set()
+            release.wait(5)
+
+        self.assertTrue(pool.submit("a", job, "a"))
+        started.wait(5)
+        self.assertTrue(pool.submit("a", job, "a2")) # Running
+        self.assertTrue(pool.submit("b", job, "b"))
+        self.assertTrue(pool.submit("b", job, "b2")) # Queued
+        self.assertFalse(pool.submit("c", job, "c")) # Shed
+        self.assertEquals(2, pool.pending())
+
+        release.set()
+        pool.join()
+        self.assertEquals(["a", "b"], calls)
+        self.assertEquals(0, pool.pending())
+
+    def test_failure(self):
+        """
+        Test that failing jobs do not stop the workers.
+        """
+
+        pool = RefreshPool(1)
+        calls = []
+        pool.submit("a", lambda: 1 / 0)
+        pool.submit("b", calls.append, "b")
+        pool.join()
+        self.assertEquals(["b"], calls)
+
+
+class DecoratorTestCase(TestCase):
+    """
+    Tests for the antidogpiled and antidogpiled_view decorators.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None, {})
+        self.mock = self.cache._cache
+        self.mock.get = Mock(return_value=None)
+        self.mock.add = Mock(return_value=True)
+
+    def test_antidogpiled(self):
+        """
+        Test that the decorated function is cached by its arguments.
+        """
+
+        calls = []
+
+        @self.cache.antidogpiled(timeout=10, grace_time=5, version=2)
+        def double(x, factor=2):
+            calls.append(x)
+            return x * factor
+
+        self.assertEquals(6, double(3))
+        self.assertEquals([3], calls)
+        key = double.cache_key(3)
+        self.assertTrue(key.startswith("tests.DecoratorTestCase."))
+        args = self.mock.set.call_args
+        self.assertEquals((key, 6), (args[0][0], args[0][1].value))
+        self.assertEquals(5, args[0][1].grace_time)
+        self.assertEquals(2, args[1]["version"])
+
+        self.mock.get = Mock(return_value=Wrapper(6, time.time() + 10, 80,
+                                                  5))
+        self.assertEquals(6, double(3))
+        self.assertEquals([3], calls)
+        self.mock.get.assert_called_with(key, version=2)
+
+        double.invalidate(3)
+        self.assertEquals(0, self.mock.set.call_args[0][1].soft_timeout)
+
+    def test_key_prefix(self):
+        """
+        Test that a key prefix replaces the name of the function.
+        """
+
+        @self.cache.antidogpiled(key_prefix="double")
+        def double(x):
+            return x * 2
+
+        self.assertTrue(double.cache_key(1).startswith("double:"))
+
+    def test_key_builder(self):
+        """
+        Test that keys differ by argument values and types, and are the same
+        for memoized and unhashable arguments.
+        """
+
+        build = KeyBuilder("p")
+        keys = set([build((1,), {}), build((True,), {}), build((1.0,), {}),
+                    build((2,), {}), build((), {"x": 1}), build((1,), {}),
+                    build(([1],), {})])
+        self.assertEquals(6, len(keys))
+        self.assertEquals(build((1,), {"a": 1, "b": 2}),
+                          build((1,), {"b": 2, "a": 1}))
+        self.assertEquals(build(("x", [1]), {}),
+                          KeyBuilder("p")(("x", [1]), {}))
+        self.assertEquals(build((1,), {}), KeyBuilder("p")((1,), {}))
+        self.assertTrue(all(len(key) == 34 for key in keys))
+
+        # Equal containers and floats with different reprs
+        self.assertNotEquals(build(((1,),), {}), build(((True,),), {}))
+        self.assertNotEquals(build((), {"x": (1,)}),
+                             build((), {"x": (True,)}))
+        self.assertNotEquals(build((0.0,), {}), build((-0.0,), {}))
+
+    def make_request(self, method="GET", path="/foo?bar=1"):
+        return Mock(method=method, get_host=Mock(return_value="example.com"),
+                    get_full_path=Mock(return_value=path))
+
+    @requires_django
+    def test_view(self):
+        """
+        Test that successful GET responses are rendered and cached by host
+        and path, as their content, status, and headers.
+        """
+
+        setup_django()
+        from django.template.response import SimpleTemplateResponse
+        response = SimpleTemplateResponse(Mock(render=Mock(
+            return_value="foo")), headers={"X-Foo": "bar"})
+        view = Mock(return_value=response, __name__="view",
+                    __qualname__="view", __module__="views")
+        cached_view = self.cache.antidogpiled_view(timeout=10)(view)
+
+        request = self.make_request()
+        result = cached_view(request, 1, a=2)
+        view.assert_called_with(request, 1, a=2)
+        self.assertEquals((b"foo", 200), (result.content, result.status_code))
+        key = self.mock.set.call_args[0][0]
+        self.assertTrue(key.startswith("view:views.view:"))
+        self.assertEquals((b"foo", 200, list(response.items())),
+                          self.mock.set.call_args[0][1].value)
+
+        # Another path has another key
+        cached_view(self.make_request(path="/foo?bar=2"))
+        self.assertNotEquals(key, self.mock.set.call_args[0][0])
+
+    @requires_django
+    def test_view_responses(self):
+        """
+        Test that every request gets a response of its own, so changes made
+        to one by middleware do not leak into the others.
+        """
+
+        setup_django()
+        from django.http import HttpResponse
+        self.mock.get = Mock(side_effect=lambda *args, **kwargs: (
+            self.mock.set.call_args[0][1] if self.mock.set.called
+            else None))
+        view = Mock(side_effect=lambda request: HttpResponse(
+            "foo", headers={"X-Foo": "bar"}), __name__="view",
+            __module__="views")
+        cached_view = self.cache.antidogpiled_view(timeout=10)(view)
+
+        first = cached_view(self.make_request())
+        first.set_cookie("sessionid", "secret")
+        second = cached_view(self.make_request())
+        self.assertEquals(1, view.call_count)
+        self.assertFalse(second is first)
+        self.assertEquals(b"foo", second.content)
+        self.assertEquals("bar", second["X-Foo"])
+        self.assertFalse(second.cookies)
+
+    @requires_django
+    def test_view_cookies(self):
+        """
+        Test that responses setting cookies are not cached.
+        """
+
+        setup_django()
+        from django.http import HttpResponse
+        response = HttpResponse("foo")
+        response.set_cookie("sessionid", "secret")
+        view = Mock(return_value=response, __name__="view",
+                    __module__="views")
+        cached_view = self.cache.antidogpiled_view()(view)
+
+        self.assertTrue(cached_view(self.make_request()) is response)
+        self.assertFalse(self.mock.set.called)
+
+    def test_view_uncached(self):
+        """
+        Test that POST requests, and unsuccessful and streaming responses,
+        are not cached.
+        """
+
+        response = Mock(status_code=404, streaming=False, render=None)
+        view = Mock(return_value=response, __name__="view",
+                    __module__="views")
+        cached_view = self.cache.antidogpiled_view()(view)
+
+        self.assertTrue(cached_view(self.make_request()) is response)
+        response.status_code = 200
+        response.streaming = True
+        self.assertTrue(cached_view(self.make_request()) is response)
+        response.streaming = False
+        self.assertTrue(cached_view(self.make_request("POST")) is response)
+
+        self.assertFalse(self.mock.set.called)
+        self.assertEquals(2, self.mock.get.call_count)
+
+
+class MetricsTestCase(TestCase):
+    """
+    Tests for the metrics.
+    """
+
+    def setUp(self):
+        self.metrics = LocalMetrics()
+        self.cache = Cache(MockBackendMixin, None,
+                           {"OPTIONS": {"metrics": self.metrics}})
+        self.mock = self.cache._cache
+
+    def test_disabled(self):
+        """
+        Test that metrics are disabled by default.
+        """
+
+        cache = Cache(MockBackendMixin, None, {})
+        self.assertEquals(None, cache._metrics)
+        self.assertTrue(isinstance(cache._backend, MockBackendMixin))
+
+    def test_dotted_path(self):
+        """
+        Test that the metrics may be given by the dotted path of a class.
+        """
+
+        cache = Cache(MockBackendMixin, None, {"OPTIONS": {
+            "metrics": "antidogpiling.metrics.LocalMetrics"}})
+        self.assertTrue(isinstance(cache._metrics, LocalMetrics))
+
+    def test_hits_and_misses(self):
+        """
+        Test that soft hits, hard hits, and misses are counted.
+        """
+
+        now = int(time.time())
+        self.mock.get = Mock(return_value=Wrapper("bar", now + 10, 1000, 60))
+        self.cache.get("foo")
+        self.mock.get = Mock(return_value="bar")
+        self.cache.get("foo")
+        self.mock.get = Mock(return_value=None)
+        self.cache.get("foo")
+
+        self.assertEquals({"soft_hit": 1, "hard_hit": 1, "miss": 1},
+                          self.metrics.counts)
+
+    def test_renewal_granted(self):
+        """
+        Test that a granted renewal is counted, and that a stale serve is
+        counted while the value is being renewed.
+        """
+
+        value = Wrapper("bar", int(time.time()) - 1, 1000, 60)
+        self.mock.get = Mock(return_value=value)
+
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals({"renewal_granted": 1, "stale_serve": 1},
+                          self.metrics.counts)
+
+    def test_lease_refused(self):
+        """
+        Test that a refused lease is counted as a stale serve.
+        """
+
+        cache = Cache(MockBackendMixin, None, {"OPTIONS": {
+            "metrics": self.metrics, "renewal": "lease"}})
+        cache._cache.add = Mock(return_value=False)
+        cache._cache.get = Mock(
+            return_value=Wrapper("bar", int(time.time()) - 1, 1000, 60))
+
+        self.assertEquals("bar", cache.get("foo"))
+        self.assertEquals({"stale_serve": 1}, self.metrics.counts)
+
+    def test_grace_expired(self):
+        """
+        Test that a value whose grace period ran out is counted.
+        """
+
+        value = Wrapper("bar", int(time.time()) - 1, 1000, 60)
+        value.renewing = True
+        self.mock.get = Mock(return_value=value)
+
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals({"grace_expired": 1, "renewal_granted": 1},
+                          self.metrics.counts)
+
+    def test_get_many(self):
+        """
+        Test that get_many counts each key.
+        """
+
+        now = int(time.time())
+        self.mock.get_many = Mock(return_value={
+            "a": Wrapper("bar", now + 10, 1000, 60),
+            "b": "bar"})
+
+        self.cache.get_many(["a", "b", "c"])
+        self.assertEquals({"soft_hit": 1, "hard_hit": 1, "miss": 1},
+                          self.metrics.counts)
+
+    def test_backend_timing(self):
+        """
+        Test that the calls to the backend are timed.
+        """
+
+        self.mock.get = Mock(return_value=None)
+        self.cache.set("foo", "bar")
+        self.cache.get("foo")
+        self.cache.get("foo")
+
+        self.assertEquals(1, self.metrics.timings["backend.set"][0])
+        self.assertEquals(2, self.metrics.timings["backend.get"][0])
+
+    def test_async(self):
+        """
+        Test that async gets are counted and timed.
+        """
+
+        self.mock.get = Mock(return_value=None)
+        self.assertEquals(None, asyncio.run(self.cache.aget("foo")))
+        self.assertEquals({"miss": 1}, self.metrics.counts)
+        self.assertEquals(1, self.metrics.timings["backend.aget"][0])
+
+    def test_direct_methods(self):
+        """
+        Test that the direct methods are timed outside of the Django backends,
+        without timing the default async methods twice.
+        """
+
+        class Backend(AntiDogpiling):
+            def _get_directly(self, key, **kwargs):
+                return None
+
+        cache = Backend(metrics=self.metrics)
+        cache._get_directly("foo")
+        asyncio.run(cache._aget_directly("foo"))
+
+        self.assertEquals({"backend.get": 2}, dict(
+            (name, timing[0]) for name, timing in
+            self.metrics.timings.items()))
+
+    def test_statsd(self):
+        """
+        Test the statsd adapter with a stand-in client.
+        """
+
+        client = Mock()
+        metrics = StatsdMetrics(client, prefix="cache")
+        metrics.incr("miss")
+        metrics.timing("backend.get", 0.002)
+
+        client.incr.assert_called_once_with("cache.miss", 1)
+        client.timing.assert_called_once_with("cache.backend.get", 2.0)
+
+    def test_prometheus(self):
+        """
+        Test the Prometheus adapter with a stand-in counter and histogram.
+        """
+
+        counter, histogram = Mock(), Mock()
+        metrics = PrometheusMetrics(counter, histogram)
+        metrics.incr("miss", 2)
+        metrics.timing("backend.get", 0.002)
+
+        counter.labels.assert_called_once_with(event="miss")
+        counter.labels.return_value.inc.assert_called_once_with(2)
+        histogram.labels.assert_called_once_with(call="backend.get")
+        histogram.labels.return_value.observe.assert_called_once_with(0.002)
+
+
+class ClockTestCase(TestCase):
+    """
+    Tests for sub-second timeouts and the clocks.
+    """
+
+    def setUp(self):
+        self.clock = Mock(return_value=1000.25)
+        self.cache = Cache(MockBackendMixin, None,
+                           {"OPTIONS": {"clock": self.clock}})
+        self.mock = self.cache._cache
+
+    def test_sub_second_timeout(self):
+        """
+        Test that sub-second timeouts and grace times are kept as they are,
+        while the hard timeout is rounded up to whole seconds.
+        """
+
+        self.cache.set("foo", "bar", timeout=0.5, grace_time=0.25)
+
+        args = self.mock.set.call_args[0]
+        self.assertEquals(1000.75, args[1].soft_timeout)
+        self.assertEquals(0.25, args[1].grace_time)
+        self.assertEquals(4, args[2])
+
+        self.cache.set("foo", "bar", timeout=0.1)
+        self.assertEquals(1, self.mock.set.call_args[0][2])
+
+    def test_controlled_clock(self):
+        """
+        Test that values time out softly by the clock.
+        """
+
+        self.mock.get = Mock(return_value=Wrapper("bar", 1000.5, 4, 0.25))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+        self.clock.return_value = 1000.6
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertAlmostEquals(1000.85,
+                                self.mock.set.call_args[0][1].soft_timeout)
+
+    def test_lease_timeout(self):
+        """
+        Test that the lease of a sub-second grace time lasts a whole second.
+        """
+
+        cache = Cache(MockBackendMixin, None, {"OPTIONS": {
+            "clock": self.clock, "renewal": "lease"}})
+        cache._cache.get = Mock(return_value=Wrapper("bar", 1000, 4, 0.25))
+        cache._cache.add = Mock(return_value=True)
+
+        self.assertEquals(None, cache.get("foo"))
+        self.assertEquals(1, cache._cache.add.call_args[0][2])
+
+    def test_pickle(self):
+        """
+        Test that sub-second timeouts survive pickling.
+        """
+
+        wrapper = pickle.loads(pickle.dumps(Wrapper("bar", 1000.75, 4, 0.25)))
+        self.assertEquals(1000.75, wrapper.soft_timeout)
+        self.assertEquals(0.25, wrapper.grace_time)
+
+    def test_dotted_path(self):
+        """
+        Test that a clock class may be given by its dotted path.
+        """
+
+        cache = Cache(MockBackendMixin, None, {"OPTIONS": {
+            "clock": "antidogpiling.clock.MonotonicClock"}})
+        self.assertTrue(isinstance(cache._clock, MonotonicClock))
+
+    def test_monotonic_clock(self):
+        """
+        Test that the monotonic clock starts at the system time.
+        """
+
+        self.assertTrue(abs(MonotonicClock()() - time.time()) < 0.1)
+
+    def test_coarse_clock(self):
+        """
+        Test that the coarse clock returns the time of the last tick, in the
+        ticking thread only.
+        """
+
+        clock = CoarseClock(self.clock)
+        self.assertEquals(1000.25, clock())
+
+        clock.tick()
+        self.clock.return_value = 1001
+        self.assertEquals(1000.25, clock())
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(clock()))
+        thread.start()
+        thread.join()
+        self.assertEquals([1001], results)
+
+        clock.clear()
+        self.assertEquals(1001, clock())
+
+
+class JitterTestCase(TestCase):
+    """
+    Tests for the soft and hard timeout jitter.
+    """
+
+    def make_cache(self, **options):
+        options["clock"] = lambda: 1000
+        return Cache(MockBackendMixin, None, {"OPTIONS": options})
+
+    def set(self, cache, timeout):
+        """
+        Set a value with the largest jitter drawn, and return the wrapper and
+        hard timeout.
+        """
+
+        with patch("antidogpiling.random.uniform", lambda a, b: b):
+            cache.set("foo", "bar", timeout)
+        args = cache._cache.set.call_args[0]
+        return args[1], args[2]
+
+    def test_no_jitter(self):
+        """
+        Test that there is no jitter by default.
+        """
+
+        wrapper, hard_timeout = self.set(self.make_cache(), 100)
+        self.assertEquals(1100, wrapper.soft_timeout)
+        self.assertEquals(800, hard_timeout)
+
+    def test_soft_percentage(self):
+        """
+        Test a soft timeout jitter given as a percentage.
+        """
+
+        cache = self.make_cache(soft_timeout_jitter="10%")
+        wrapper, hard_timeout = self.set(cache, 100)
+        self.assertEquals(1090, wrapper.soft_timeout)
+        self.assertEquals(800, hard_timeout)
+
+    def test_soft_seconds(self):
+        """
+        Test a soft timeout jitter given in seconds, never longer than the
+        timeout.
+        """
+
+        cache = self.make_cache(soft_timeout_jitter=5)
+        self.assertEquals(1095, self.set(cache, 100)[0].soft_timeout)
+        self.assertEquals(1000, self.set(cache, 2)[0].soft_timeout)
+
+    def test_hard(self):
+        """
+        Test that the hard timeout jitter lengthens the hard timeout.
+        """
+
+        cache = self.make_cache(hard_timeout_jitter="50%")
+        wrapper, hard_timeout = self.set(cache, 10)
+        self.assertEquals(1010, wrapper.soft_timeout)
+        self.assertEquals(120, hard_timeout)
+        self.assertEquals(120, wrapper.hard_timeout)
+
+    def test_spread(self):
+        """
+        Test that the soft timeouts of values set together are spread out.
+        """
+
+        cache = self.make_cache(soft_timeout_jitter="50%")
+        timeouts = set()
+        for i in range(20):
+            cache.set("foo", "bar", 100)
+            timeouts.add(cache._cache.set.call_args[0][1].soft_timeout)
+
+        self.assertTrue(len(timeouts) > 1)
+        self.assertTrue(min(timeouts) >= 1050)
+        self.assertTrue(max(timeouts) <= 1100)
+
+    def test_set_many(self):
+        """
+        Test that bulk sets set the values with their own hard timeouts, in
+        one call per hard timeout.
+        """
+
+        cache = self.make_cache(hard_timeout_jitter="50%")
+        draws = iter([40, 0, 40])
+        with patch("antidogpiling.random.uniform",
+                   lambda a, b: next(draws)):
+            cache.set_many({"foo": 1, "bar": 2, "baz": 3}, 10)
+
+        calls = dict((args[0][1], sorted(args[0][0]))
+                     for args in cache._cache.set_many.call_args_list)
+        self.assertEquals({120: ["baz", "foo"], 80: ["bar"]}, calls)
+
+        cache._cache.set_many.reset_mock()
+        draws = iter([40, 0])
+        with patch("antidogpiling.random.uniform",
+                   lambda a, b: next(draws)):
+            asyncio.run(cache.aset_many({"foo": 1, "bar": 2}, 10))
+        calls = dict((args[0][1], sorted(args[0][0]))
+                     for args in cache._cache.set_many.call_args_list)
+        self.assertEquals({120: ["foo"], 80: ["bar"]}, calls)
+
+    def test_set_many_native(self):
+        """
+        Test that the native backends store the values of a bulk set with
+        their own hard timeouts.
+        """
+
+        cache = MemoryCache(self.id(), hard_timeout_jitter="50%",
+                            clock=lambda: 1000)
+        draws = iter([40, 0])
+        with patch("antidogpiling.random.uniform",
+                   lambda a, b: next(draws)):
+            cache.set_many({"foo": 1, "bar": 2}, 10)
+        self.assertEquals(1120, cache._store.get("foo")[1])
+        self.assertEquals(1080, cache._store.get("bar")[1])
+
+
+class MarkerInvalidationTestCase(TestCase):
+    """
+    Tests for the "marker" invalidation mode.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None, {"OPTIONS": {
+            "invalidation": "marker", "clock": lambda: 1000.25}})
+        self.mock = self.cache._cache
+
+    def test_unknown_mode(self):
+        """
+        Test that unknown invalidation modes are refused.
+        """
+
+        self.assertRaises(ValueError, Cache, MockBackendMixin, None,
+                          {"OPTIONS": {"invalidation": "foo"}})
+
+    def test_delete(self):
+        """
+        Test that a soft delete only writes the marker, without fetching the
+        value.
+        """
+
+        self.mock.get = Mock(return_value=Wrapper("bar", 2000, 800, 60))
+        self.cache.delete("foo")
+
+        self.mock.set.assert_called_once_with("foo:adp-inv", 1000.25, 2592000,
+                                              version=None)
+        self.assertFalse(self.mock.get.called)
+        self.assertFalse(self.mock.delete.called)
+
+    def test_delete_many(self):
+        """
+        Test that a soft delete of several keys writes all markers at once.
+        """
+
+        self.mock.get_many = Mock(return_value={
+            "foo": Wrapper("bar", 2000, 800, 60),
+            "bar": Wrapper("baz", 2000, 800, 60)})
+        self.cache.delete_many(["foo", "bar"])
+
+        self.mock.set_many.assert_called_once_with(
+            {"foo:adp-inv": 1000.25, "bar:adp-inv": 1000.25}, 2592000,
+            version=None)
+        self.assertFalse(self.mock.get_many.called)
+        self.assertFalse(self.mock.delete_many.called)
+
+    def test_delete_hard_values(self):
+        """
+        Test that values set with hard=True, which are not affected by the
+        markers, are deleted by hard deletes only.
+        """
+
+        self.cache.delete("foo")
+        self.assertFalse(self.mock.delete.called)
+        self.cache.delete("foo", hard=True)
+        self.mock.delete.assert_called_once_with("foo", version=None)
+
+        self.cache.delete_many(["foo", "bar"], hard=True)
+        self.mock.delete_many.assert_called_once_with(["foo", "bar"],
+                                                      version=None)
+
+        asyncio.run(self.cache.adelete("foo", hard=True))
+        self.assertEquals(2, self.mock.delete.call_count)
+        self.assertFalse(self.mock.get.called)
+        self.assertFalse(self.mock.get_many.called)
+
+    def test_get_invalidated(self):
+        """
+        Test that a value older than its marker is renewed, and written back
+        with a new stamp.
+        """
+
+        self.mock.get_many = Mock(return_value={
+            "foo": Wrapper("bar", 2000, 800, 60, 0, 900),
+            "foo:adp-inv": 950})
+
+        self.assertEquals(None, self.cache.get("foo"))
+        self.mock.get_many.assert_called_once_with(["foo", "foo:adp-inv"],
+                                                   version=None)
+
+        value = self.mock.set.call_args[0][1]
+        self.assertEquals(1060.25, value.soft_timeout)
+        self.assertEquals(1000.25, value.stamp)
+        self.assertTrue(value.renewing)
+
+    def test_get_newer_than_marker(self):
+        """
+        Test that a value newer than its marker is served, including a value
+        being renewed after the invalidation.
+        """
+
+        value = Wrapper("bar", 2000, 800, 60, 0, 990)
+        self.mock.get_many = Mock(return_value={"foo": value,
+                                                "foo:adp-inv": 950})
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertFalse(self.mock.set.called)
+
+    def test_get_many(self):
+        """
+        Test that get_many fetches the markers along with the values.
+        """
+
+        self.mock.get_many = Mock(return_value={
+            "a": Wrapper("old", 2000, 800, 60, 0, 900),
+            "b": Wrapper("new", 2000, 800, 60, 0, 990),
+            "a:adp-inv": 950, "b:adp-inv": 950})
+
+        self.assertEquals({"b": "new"}, self.cache.get_many(["a", "b", "c"]))
+        self.mock.get_many.assert_called_once_with(
+            ["a", "b", "c", "a:adp-inv", "b:adp-inv", "c:adp-inv"],
+            version=None)
+
+    def test_async(self):
+        """
+        Test the async soft delete and get.
+        """
+
+        self.mock.get = Mock(return_value=Wrapper("bar", 2000, 800, 60))
+        asyncio.run(self.cache.adelete("foo"))
+        self.mock.set.assert_called_once_with("foo:adp-inv", 1000.25, 2592000,
+                                              version=None)
+        self.assertFalse(self.mock.get.called)
+
+        self.mock.get_many = Mock(return_value={
+            "foo": Wrapper("bar", 2000, 800, 60, 0, 990),
+            "foo:adp-inv": 950})
+        self.assertEquals("bar", asyncio.run(self.cache.aget("foo")))
+
+
+class TagTestCase(TestCase):
+    """
+    Tests for the tags and soft_invalidate_tag.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None,
+                           {"OPTIONS": {"clock": lambda: 1000.25}})
+        self.mock = self.cache._cache
+
+    def test_set_tags(self):
+        """
+        Test that the tags are kept in the wrapper, and survive pickling.
+        """
+
+        self.cache.set("foo", "bar", 10, tags=["product:1", "fragments"])
+
+        value = self.mock.set.call_args[0][1]
+        self.assertEquals(("product:1", "fragments"), value.tags)
+        self.assertEquals(1000.25, value.stamp)
+        self.assertEquals(("product:1", "fragments"),
+                          pickle.loads(pickle.dumps(value)).tags)
+        self.assertEquals((), pickle.loads(pickle.dumps(
+            Wrapper("bar", 1000, 800, 60))).tags)
+
+    def test_soft_invalidate_tag(self):
+        """
+        Test that invalidating a tag writes its marker only.
+        """
+
+        self.cache.soft_invalidate_tag("product:1")
+
+        self.mock.set.assert_called_once_with("adp-tag:product:1", 1000.25,
+                                              2592000, version=None)
+        self.assertFalse(self.mock.get.called)
+
+    def test_get_invalidated(self):
+        """
+        Test that a value older than the marker of one of its tags is
+        renewed.
+        """
+
+        self.mock.get = Mock(return_value=Wrapper(
+            "bar", 2000, 800, 60, 0, 900, ("a", "b")))
+        self.mock.get_many = Mock(return_value={"adp-tag:b": 950})
+
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals(["adp-tag:a", "adp-tag:b"],
+                          sorted(self.mock.get_many.call_args[0][0]))
+        self.assertEquals(1000.25, self.mock.set.call_args[0][1].stamp)
+
+    def test_get_newer_than_tags(self):
+        """
+        Test that a value newer than the markers of its tags is served, and
+        that untagged values cost no extra round-trip.
+        """
+
+        self.mock.get = Mock(return_value=Wrapper(
+            "bar", 2000, 800, 60, 0, 990, ("a",)))
+        self.mock.get_many = Mock(return_value={"adp-tag:a": 950})
+        self.assertEquals("bar", self.cache.get("foo"))
+
+        self.mock.get_many.reset_mock()
+        self.mock.get = Mock(return_value=Wrapper("bar", 2000, 800, 60))
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertFalse(self.mock.get_many.called)
+
+    def test_get_many(self):
+        """
+        Test that get_many fetches the markers of all tags at once.
+        """
+
+        values = {"a": Wrapper("old", 2000, 800, 60, 0, 900, ("x",)),
+                  "b": Wrapper("new", 2000, 800, 60, 0, 900, ("y",))}
+        self.mock.get_many = Mock(side_effect=[values, {"adp-tag:x": 950}])
+
+        self.assertEquals({"b": "new"}, self.cache.get_many(["a", "b"]))
+        self.assertEquals(2, self.mock.get_many.call_count)
+        self.assertEquals(["adp-tag:x", "adp-tag:y"],
+                          sorted(self.mock.get_many.call_args[0][0]))
+
+    def test_local_tier_cleared(self):
+        """
+        Test that invalidating a tag clears the process-local tier.
+        """
+
+        cache = Cache(MockBackendMixin, None, {"OPTIONS": {
+            "l1_max_entries": 10, "clock": lambda: 1000.25}})
+        cache.set("foo", "bar", 10, tags=["a"])
+        self.assertEquals(1, len(cache._l1))
+
+        cache.soft_invalidate_tag("a")
+        self.assertEquals(0, len(cache._l1))
+
+    def test_async(self):
+        """
+        Test the async tag invalidation and get.
+        """
+
+        asyncio.run(self.cache.asoft_invalidate_tag("a"))
+        self.mock.set.assert_called_once_with("adp-tag:a", 1000.25, 2592000,
+                                              version=None)
+
+        self.mock.get = Mock(return_value=Wrapper(
+            "bar", 2000, 800, 60, 0, 900, ("a",)))
+        self.mock.get_many = Mock(return_value={"adp-tag:a": 950})
+        self.assertEquals(None, asyncio.run(self.cache.aget("foo")))
+
+
+class CompressionTestCase(TestCase):
+    """
+    Tests for the compression of the wrapped values.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None, {"OPTIONS": {
+            "compress_threshold": 1000, "clock": lambda: 1000}})
+        self.mock = self.cache._cache
+
+    def wrap(self, value):
+        """
+        Wrap a value like the cache does.
+        """
+
+        self.cache.set("foo", value, 10)
+        return self.mock.set.call_args[0][1]
+
+    def test_disabled(self):
+        """
+        Test that the compression is disabled by default.
+        """
+
+        cache = Cache(MockBackendMixin, None, {})
+        cache.set("foo", "bar")
+        self.assertEquals(None, cache._cache.set.call_args[0][1].compression)
+
+    def test_unknown_codec(self):
+        """
+        Test that unknown codecs are refused.
+        """
+
+        self.assertRaises(ValueError, Cache, MockBackendMixin, None,
+                          {"OPTIONS": {"compress_codec": "foo"}})
+
+    def test_small(self):
+        """
+        Test that values below the threshold are not compressed.
+        """
+
+        data = pickle.dumps(self.wrap("bar"))
+        self.assertEquals("bar", pickle.loads(data).value)
+        self.assertFalse(b"x\x9c" in data)
+
+    def test_large(self):
+        """
+        Test that values above the threshold are compressed, and only
+        decompressed when used.
+        """
+
+        value = "foo bar " * 10000
+        data = pickle.dumps(self.wrap(value), pickle.HIGHEST_PROTOCOL)
+        self.assertTrue(len(data) < len(value) / 10)
+
+        decompress = Mock(side_effect=zlib.decompress)
+        with patch.dict("antidogpiling._DECOMPRESS", {0x04: decompress}):
+            wrapper = pickle.loads(data)
+            self.assertEquals(1010, wrapper.soft_timeout)
+            self.assertFalse(decompress.called)
+
+            self.assertEquals(value, wrapper.value)
+            self.assertEquals(value, wrapper.value)
+            self.assertEquals(1, decompress.call_count)
+
+    def test_repickle(self):
+        """
+        Test that a wrapper is pickled again without decoding its payload,
+        like by the renewal write-back.
+        """
+
+        data = pickle.dumps(self.wrap("foo bar " * 10000))
+        wrapper = pickle.loads(data)
+        wrapper.renewing = True
+
+        with patch("antidogpiling.zlib.compress") as compress:
+            copy = pickle.loads(pickle.dumps(wrapper))
+        self.assertFalse(compress.called)
+        self.assertTrue(copy.renewing)
+        self.assertEquals("foo bar " * 10000, copy.value)
+
+        wrapper.value = "bar"
+        self.assertEquals("bar", pickle.loads(pickle.dumps(wrapper)).value)
+
+    def test_renewal_not_decoded(self):
+        """
+        Test that the client granted the renewal of a value does not pay for
+        decoding it.
+        """
+
+        wrapper = pickle.loads(pickle.dumps(self.wrap("foo bar " * 10000)))
+        wrapper.soft_timeout = 0
+        self.mock.get = Mock(return_value=wrapper)
+
+        with patch.dict("antidogpiling._DECOMPRESS", {0x04: Mock()}) as codecs:
+            self.assertEquals(None, self.cache.get("foo"))
+            self.assertFalse(codecs[0x04].called)
+
+    def test_lzma(self):
+        """
+        Test the lzma codec.
+        """
+
+        cache = Cache(MockBackendMixin, None, {"OPTIONS": {
+            "compress_threshold": 1000, "compress_codec": "lzma"}})
+        cache.set("foo", "foo bar " * 10000)
+        data = pickle.dumps(cache._cache.set.call_args[0][1])
+
+        self.assertTrue(len(data) < 10000)
+        self.assertEquals("foo bar " * 10000, pickle.loads(data).value)
+
+
+class Unpickled(object):
+    """
+    Value counting how many times it is unpickled.
+    """
+
+    count = 0
+
+    def __setstate__(self, state):
+        Unpickled.count += 1
+        self.__dict__.update(state)
+
+
+class LazyDecodingTestCase(TestCase):
+    """
+    Tests for the lazy decoding of the wrapped values.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None,
+                           {"OPTIONS": {"clock": lambda: 1000}})
+        self.mock = self.cache._cache
+        Unpickled.count = 0
+
+    def fetched(self, soft_timeout):
+        """
+        Get a wrapper as fetched from the cache, with the given soft timeout.
+        """
+
+        value = Unpickled()
+        value.foo = "bar"
+        self.cache.set("foo", value, 10)
+        wrapper = self.mock.set.call_args[0][1]
+        wrapper.soft_timeout = soft_timeout
+        self.mock.set.reset_mock()
+        return pickle.loads(pickle.dumps(wrapper))
+
+    def test_decoded_when_used(self):
+        """
+        Test that the value is decoded when first used, and only once.
+        """
+
+        wrapper = self.fetched(1010)
+        self.assertEquals(0, Unpickled.count)
+
+        self.mock.get = Mock(return_value=wrapper)
+        self.assertEquals("bar", self.cache.get("foo").foo)
+        self.assertEquals("bar", self.cache.get("foo").foo)
+        self.assertEquals(1, Unpickled.count)
+
+    def test_renewal(self):
+        """
+        Test that the client granted the renewal of a value does not decode
+        it, neither does the write-back.
+        """
+
+        self.mock.get = Mock(return_value=self.fetched(900))
+
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals(1060, pickle.loads(pickle.dumps(
+            self.mock.set.call_args[0][1])).soft_timeout)
+        self.assertEquals(0, Unpickled.count)
+
+    def test_soft_invalidation(self):
+        """
+        Test that a soft invalidation does not decode the value.
+        """
+
+        self.mock.get = Mock(return_value=self.fetched(1010))
+
+        self.cache.delete("foo")
+        wrapper = pickle.loads(pickle.dumps(self.mock.set.call_args[0][1]))
+        self.assertEquals(0, wrapper.soft_timeout)
+        self.assertEquals(0, Unpickled.count)
+        self.assertEquals("bar", wrapper.value.foo)
+
+    def test_inline(self):
+        """
+        Test that simple values are pickled inline, and None is recognized
+        without decoding.
+        """
+
+        for value in (None, True, 42, 4.2, "bar", b"bar"):
+            wrapper = pickle.loads(pickle.dumps(Wrapper(value, 0, 0, 0)))
+            self.assertEquals(value, wrapper.value)
+            self.assertEquals(None, wrapper._payload)
+
+        self.assertTrue(Wrapper(None, 0, 0, 0).empty)
+        self.assertFalse(self.fetched(1010).empty)
+        self.assertEquals(0, Unpickled.count)
+
+
+class ChunkingTestCase(TestCase):
+    """
+    Tests for the chunking of large wrapped values.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None, {"OPTIONS": {
+            "chunk_size": 100, "clock": lambda: 1000}})
+        self.mock = self.cache._cache
+
+        # Keep the values in a dict, pickled like by a real backend
+        self.store = {}
+        self.mock.set.side_effect = self.store_one
+        self.mock.set_many.side_effect = self.store_many
+        self.mock.get.side_effect = lambda key, version: self.load(key)
+        self.mock.get_many.side_effect = lambda keys, version: dict(
+            (key, self.load(key)) for key in keys if key in self.store)
+
+    def store_one(self, key, value, timeout, version):
+        self.store[key] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def store_many(self, data, timeout, version):
+        for key, value in data.items():
+            self.store_one(key, value, timeout, version)
+        return []
+
+    def load(self, key):
+        if key in self.store:
+            return pickle.loads(self.store[key])
+
+    def test_disabled(self):
+        """
+        Test that the chunking is disabled by default.
+        """
+
+        cache = Cache(MockBackendMixin, None, {})
+        cache.set("foo", "bar " * 1000)
+        self.assertTrue(cache._cache.set.called)
+        self.assertFalse(cache._cache.set_many.called)
+
+    def test_small(self):
+        """
+        Test that values up to the chunk size are not chunked.
+        """
+
+        self.cache.set("foo", "b" * 100, 10)
+        self.assertEquals(["foo"], list(self.store))
+        self.assertEquals("b" * 100, self.cache.get("foo"))
+        self.assertFalse(self.mock.get_many.called)
+
+    def test_set(self):
+        """
+        Test that a large value is set along with its chunks in one write.
+        """
+
+        value = ["bar"] * 100
+        self.cache.set("foo", value, 10)
+
+        self.assertFalse(self.mock.set.called)
+        self.assertEquals(1, self.mock.set_many.call_count)
+        self.assertEquals(4, len(self.store))
+
+        wrapper = self.load("foo")
+        token, count = wrapper.chunks
+        self.assertEquals(3, count)
+        self.assertEquals(1010, wrapper.soft_timeout)
+        self.assertTrue(len(self.store["foo"]) < 100)
+        self.assertEquals(pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                          b"".join(self.load("foo:adp-chunk:%s:%d" % (
+                              token, i)) for i in range(count)))
+
+    def test_get(self):
+        """
+        Test that the chunks are fetched in one round-trip, and joined.
+        """
+
+        value = ["bar"] * 100
+        self.cache.set("foo", value, 10)
+
+        self.assertEquals(value, self.cache.get("foo"))
+        self.assertEquals(1, self.mock.get_many.call_count)
+        self.assertEquals(3, len(self.mock.get_many.call_args[0][0]))
+
+    def test_missing_chunk(self):
+        """
+        Test that a value with a chunk missing is missing.
+        """
+
+        self.cache.set("foo", "bar " * 100, 10)
+        token = self.load("foo").chunks[0]
+        del self.store["foo:adp-chunk:%s:1" % token]
+
+        self.assertEquals("baz", self.cache.get("foo", "baz"))
+        self.assertEquals({}, self.cache.get_many(["foo"]))
+
+    def test_overwritten(self):
+        """
+        Test that chunks of an older write are not used.
+        """
+
+        self.cache.set("foo", "bar " * 100, 10)
+        old = self.store.pop("foo")
+        self.store.clear()
+        self.cache.set("foo", "baz " * 100, 10)
+        self.store["foo"] = old
+
+        self.assertEquals(None, self.cache.get("foo"))
+
+    def test_renewal(self):
+        """
+        Test that the renewal write-back only writes the value with the
+        manifest, leaving the chunks in place.
+        """
+
+        self.cache.set("foo", "bar " * 100, 10)
+        wrapper = self.load("foo")
+        wrapper.soft_timeout = 900
+        self.store["foo"] = pickle.dumps(wrapper)
+        self.mock.set_many.reset_mock()
+
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals(1, self.mock.set.call_count)
+        self.assertFalse(self.mock.set_many.called)
+        self.assertTrue(len(self.store["foo"]) < 150)
+        self.assertEquals("bar " * 100, self.cache.get("foo"))
+
+    def test_get_many(self):
+        """
+        Test that the chunks of all values are fetched in one round-trip.
+        """
+
+        self.cache.set_many({"foo": "bar " * 100, "baz": "qux " * 100,
+                             "quux": "small"}, 10)
+        self.assertEquals(1, self.mock.set_many.call_count)
+        self.mock.get_many.reset_mock()
+
+        self.assertEquals({"foo": "bar " * 100, "baz": "qux " * 100,
+                           "quux": "small"},
+                          self.cache.get_many(["foo", "baz", "quux"]))
+        self.assertEquals(2, self.mock.get_many.call_count)
+
+    def test_set_many_failed(self):
+        """
+        Test that the keys of failed chunks are reported as the keys of
+        their values.
+        """
+
+        self.mock.set_many.side_effect = lambda data, timeout, version: [
+            key for key in data if key.startswith("foo:")]
+        self.assertEquals(["foo"], self.cache.set_many(
+            {"foo": "bar " * 100, "baz": "qux"}, 10))
+
+    def test_add(self):
+        """
+        Test that the chunks are only set once the value is added, and that
+        the value is deleted again if they fail.
+        """
+
+        def add(key, value, timeout, version):
+            if key in self.store:
+                return False
+            self.store_one(key, value, timeout, version)
+            return True
+
+        self.mock.add.side_effect = add
+        self.mock.delete.side_effect = lambda key, version: \
+            self.store.pop(key)
+
+        self.assertTrue(self.cache.add("foo", "bar " * 100, 10))
+        self.assertEquals(1, self.mock.set_many.call_count)
+        self.assertEquals("bar " * 100, self.cache.get("foo"))
+
+        stored = dict(self.store)
+        self.assertFalse(self.cache.add("foo", "baz " * 100, 10))
+        self.assertEquals(1, self.mock.set_many.call_count)
+        self.assertEquals(stored, self.store)
+
+        self.mock.set_many.side_effect = lambda data, timeout, version: [
+            list(data)[0]]
+        self.assertFalse(self.cache.add("bar", "baz " * 100, 10))
+        self.assertFalse("bar" in self.store)
+        self.assertFalse(asyncio.run(self.cache.aadd("bar", "baz " * 100,
+                                                     10)))
+        self.assertFalse("bar" in self.store)
+
+    def test_get_or_set_waiting(self):
+        """
+        Test that a client waiting for a value being produced by another
+        process fetches its chunks too.
+        """
+
+        self.cache.set("foo", "bar " * 100, 10)
+        self.cache.lease_poll_interval = 0.001
+        self.mock.add.return_value = False # The lease is taken
+        producer = Mock(return_value="baz")
+
+        for get_or_set in (self.cache.get_or_set, lambda *args: asyncio.run(
+                self.cache.aget_or_set(*args))):
+            misses = [None]
+            self.mock.get.side_effect = lambda key, version: (
+                misses.pop() if misses else self.load(key))
+            self.assertEquals("bar " * 100, get_or_set("foo", producer, 10))
+        self.assertFalse(producer.called)
+
+    def test_async(self):
+        """
+        Test that the async methods set and fetch the chunks too.
+        """
+
+        async def run():
+            await self.cache.aset("foo", "bar " * 100, 10)
+            self.assertEquals(1, self.mock.set_many.call_count)
+            return await self.cache.aget("foo")
+
+        self.assertEquals("bar " * 100, asyncio.run(run()))
+        self.assertEquals(1, self.mock.get_many.call_count)
+
+
+class WriteBehindTestCase(TestCase):
+    """
+    Tests for the WriteBehind class.
+    """
+
+    def test_batches(self):
+        """
+        Test that write-backs queued while a batch is written are written in
+        one batch per bulk set, timeout, and keyword arguments, and that a
+        newer write-back of a key replaces the queued one.
+        """
+
+        writer = WriteBehind(3)
+        release = threading.Event()
+        started = threading.Event()
+        calls = []
+
+        def set_many(values, timeout, **kwargs):
+            calls.append((values, timeout, kwargs))
+            started.set()
+            release.wait(5)
+
+        self.assertTrue(writer.submit("a", set_many, "a", 1, 10, {}))
+        started.wait(5)
+        self.assertTrue(writer.submit("b", set_many, "b", 1, 10, {}))
+        self.assertTrue(writer.submit("c", set_many, "c", 1, 10, {}))
+        self.assertTrue(writer.submit("b", set_many, "b", 2, 10, {}))
+        self.assertTrue(writer.submit(("c", 2), set_many, "c", 1, 10,
+                                      {"version": 2}))
+        self.assertFalse(writer.submit("d", set_many, "d", 1, 10, {}))
+        self.assertEquals(4, writer.pending())
+
+        release.set()
+        writer.join()
+        self.assertEquals(0, writer.pending())
+        self.assertEquals([({"a": 1}, 10, {}),
+                           ({"b": 2, "c": 1}, 10, {}),
+                           ({"c": 1}, 10, {"version": 2})],
+                          sorted(calls, key=repr))
+
+    def test_discard(self):
+        """
+        Test that discarding drops the queued write-backs, and waits for the
+        ones being written.
+        """
+
+        writer = WriteBehind()
+        release = threading.Event()
+        started = threading.Event()
+        calls = []
+
+        def set_many(values, timeout):
+            calls.append(values)
+            started.set()
+            release.wait(5)
+
+        writer.submit("a", set_many, "a", 1, 10, {})
+        started.wait(5)
+        writer.submit("b", set_many, "b", 1, 10, {})
+        writer.discard(["b"])
+
+        discarded = threading.Event()
+        thread = threading.Thread(target=lambda: (writer.discard(["a"]),
+                                                  discarded.set()))
+        thread.start()
+        self.assertFalse(discarded.wait(0.05))
+        release.set()
+        thread.join(5)
+        self.assertTrue(discarded.is_set())
+
+        writer.join()
+        self.assertEquals([{"a": 1}], calls)
+
+    def test_failure(self):
+        """
+        Test that failing writes do not stop the writer.
+        """
+
+        writer = WriteBehind()
+        calls = []
+        writer.submit("a", lambda values, timeout: 1 / 0, "a", 1, 10, {})
+        writer.join()
+        writer.submit("b", lambda values, timeout: calls.append(values), "b",
+                      1, 10, {})
+        writer.join()
+        self.assertEquals([{"b": 1}], calls)
+
+
+class BackgroundWriteBackTestCase(TestCase):
+    """
+    Tests for the "background" write-back mode.
+    """
+
+    def setUp(self):
+        self.cache = Cache(MockBackendMixin, None, {"OPTIONS": {
+            "writeback": "background", "clock": lambda: 1000}})
+        self.mock = self.cache._cache
+        self.mock.set_many = Mock(return_value=[])
+
+    def test_unknown_mode(self):
+        """
+        Test that unknown write-back modes are refused.
+        """
+
+        self.assertRaises(ValueError, Cache, MockBackendMixin, None,
+                          {"OPTIONS": {"writeback": "foo"}})
+
+    def test_get(self):
+        """
+        Test that the write-back of a value being renewed is queued, and
+        written with a bulk set.
+        """
+
+        value = Wrapper("bar", 900, 800, 60)
+        self.mock.get = Mock(return_value=value)
+
+        self.assertEquals(None, self.cache.get("foo"))
+        self.cache._writer.join()
+
+        self.assertFalse(self.mock.set.called)
+        self.mock.set_many.assert_called_once_with({"foo": value}, 800,
+                                                   version=None)
+        self.assertEquals(1060, value.soft_timeout)
+        self.assertTrue(value.renewing)
+
+    def test_get_many(self):
+        """
+        Test that the write-backs of a get_many are written in one batch.
+        """
+
+        values = {"foo": Wrapper("bar", 900, 800, 60),
+                  "baz": Wrapper("qux", 900, 800, 60),
+                  "quux": Wrapper("fresh", 2000, 800, 60)}
+        self.mock.get_many = Mock(return_value=values)
+
+        self.assertEquals({"quux": "fresh"},
+                          self.cache.get_many(["foo", "baz", "quux"]))
+        self.cache._writer.join()
+
+        self.mock.set_many.assert_called_once_with(
+            {"foo": values["foo"], "baz": values["baz"]}, 800, version=None)
+
+    def test_full(self):
+        """
+        Test that values are written back right away when the queue is full.
+        """
+
+        self.cache._writer = WriteBehind(0)
+        self.mock.get = Mock(return_value=Wrapper("bar", 900, 800, 60))
+
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertTrue(self.mock.set.called)
+
+    def test_set_discards(self):
+        """
+        Test that setting a key discards its queued write-back.
+        """
+
+        self.cache._writer = Mock()
+        self.cache.set("foo", "bar", 10, version=2)
+        self.cache._writer.discard.assert_called_once_with(
+            [("foo", ("version", 2))])
+
+
+class FakeRedis(object):
+    """
+    Stand-in for a Redis client, running Python equivalents of the scripts of
+    the Redis cache, and counting the round-trips. The scripts themselves are
+    run by RedisScriptTestCase.
+    """
+
+    FIELDS = (b"soft", b"hard", b"grace", b"compute", b"stamp", b"renewing",
+              b"flags", b"tags", b"value")
+
+    def __init__(self):
+        self.data = {} # Key: Dict of fields, or bytes
+        self.expiry = {} # Key: Seconds
+        self.calls = 0
+
+    def register_script(self, script):
+        run = {GET_SCRIPT: self._get, STORE_SCRIPT: self._store,
+               INVALIDATE_SCRIPT: self._invalidate}[script]
+
+        def call(keys=(), args=(), client=None):
+            args = [self._encode(arg) for arg in args]
+            if client is not None:
+                return client.queue(run, keys[0], args)
+            self.calls += 1
+            return run(keys[0], args)
+
+        return call
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def set(self, key, value, ex=None):
+        self.calls += 1
+        self.data[key] = self._encode(value)
+        self.expiry[key] = ex
+
+    def delete(self, *keys):
+        self.calls += 1
+        for key in keys:
+            self.data.pop(key, None)
+
+    def _encode(self, value):
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, float):
+            return repr(value).encode()
+        return str(value).encode()
+
+    def _get(self, key, args):
+        fields = self.data.get(key)
+        if fields is None:
+            return None
+        reply = [fields.get(name) for name in self.FIELDS]
+        if reply[0] is None:
+            return [0, reply]
+
+        now = float(args[0])
+        soft = float(reply[0])
+        if soft >= now and reply[7]:
+            for tag in reply[7].split(b"\0"):
+                marker = self.data.get(args[1].decode() + tag.decode())
+                if marker is not None and float(marker) >= float(reply[4]):
+                    soft = -1
+                    break
+        if soft >= now:
+            return [0, reply]
+
+        fields.update({b"soft": repr(now + float(reply[2])).encode(),
+                       b"stamp": args[0], b"renewing": b"1"})
+        if args[2] != b"1":
+            reply[8] = None
+        return [1, reply]
+
+    def _store(self, key, args):
+        if args[0] == b"1" and key in self.data:
+            return 0
+        self.data[key] = dict(zip(args[2::2], args[3::2]))
+        self.expiry[key] = int(args[1])
+        return 1
+
+    def _invalidate(self, key, args):
+        fields = self.data.get(key)
+        if fields is not None and b"soft" in fields:
+            fields.update({b"soft": b"0", b"renewing": b"0"})
+            return 1
+        return int(self.data.pop(key, None) is not None)
+
+
+class FakePipeline(object):
+    """
+    Stand-in for a Redis pipeline, running the queued scripts in one
+    round-trip.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.queued = []
+
+    def queue(self, run, key, args):
+        self.queued.append((run, key, args))
+
+    def execute(self):
+        self.client.calls += 1
+        return [run(key, args) for run, key, args in self.queued]
+
+
+class RedisCacheTestCase(TestCase):
+    """
+    Tests for the RedisCache class.
+    """
+
+    def setUp(self):
+        self.now = 1000.5
+        self.client = FakeRedis()
+        self.cache = RedisCache(self.client, clock=lambda: self.now)
+
+    def test_set_and_get(self):
+        """
+        Test that values are kept in hashes, and fetched in one round-trip.
+        """
+
+        self.cache.set("foo", "bar", 10)
+        fields = self.client.data["foo"]
+        self.assertEquals(b"1010.5", fields[b"soft"])
+        self.assertEquals(b"0", fields[b"renewing"])
+        self.assertEquals(80, self.client.expiry["foo"])
+
+        self.client.calls = 0
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals(1, self.client.calls)
+        self.assertEquals("baz", self.cache.get("missing", "baz"))
+
+    def test_renewal(self):
+        """
+        Test that the renewal is granted to one client, in place, without
+        sending the payload or writing it back.
+        """
+
+        self.cache.set("foo", "bar", 10, grace_time=30)
+        self.now = 1011
+
+        self.client.calls = 0
+        value = self.cache._get_directly("foo")
+        self.assertTrue(value.claimed)
+        self.assertTrue(value.empty)
+        self.assertEquals(b"1041.0", self.client.data["foo"][b"soft"])
+        self.assertEquals(b"1", self.client.data["foo"][b"renewing"])
+
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals(2, self.client.calls)
+
+        self.now = 1042
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals(3, self.client.calls)
+
+    def test_get_many(self):
+        """
+        Test that several values are fetched in one round-trip, leaving out
+        the ones due for renewal.
+        """
+
+        self.cache.set_many({"foo": "bar", "baz": "qux"}, 10)
+        self.cache.set("quux", "corge", 20)
+        self.now = 1011
+
+        self.client.calls = 0
+        self.assertEquals({"quux": "corge"},
+                          self.cache.get_many(["foo", "baz", "quux", "x"]))
+        self.assertEquals(1, self.client.calls)
+        self.assertEquals({"foo": "bar", "baz": "qux", "quux": "corge"},
+                          self.cache.get_many(["foo", "baz", "quux"]))
+
+    def test_add(self):
+        """
+        Test that values are only added when missing.
+        """
+
+        self.assertTrue(self.cache.add("foo", "bar", 10))
+        self.assertFalse(self.cache.add("foo", "baz", 10))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+    def test_hard(self):
+        """
+        Test that values set with hard=True are not anti-dogpiled, and are
+        deleted by soft deletes.
+        """
+
+        self.cache.set("foo", ["bar"], 10, hard=True)
+        self.assertEquals(10, self.client.expiry["foo"])
+        self.assertFalse(b"soft" in self.client.data["foo"])
+        self.assertEquals(["bar"], self.cache.get("foo"))
+
+        self.cache.delete("foo")
+        self.assertFalse("foo" in self.client.data)
+
+    def test_delete(self):
+        """
+        Test that deletes invalidate the values softly, in place, unless
+        hard.
+        """
+
+        self.cache.set_many({"foo": "bar", "baz": "qux", "quux": "corge"}, 10)
+
+        self.client.calls = 0
+        self.cache.delete("foo")
+        self.cache.delete_many(["baz"])
+        self.assertEquals(2, self.client.calls)
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals(None, self.cache.get("baz"))
+
+        self.cache.delete("quux", hard=True)
+        self.assertFalse("quux" in self.client.data)
+
+    def test_tags(self):
+        """
+        Test that the markers of the tags are applied by the get script.
+        """
+
+        self.cache.set("foo", "bar", 10, tags=["a", "b"])
+        self.cache.set("baz", "qux", 10, tags=["a"])
+        self.now = 1002
+        self.cache.soft_invalidate_tag("b")
+        self.assertEquals(b"1002", self.client.data["adp-tag:b"])
+        self.now = 1003
+
+        self.assertEquals("qux", self.cache.get("baz"))
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+    def test_get_or_set(self):
+        """
+        Test that get_or_set produces missing values and values granted for
+        renewal.
+        """
+
+        producer = Mock(return_value="bar")
+        self.assertEquals("bar", self.cache.get_or_set("foo", producer, 10))
+        self.assertEquals("bar", self.cache.get_or_set("foo", producer, 10))
+        self.assertEquals(1, producer.call_count)
+        self.assertFalse("foo:adp-lease" in self.client.data)
+
+        self.now = 1011
+        producer.return_value = "baz"
+        self.assertEquals("baz", self.cache.get_or_set("foo", producer, 10))
+        self.assertEquals(b"1021", self.client.data["foo"][b"soft"])
+
+    def test_single_flight(self):
+        """
+        Test that the clients sharing the fetch of a value granted for renewal
+        are served the old value, as the payload is sent along.
+        """
+
+        cache = RedisCache(self.client, single_flight=True,
+                           clock=lambda: self.now)
+        cache.set("foo", "old", 10)
+        cache.set("bar", "old", 10)
+        self.now = 1011
+
+        producer = Mock(return_value="fresh")
+        self.assertEquals(["fresh", "old", "old", "old"], sorted(
+            run_coalesced(cache, lambda: cache.get_or_set("foo", producer,
+                                                          10))))
+        self.assertEquals(1, producer.call_count)
+        self.assertEquals([None, "old", "old", "old"], sorted(
+            run_coalesced(cache, lambda: cache.get("bar")),
+            key=lambda result: result is not None))
+
+    def test_compression(self):
+        """
+        Test that large values are compressed, and decoded when used.
+        """
+
+        cache = RedisCache(self.client, compress_threshold=100,
+                           clock=lambda: self.now)
+        cache.set("foo", "bar " * 1000, 10)
+        self.assertTrue(len(self.client.data["foo"][b"value"]) < 100)
+
+        value = cache._get_directly("foo")
+        self.assertFalse(value.empty)
+        self.assertEquals("bar " * 1000, value.value)
+
+    def test_metrics(self):
+        """
+        Test that the renewals are counted.
+        """
+
+        metrics = LocalMetrics()
+        cache = RedisCache(self.client, metrics=metrics,
+                           clock=lambda: self.now)
+        cache.set("foo", "bar", 10)
+        cache.get("foo")
+        self.now = 1011
+        cache.get("foo")
+        cache.get("foo")
+
+        self.assertEquals({"soft_hit": 1, "renewal_granted": 1,
+                           "stale_serve": 1}, metrics.counts)
+
+
+@requires_lua
+class RedisScriptTestCase(TestCase):
+    """
+    Tests for the Lua scripts of the RedisCache class, run by the Lua 5.1
+    interpreter of fakeredis, like on a Redis server.
+    """
+
+    def setUp(self):
+        self.now = 1000.5
+        self.client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        self.cache = RedisCache(self.client, clock=lambda: self.now)
+
+    def test_chunk_size(self):
+        """
+        Test that the chunk_size option makes no difference.
+        """
+
+        cache = RedisCache(self.client, chunk_size=10,
+                           clock=lambda: self.now)
+        value = list(range(100))
+        self.assertEquals(value, cache.get_or_set("foo", lambda: value, 10))
+        self.assertEquals(value, cache.get("foo"))
+        self.assertEquals([b"foo"], self.client.keys())
+
+    def test_set_and_get(self):
+        """
+        Test that values are stored in hashes, with the hard timeout as the
+        expiry, and read back.
+        """
+
+        self.cache.set("foo", "bar", 10, tags=["a", "b"])
+        fields = self.client.hgetall("foo")
+        self.assertEquals(b"1010.5", fields[b"soft"])
+        self.assertEquals(b"a\0b", fields[b"tags"])
+        self.assertTrue(70 < self.client.ttl("foo") <= 80)
+
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals("baz", self.cache.get("missing", "baz"))
+        self.assertEquals({"foo": "bar"},
+                          self.cache.get_many(["foo", "missing"]))
+
+    def test_renewal(self):
+        """
+        Test that the get script grants the renewal to one client, bumping
+        the soft timeout in place, without sending the payload.
+        """
+
+        self.cache.set("foo", "bar", 10, grace_time=30)
+        self.now = 1011
+
+        value = self.cache._get_directly("foo")
+        self.assertTrue(value.claimed)
+        self.assertTrue(value.empty)
+        self.assertEquals(1041, float(self.client.hget("foo", "soft")))
+        self.assertEquals(b"1", self.client.hget("foo", "renewing"))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+        cache = RedisCache(self.client, single_flight=True,
+                           clock=lambda: self.now)
+        self.now = 1042
+        value = cache._get_directly("foo")
+        self.assertTrue(value.claimed)
+        self.assertEquals("bar", value.value)
+
+    def test_add_and_hard(self):
+        """
+        Test that the store script only adds missing values, and stores
+        values set with hard=True without the wrapper fields.
+        """
+
+        self.assertTrue(self.cache.add("foo", "bar", 10))
+        self.assertFalse(self.cache.add("foo", "baz", 10))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+        self.cache.set("baz", ["qux"], 10, hard=True)
+        self.assertFalse(self.client.hexists("baz", "soft"))
+        self.assertTrue(0 < self.client.ttl("baz") <= 10)
+        self.assertEquals(["qux"], self.cache.get("baz"))
+
+    def test_delete(self):
+        """
+        Test that the invalidate script invalidates wrapped values in place,
+        and deletes the others.
+        """
+
+        self.cache.set("foo", "bar", 10)
+        self.cache.set("baz", "qux", 10, hard=True)
+        self.cache.delete_many(["foo", "baz"])
+        self.assertEquals(b"0", self.client.hget("foo", "soft"))
+        self.assertFalse(self.client.exists("baz"))
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+    def test_tags(self):
+        """
+        Test that the get script applies the markers of the tags.
+        """
+
+        self.cache.set("foo", "bar", 10, tags=["a", "b"])
+        self.cache.set("baz", "qux", 10, tags=["a"])
+        self.now = 1002
+        self.cache.soft_invalidate_tag("b")
+        self.now = 1003
+
+        self.assertEquals("qux", self.cache.get("baz"))
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+
+class SQLCacheTestCase(TestCase):
+    """
+    Tests for the SQLCache class, on an in-memory SQLite database.
+    """
+
+    def setUp(self):
+        self.now = 1000.5
+        self.connection = sqlite3.connect(":memory:")
+        self.cache = SQLCache(self.connection, clock=lambda: self.now)
+        self.cache.create_table()
+        self.statements = []
+        self.connection.set_trace_callback(self.statements.append)
+
+    def row(self, key, columns="soft_timeout, stamp, renewing, value"):
+        return self.connection.execute(
+            "SELECT %s FROM antidogpiling_cache WHERE cache_key = ?" %
+            columns, (key,)).fetchone()
+
+    def test_chunk_size(self):
+        """
+        Test that the chunk_size option makes no difference.
+        """
+
+        self.cache.chunk_size = 10
+        value = list(range(100))
+        self.assertEquals(value, self.cache.get_or_set("foo", lambda: value,
+                                                       10))
+        self.assertEquals(value, self.cache.get("foo"))
+
+    def test_set_and_get(self):
+        """
+        Test that the timeouts are kept in columns of their own, and values
+        are fetched with one query.
+        """
+
+        self.cache.set("foo", "bar", 10)
+        self.assertEquals((1010.5, 1080.5),
+                          self.row("foo", "soft_timeout, expires"))
+
+        del self.statements[:]
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals(1, len([statement for statement in self.statements
+                                  if statement.startswith("SELECT")]))
+        self.assertEquals("baz", self.cache.get("missing", "baz"))
+
+        self.now = 1081
+        self.assertEquals(None, self.cache.get("foo"))
+
+    def test_renewal(self):
+        """
+        Test that the renewal is claimed by one client, with a conditional
+        update leaving the payload as it is.
+        """
+
+        self.cache.set("foo", "bar", 10, grace_time=30)
+        payload = self.row("foo")[3]
+        self.now = 1011
+
+        value = self.cache._get_directly("foo")
+        other = self.cache._get_directly("foo")
+        del self.statements[:]
+        self.assertTrue(self.cache._claim_renewal("foo", value))
+        self.assertFalse(self.cache._claim_renewal("foo", other))
+        self.assertFalse([statement for statement in self.statements
+                          if statement.startswith("INSERT") or
+                          "value" in statement])
+        self.assertEquals((1041, 1011, 1, payload), self.row("foo"))
+
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.now = 1042
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+    def test_get_many(self):
+        """
+        Test that several values are fetched with one query, leaving out the
+        ones due for renewal.
+        """
+
+        self.cache.set_many({"foo": "bar", "baz": "qux"}, 10)
+        self.cache.set("quux", "corge", 20)
+        self.now = 1011
+
+        del self.statements[:]
+        self.assertEquals({"quux": "corge"},
+                          self.cache.get_many(["foo", "baz", "quux", "x"]))
+        self.assertEquals(1, len([statement for statement in self.statements
+                                  if statement.startswith("SELECT")]))
+        self.assertEquals({"foo": "bar", "baz": "qux", "quux": "corge"},
+                          self.cache.get_many(["foo", "baz", "quux"]))
+
+    def test_add(self):
+        """
+        Test that values are only added when missing or expired.
+        """
+
+        self.assertTrue(self.cache.add("foo", "bar", 10))
+        self.assertFalse(self.cache.add("foo", "baz", 10))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+        self.now = 1081
+        self.assertTrue(self.cache.add("foo", "baz", 10))
+        self.assertEquals("baz", self.cache.get("foo"))
+
+    def test_hard(self):
+        """
+        Test that values set with hard=True are not anti-dogpiled, and are
+        deleted by soft deletes.
+        """
+
+        self.cache.set("foo", ["bar"], 10, hard=True)
+        self.assertEquals((None, 1010.5),
+                          self.row("foo", "soft_timeout, expires"))
+        self.assertEquals(["bar"], self.cache.get("foo"))
+
+        self.cache.delete("foo")
+        self.assertEquals(None, self.row("foo"))
+
+    def test_delete(self):
+        """
+        Test that deletes invalidate the values softly, in place, unless
+        hard.
+        """
+
+        self.cache.set_many({"foo": "bar", "baz": "qux", "quux": "corge"}, 10)
+
+        self.cache.delete_many(["foo", "baz"])
+        self.assertEquals((0, 1000.5, 0), self.row("foo")[:3])
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals(None, self.cache.get("baz"))
+
+        self.cache.delete("quux", hard=True)
+        self.assertEquals(None, self.row("quux"))
+
+    def test_tags(self):
+        """
+        Test that values invalidated by the markers of their tags are claimed
+        by one client.
+        """
+
+        self.cache.set("foo", "bar", 10, tags=["a", "b"])
+        self.cache.set("baz", "qux", 10, tags=["a"])
+        self.now = 1002
+        self.cache.soft_invalidate_tag("b")
+        self.now = 1003
+
+        self.assertEquals("qux", self.cache.get("baz"))
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+    def test_get_or_set(self):
+        """
+        Test that get_or_set produces missing values and values due for
+        renewal.
+        """
+
+        producer = Mock(return_value="bar")
+        self.assertEquals("bar", self.cache.get_or_set("foo", producer, 10))
+        self.assertEquals("bar", self.cache.get_or_set("foo", producer, 10))
+        self.assertEquals(1, producer.call_count)
+
+        self.now = 1011
+        producer.return_value = "baz"
+        self.assertEquals("baz", self.cache.get_or_set("foo", producer, 10))
+        self.assertEquals(1021, self.row("foo")[0])
+
+    def test_upsert(self):
+        """
+        Test that values are set with one upsert given the vendor.
+        """
+
+        cache = SQLCache(self.connection, vendor="sqlite",
+                         clock=lambda: self.now)
+        cache.set("foo", "bar", 10)
+        del self.statements[:]
+        cache.set_many({"foo": "baz", "qux": "quux"}, 10)
+        inserts = [statement for statement in self.statements
+                   if statement.startswith("INSERT")]
+        self.assertEquals(2, len(inserts))
+        self.assertTrue(all("ON CONFLICT" in insert for insert in inserts))
+        self.assertFalse([statement for statement in self.statements
+                          if statement.startswith("DELETE")])
+        self.assertEquals({"foo": "baz", "qux": "quux"},
+                          cache.get_many(["foo", "qux"]))
+
+        self.assertRaises(ValueError, SQLCache, self.connection,
+                          vendor="oracle")
+
+    def test_concurrent_insert(self):
+        """
+        Test that a set is dropped, not raised, when a concurrent set inserts
+        the key between the delete and the insert.
+        """
+
+        self.cache.set("foo", "bar", 10)
+        connection = self.cache.connection = Mock()
+        connection.IntegrityError = sqlite3.IntegrityError
+        connection.cursor.return_value.executemany.side_effect = \
+            sqlite3.IntegrityError("UNIQUE constraint failed")
+
+        self.cache.set("foo", "baz", 10)
+        self.assertTrue(connection.rollback.called)
+        self.assertFalse(connection.commit.called)
+
+    def test_cull(self):
+        """
+        Test that culls delete the expired values, and the values expiring
+        first beyond max_entries.
+        """
+
+        self.cache.set("foo", "bar", 1, hard=True)
+        self.cache.set("baz", "qux", 10, hard=True)
+        self.now = 1002
+        self.cache.cull()
+        self.assertEquals(None, self.row("foo"))
+        self.assertEquals("qux", self.cache.get("baz"))
+
+        cache = SQLCache(self.connection, max_entries=2,
+                         clock=lambda: self.now)
+        cache.set("quux", "corge", 20, hard=True)
+        cache.set("grault", "garply", 30, hard=True)
+        self.assertEquals(None, self.row("baz"))
+        self.assertEquals({"quux": "corge", "grault": "garply"},
+                          cache.get_many(["baz", "quux", "grault"]))
+
+    def test_compression(self):
+        """
+        Test that large values are compressed, and decoded when used.
+        """
+
+        cache = SQLCache(self.connection, compress_threshold=100,
+                         clock=lambda: self.now)
+        cache.set("foo", "bar " * 1000, 10)
+        self.assertTrue(len(self.row("foo")[3]) < 100)
+        self.assertEquals("bar " * 1000, cache.get("foo"))
+
+
+@requires_django
+class DjangoDatabaseCacheTestCase(TestCase):
+    """
+    Tests for the Django DatabaseCache backend, on an in-memory SQLite
+    database.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        setup_django()
+
+    def setUp(self):
+        self.now = 1000.5
+        self.cache = DatabaseCache("adp cache", {"TIMEOUT": 60, "OPTIONS": {
+            "clock": lambda: self.now}})
+        self.cache.create_table()
+
+    def tearDown(self):
+        with connections["default"].cursor() as cursor:
+            cursor.execute('DROP TABLE "adp cache"')
+
+    def test_set_and_get(self):
+        """
+        Test that values are set with upserts, and renewed in place.
+        """
+
+        self.assertTrue(self.cache._upsert is not None)
+        self.cache.set("foo", "bar", 10)
+        self.cache.set_many({"foo": "baz", "qux": "quux"}, 10)
+        self.assertEquals({"foo": "baz", "qux": "quux"},
+                          self.cache.get_many(["foo", "qux"]))
+
+        self.now = 1011
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("baz", self.cache.get("foo"))
+
+    def test_add_and_delete(self):
+        """
+        Test that values are only added when missing, and invalidated softly.
+        """
+
+        self.assertTrue(self.cache.add("foo", "bar"))
+        self.assertFalse(self.cache.add("foo", "baz"))
+        self.cache.delete("foo")
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.cache.delete("foo", hard=True)
+        self.assertEquals("qux", self.cache.get("foo", "qux"))
+
+    def test_has_key(self):
+        """
+        Test that keys are checked without claiming the renewals, like by the
+        cache session backend.
+        """
+
+        self.cache.set("foo", "bar", 10)
+        self.assertTrue("foo" in self.cache)
+        self.assertFalse(self.cache.has_key("baz"))
+
+        self.now = 1011
+        self.assertTrue("foo" in self.cache)
+        self.assertEquals(None, self.cache.get("foo"))
+
+        self.now = 1081
+        self.assertFalse("foo" in self.cache)
+
+    def test_incr(self):
+        """
+        Test that values set with hard=True are incremented and decremented,
+        keeping their expiry times.
+        """
+
+        self.cache.set("foo", 1, 10, hard=True)
+        self.assertEquals(3, self.cache.incr("foo", 2))
+        self.assertEquals(2, self.cache.decr("foo"))
+        self.assertEquals(2, self.cache.get("foo"))
+
+        self.cache.set("bar", 1, 10)
+        self.assertRaises(ValueError, self.cache.incr, "bar")
+        self.assertRaises(ValueError, self.cache.incr, "baz")
+        self.now = 1011
+        self.assertRaises(ValueError, self.cache.incr, "foo")
+
+    def test_touch(self):
+        """
+        Test that touches give values new timeouts.
+        """
+
+        self.cache.set("foo", "bar", 10)
+        self.cache.set("baz", "qux", 10, hard=True)
+        self.now = 1005
+        self.assertTrue(self.cache.touch("foo", 10))
+        self.assertTrue(self.cache.touch("baz", 10))
+        self.assertFalse(self.cache.touch("quux", 10))
+
+        self.now = 1014
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals("qux", self.cache.get("baz"))
+
+    def test_get_or_set(self):
+        """
+        Test that get_or_set defaults to the default timeout, and takes the
+        value itself, like in Django.
+        """
+
+        self.assertEquals("bar", self.cache.get_or_set("foo", "bar"))
+        self.now = 1060
+        self.assertEquals("bar", self.cache.get_or_set("foo", "baz"))
+        self.now = 1061
+        self.assertEquals("baz", self.cache.get_or_set("foo", "baz"))
+
+
+class FileCacheTestCase(TestCase):
+    """
+    Tests for the FileCache class.
+    """
+
+    def setUp(self):
+        self.now = 1000.5
+        self.directory = tempfile.mkdtemp()
+        self.cache = FileCache(self.directory, clock=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def header(self, key):
+        with open(self.cache._path(key), "rb") as f:
+            return HEADER.unpack(f.read(HEADER.size))
+
+    def payload(self, key):
+        with open(self.cache._path(key), "rb") as f:
+            header = HEADER.unpack(f.read(HEADER.size))
+            f.read(header[4])
+            return f.read()
+
+    def test_chunk_size(self):
+        """
+        Test that the chunk_size option makes no difference.
+        """
+
+        self.cache.chunk_size = 10
+        value = list(range(100))
+        self.assertEquals(value, self.cache.get_or_set("foo", lambda: value,
+                                                       10))
+        self.assertEquals(value, self.cache.get("foo"))
+        self.assertEquals(1, len(os.listdir(self.directory)))
+
+    def test_set_and_get(self):
+        """
+        Test that the timeouts are kept in the header of the file.
+        """
+
+        self.cache.set("foo", "bar", 10)
+        self.assertEquals((1, 0, 1010.5, 1000.5), self.header("foo")[1:3] +
+                          self.header("foo")[5:7])
+        self.assertEquals(1080.5, self.header("foo")[-1])
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals("baz", self.cache.get("missing", "baz"))
+
+        self.now = 1081
+        self.assertEquals(None, self.cache.get("foo"))
+
+    def test_renewal(self):
+        """
+        Test that the renewal is claimed by one client, in the header, without
+        reading the payload or writing it back.
+        """
+
+        self.cache.set("foo", "bar", 10, grace_time=30)
+        payload = self.payload("foo")
+        inode = os.stat(self.cache._path("foo")).st_ino
+        self.now = 1011
+
+        value = self.cache._get_directly("foo")
+        self.assertTrue(value.claimed)
+        self.assertTrue(value.empty)
+        self.assertEquals((1, 1041, 1011), self.header("foo")[2:3] +
+                          self.header("foo")[5:7])
+
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertFalse(self.cache._claim_directly("foo", value))
+        self.assertEquals(payload, self.payload("foo"))
+        self.assertEquals(inode, os.stat(self.cache._path("foo")).st_ino)
+
+        self.now = 1042
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+    def test_replaced(self):
+        """
+        Test that renewals are not claimed in files replaced since read.
+        """
+
+        self.cache.set("foo", "bar", 10)
+        value = self.cache._get_directly("foo")
+        self.now = 1001
+        self.cache.set("foo", "baz", 10)
+        self.assertFalse(self.cache._claim_directly("foo", value))
+        self.assertTrue(self.cache._claim_directly(
+            "foo", self.cache._get_directly("foo")))
+
+    def test_get_many(self):
+        """
+        Test that values due for renewal are left out of bulk gets.
+        """
+
+        self.cache.set_many({"foo": "bar", "baz": "qux"}, 10)
+        self.cache.set("quux", "corge", 20)
+        self.now = 1011
+
+        self.assertEquals({"quux": "corge"},
+                          self.cache.get_many(["foo", "baz", "quux", "x"]))
+        self.assertEquals({"foo": "bar", "baz": "qux", "quux": "corge"},
+                          self.cache.get_many(["foo", "baz", "quux"]))
+
+    def test_add(self):
+        """
+        Test that values are only added when missing or expired.
+        """
+
+        self.assertTrue(self.cache.add("foo", "bar", 10))
+        self.assertFalse(self.cache.add("foo", "baz", 10))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+        self.now = 1081
+        self.assertTrue(self.cache.add("foo", "baz", 10))
+        self.assertEquals("baz", self.cache.get("foo"))
+        self.assertEquals(1, len(os.listdir(self.directory)))
+
+    def test_add_race(self):
+        """
+        Test that a client adding a value in place of an expired one does not
+        remove the value another client added meanwhile.
+        """
+
+        self.cache.add("foo", "bar", 10)
+        self.now = 1081
+        flock = fcntl.flock
+        racing = []
+
+        def racing_flock(fd, operation):
+            if not racing:
+                racing.append(None)
+                racing[0] = self.cache.add("foo", "baz", 10)
+            flock(fd, operation)
+
+        with patch("fcntl.flock", racing_flock):
+            self.assertFalse(self.cache.add("foo", "qux", 10))
+        self.assertEquals([True], racing)
+        self.assertEquals("baz", self.cache.get("foo"))
+
+    def test_hard(self):
+        """
+        Test that values set with hard=True are not anti-dogpiled, and are
+        deleted by soft deletes.
+        """
+
+        self.cache.set("foo", ["bar"], 10, hard=True)
+        self.assertEquals(0, self.header("foo")[1])
+        self.assertEquals(["bar"], self.cache.get("foo"))
+
+        self.cache.delete("foo")
+        self.assertFalse(os.path.exists(self.cache._path("foo")))
+
+    def test_delete(self):
+        """
+        Test that deletes invalidate the values softly, in the headers, unless
+        hard.
+        """
+
+        self.cache.set_many({"foo": "bar", "baz": "qux", "quux": "corge"}, 10)
+
+        self.cache.delete_many(["foo", "baz"])
+        self.assertEquals(0, self.header("foo")[5])
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertEquals(None, self.cache.get("baz"))
+
+        self.cache.delete("quux", hard=True)
+        self.assertFalse(os.path.exists(self.cache._path("quux")))
+
+    def test_tags(self):
+        """
+        Test that values invalidated by the markers of their tags are claimed
+        by one client.
+        """
+
+        self.cache.set("foo", "bar", 10, tags=["a", "b"])
+        self.cache.set("baz", "qux", 10, tags=["a"])
+        self.now = 1002
+        self.cache.soft_invalidate_tag("b")
+        self.now = 1003
+
+        self.assertEquals("qux", self.cache.get("baz"))
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+    def test_get_or_set(self):
+        """
+        Test that get_or_set produces missing values and values due for
+        renewal.
+        """
+
+        producer = Mock(return_value="bar")
+        self.assertEquals("bar", self.cache.get_or_set("foo", producer, 10))
+        self.assertEquals("bar", self.cache.get_or_set("foo", producer, 10))
+        self.assertEquals(1, producer.call_count)
+
+        self.now = 1011
+        producer.return_value = "baz"
+        self.assertEquals("baz", self.cache.get_or_set("foo", producer, 10))
+        self.assertEquals(1021, self.header("foo")[5])
+
+    def test_single_flight(self):
+        """
+        Test that the clients sharing the fetch of a value claimed for renewal
+        are served the old value, as the payload is read along.
+        """
+
+        cache = FileCache(self.directory, single_flight=True,
+                          clock=lambda: self.now)
+        cache.set("foo", "old", 10)
+        cache.set("bar", "old", 10)
+        self.now = 1011
+
+        producer = Mock(return_value="fresh")
+        self.assertEquals(["fresh", "old", "old", "old"], sorted(
+            run_coalesced(cache, lambda: cache.get_or_set("foo", producer,
+                                                          10))))
+        self.assertEquals(1, producer.call_count)
+        self.assertEquals([None, "old", "old", "old"], sorted(
+            run_coalesced(cache, lambda: cache.get("bar")),
+            key=lambda result: result is not None))
+
+    def test_cull(self):
+        """
+        Test that culls delete the expired values, and the values expiring
+        first beyond max_entries.
+        """
+
+        self.cache.set("foo", "bar", 1, hard=True)
+        self.cache.set("baz", "qux", 10, hard=True)
+        self.now = 1002
+        self.cache.cull()
+        self.assertFalse(os.path.exists(self.cache._path("foo")))
+        self.assertEquals("qux", self.cache.get("baz"))
+
+        cache = FileCache(self.directory, max_entries=2,
+                          clock=lambda: self.now)
+        cache.set("quux", "corge", 20, hard=True)
+        cache.set("grault", "garply", 30, hard=True)
+        self.assertEquals({"quux": "corge", "grault": "garply"},
+                          cache.get_many(["baz", "quux", "grault"]))
+
+    def test_cull_if_full(self):
+        """
+        Test that sets only cull when there are more than max_entries values,
+        and then cull a share of them.
+        """
+
+        cache = FileCache(self.directory, max_entries=3,
+                          clock=lambda: self.now)
+        with patch.object(FileCache, "_expires",
+                          side_effect=cache._expires) as expires:
+            for i in range(3):
+                cache.set("key%d" % i, i, 10 + 2 * i, hard=True)
+                cache.add("added%d" % i, i, 11 + 2 * i, hard=True)
+                if i == 0:
+                    self.assertFalse(expires.called)
+
+        # Both culls keep the 2 values expiring last of 4
+        self.assertEquals({"key2": 2, "added2": 2}, cache.get_many(
+            ["key%d" % i for i in range(3)] +
+            ["added%d" % i for i in range(3)]))
+        self.assertEquals(2, len(os.listdir(self.directory)))
+
+    def test_compression(self):
+        """
+        Test that large values are compressed, and decoded when used.
+        """
+
+        cache = FileCache(self.directory, compress_threshold=100,
+                          clock=lambda: self.now)
+        cache.set("foo", "bar " * 1000, 10)
+        self.assertTrue(len(self.payload("foo")) < 100)
+        self.assertEquals("bar " * 1000, cache.get("foo"))
+
+
+class MemoryCacheTestCase(TestCase):
+    """
+    Tests for the MemoryCache class.
+    """
+
+    def setUp(self):
+        self.now = 1000.5
+        self.cache = MemoryCache(self.id(), clock=lambda: self.now)
+
+    def test_set_and_get(self):
+        """
+        Test that values are kept by reference, without pickling.
+        """
+
+        value = ["bar"]
+        with patch("pickle.dumps") as dumps:
+            self.cache.set("foo", value, 10)
+            self.assertTrue(self.cache.get("foo") is value)
+            self.assertFalse(dumps.called)
+        self.assertEquals("baz", self.cache.get("missing", "baz"))
+
+        self.now = 1081
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertFalse("foo" in self.cache._store)
+
+    def test_copy(self):
+        """
+        Test that values are copied when read with the copy option.
+        """
+
+        cache = MemoryCache(self.id(), copy=True)
+        value = ["bar"]
+        cache.set("foo", value, 10)
+        cache.set("baz", value, 10, hard=True)
+        self.assertEquals(value, cache.get("foo"))
+        self.assertFalse(cache.get("foo") is value)
+        self.assertFalse(cache.get("baz") is value)
+
+    def test_shared(self):
+        """
+        Test that caches with the same name share the values.
+        """
+
+        self.cache.set("foo", "bar", 10)
+        self.assertEquals("bar", MemoryCache(
+            self.id(), clock=lambda: self.now).get("foo"))
+        self.assertEquals(None, MemoryCache(
+            self.id() + "x", clock=lambda: self.now).get("foo"))
+
+    def test_renewal(self):
+        """
+        Test that the renewal is claimed by one client, by swapping in a new
+        wrapper, without changing the stored one.
+        """
+
+        self.cache.set("foo", "bar", 10, grace_time=30)
+        stored = self.cache._store.get("foo")[0]
+        self.now = 1011
+
+        value = self.cache._get_directly("foo")
+        self.assertTrue(value.claimed)
+        self.assertEquals((1010.5, False), (stored.soft_timeout,
+                                            stored.renewing))
+        renewed = self.cache._store.get("foo")[0]
+        self.assertEquals((1041, 1011, True), (renewed.soft_timeout,
+                                               renewed.stamp,
+                                               renewed.renewing))
+
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertFalse(self.cache._claim_directly("foo", value))
+        self.now = 1042
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+    def test_concurrent_renewal(self):
+        """
+        Test that exactly one of several threads is granted the renewal.
+        """
+
+        self.cache.set("foo", "bar", 10)
+        self.now = 1011
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.cache.get("foo")))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals([None] + ["bar"] * 7, sorted(
+            results, key=lambda result: result is not None))
+
+    def test_get_many(self):
+        """
+        Test that values due for renewal are left out of bulk gets.
+        """
+
+        self.cache.set_many({"foo": "bar", "baz": "qux"}, 10)
+        self.cache.set("quux", "corge", 20)
+        self.now = 1011
+
+        self.assertEquals({"quux": "corge"},
+                          self.cache.get_many(["foo", "baz", "quux", "x"]))
+        self.assertEquals({"foo": "bar", "baz": "qux", "quux": "corge"},
+                          self.cache.get_many(["foo", "baz", "quux"]))
+
+    def test_add(self):
+        """
+        Test that values are only added when missing or expired.
+        """
+
+        self.assertTrue(self.cache.add("foo", "bar", 10))
+        self.assertFalse(self.cache.add("foo", "baz", 10))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+        self.now = 1081
+        self.assertTrue(self.cache.add("foo", "baz", 10))
+        self.assertEquals("baz", self.cache.get("foo"))
+
+    def test_delete(self):
+        """
+        Test that deletes invalidate the values softly, unless hard or not
+        anti-dogpiled.
+        """
+
+        self.cache.set_many({"foo": "bar", "baz": "qux"}, 10)
+        self.cache.set("quux", "corge", 10, hard=True)
+
+        self.cache.delete_many(["foo", "quux"])
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.assertFalse("quux" in self.cache._store)
+
+        self.cache.delete("baz", hard=True)
+        self.assertFalse("baz" in self.cache._store)
+
+    def test_tags(self):
+        """
+        Test that values invalidated by the markers of their tags are claimed
+        by one client.
+        """
+
+        self.cache.set("foo", "bar", 10, tags=["a", "b"])
+        self.cache.set("baz", "qux", 10, tags=["a"])
+        self.now = 1002
+        self.cache.soft_invalidate_tag("b")
+        self.now = 1003
+
+        self.assertEquals("qux", self.cache.get("baz"))
+        self.assertEquals(None, self.cache.get("foo"))
+        self.assertEquals("bar", self.cache.get("foo"))
+
+    def test_get_or_set(self):
+        """
+        Test that get_or_set produces missing values and values due for
+        renewal.
+        """
+
+        producer = Mock(return_value="bar")
+        self.assertEquals("bar", self.cache.get_or_set("foo", producer, 10))
+        self.assertEquals("bar", self.cache.get_or_set("foo", producer, 10))
+        self.assertEquals(1, producer.call_count)
+
+        self.now = 1011
+        producer.return_value = "baz"
+        self.assertEquals("baz", self.cache.get_or_set("foo", producer, 10))
+        self.assertEquals(1021, self.cache._store.get("foo")[0].soft_timeout)
+
+    def test_default_timeout(self):
+        """
+        Test that get_or_set and the decorator default to the default
+        timeout, and that get_or_set takes the value itself.
+        """
+
+        self.assertEquals("bar", self.cache.get_or_set("foo", "bar"))
+        self.assertEquals(1300.5, self.cache._store.get("foo")[0].soft_timeout)
+        self.assertEquals("qux", asyncio.run(self.cache.aget_or_set(
+            "baz", lambda: "qux")))
+        self.assertEquals(1300.5, self.cache._store.get("baz")[0].soft_timeout)
+
+        @self.cache.antidogpiled()
+        def double(x):
+            return x * 2
+
+        self.assertEquals(4, double(2))
+        self.assertEquals(1300.5, self.cache._store.get(
+            double.cache_key(2))[0].soft_timeout)
+
+    def test_max_bytes(self):
+        """
+        Test that the least recently used values are evicted beyond the
+        memory limit.
+        """
+
+        cache = MemoryCache(self.id(), max_bytes=2000)
+        cache.set("foo", "x" * 1000, 10)
+        cache.set("bar", "y" * 1000, 10)
+        self.assertEquals(None, cache.get("foo"))
+        self.assertEquals("y" * 1000, cache.get("bar"))
+
+
+class HashRingTestCase(TestCase):
+    """
+    Tests for the HashRing class.
+    """
+
+    def test_layout(self):
+        """
+        Test that each node gets 160 points, scaled by the weights.
+        """
+
+        ring = HashRing(["a:11211", "b:11211"])
+        self.assertEquals(320, len(ring._points))
+        self.assertEquals(sorted(ring._points), ring._points)
+
+        ring = HashRing(["a:11211", "b:11211"], {"a:11211": 3})
+        self.assertEquals(240, ring._nodes.count("a:11211"))
+        self.assertEquals(80, ring._nodes.count("b:11211"))
+
+    def test_get_node(self):
+        """
+        Test that keys go to the node of the first point at or after their
+        hash, wrapping around.
+        """
+
+        ring = HashRing(["a:11211", "b:11211", "c:11211"])
+        key = "foo"
+        index = [point >= ring.hash(key)
+                 for point in ring._points + [2 ** 32]].index(True)
+        self.assertEquals(ring._nodes[index % len(ring._nodes)],
+                          ring.get_node(key))
+        self.assertRaises(ValueError, HashRing([]).get_node, key)
+
+    def test_libketama(self):
+        """
+        Test the layout and the nodes picked against the output of libketama,
+        with weights giving a different number of points in double precision.
+        """
+
+        nodes = ["10.0.0.1:11211", "10.0.0.2:11211", "10.0.0.3:11211"]
+        ring = HashRing(nodes, dict(zip(nodes, [18, 21, 1])))
+        self.assertEquals([216, 248, 12],
+                          [ring._nodes.count(node) for node in nodes])
+        self.assertEquals(
+            [nodes[1], nodes[0], nodes[0], nodes[1], nodes[0], nodes[0],
+             nodes[1], nodes[0], nodes[1], nodes[0]],
+            [ring.get_node(key) for key in [
+                "foo", "bar", "baz", "qux", "quux", "corge", "grault",
+                "garply", "waldo", "fred"]])
+
+    def test_consistency(self):
+        """
+        Test that adding a node only moves keys to that node, about its share
+        of them.
+        """
+
+        keys = ["key%d" % i for i in range(1000)]
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b", "c", "d"])
+        moved = [key for key in keys
+                 if before.get_node(key) != after.get_node(key)]
+        self.assertEquals(set(["d"]),
+                          set(after.get_node(key) for key in moved))
+        self.assertTrue(150 < len(moved) < 350)
+
+
+class FakeNode(object):
+    """
+    In-process stand-in for a Django Memcached backend, pickling the values
+    into a dict per server, by their keys made like Django's. It fails every
+    call while its server is down.
+    """
+
+    stores = {}
+    down = set()
+    calls = []
+
+    def __init__(self, server, params):
+        self.server = server
+        self.params = params
+        self.store = self.stores.setdefault(server, {})
+
+    def _call(self, method, *args):
+        self.calls.append((self.server, method) + args)
+        if self.server in self.down:
+            raise IOError("Connection refused")
+
+    def make_key(self, key, version=None):
+        return "%s:%s:%s" % (self.params.get("KEY_PREFIX", ""),
+                             version or self.params.get("VERSION", 1), key)
+
+    def add(self, key, value, timeout=None, version=None):
+        self._call("add", key)
+        key = self.make_key(key, version)
+        if key in self.store:
+            return False
+        self.store[key] = pickle.dumps(value)
+        return True
+
+    def set(self, key, value, timeout=None, version=None):
+        self._call("set", key)
+        self.store[self.make_key(key, version)] = pickle.dumps(value)
+
+    def get(self, key, default=None, version=None):
+        self._call("get", key)
+        key = self.make_key(key, version)
+        if key not in self.store:
+            return default
+        return pickle.loads(self.store[key])
+
+    def delete(self, key, version=None):
+        self._call("delete", key)
+        return self.store.pop(self.make_key(key, version), None) is not None
+
+    def get_many(self, keys, version=None):
+        self._call("get_many", sorted(keys))
+        made = dict((key, self.make_key(key, version)) for key in keys)
+        return dict((key, pickle.loads(self.store[made[key]])) for key in keys
+                    if made[key] in self.store)
+
+    def set_many(self, data, timeout=None, version=None):
+        self._call("set_many", sorted(data))
+        for key, value in data.items():
+            self.store[self.make_key(key, version)] = pickle.dumps(value)
+        return []
+
+    def delete_many(self, keys, version=None):
+        self._call("delete_many", sorted(keys))
+        for key in keys:
+            self.store.pop(self.make_key(key, version), None)
+
+
+@requires_django
+class MultiNodeTestCase(TestCase):
+    """
+    Tests for the ConsistentHashingBackend class, and the MultiNodeCache
+    backend.
+    """
+
+    def setUp(self):
+        self.servers = ["%s-a:11211" % self.id(), "%s-b:11211" % self.id()]
+        self.params = {"OPTIONS": {"NODE_BACKEND": FakeNode,
+                                   "RETRY_TIMEOUT": 0.05, "foo": "bar"}}
+        self.backend = ConsistentHashingBackend(";".join(self.servers),
+                                                self.params)
+        del FakeNode.calls[:]
+        FakeNode.down.clear()
+
+        # Keys on both nodes
+        self.keys = dict((self.backend._node(key), key) for key in
+                         ["key%d" % i for i in range(100)])
+        self.a, self.b = self.keys[self.servers[0]], self.keys[self.servers[1]]
+
+    def test_nodes(self):
+        """
+        Test that the options of the backend are not passed on to the nodes,
+        and that the keys are kept on their nodes.
+        """
+
+        node = self.backend._nodes[self.servers[0]]
+        self.assertEquals({"foo": "bar"}, node.params["OPTIONS"])
+
+        self.backend.set(self.a, "x")
+        self.backend.set(self.b, "y")
+        self.assertEquals([":1:" + self.a],
+                          list(FakeNode.stores[self.servers[0]]))
+        self.assertEquals([":1:" + self.b],
+                          list(FakeNode.stores[self.servers[1]]))
+        self.assertEquals("x", self.backend.get(self.a))
+        self.assertTrue(self.backend.delete(self.a))
+        self.assertEquals("z", self.backend.get(self.a, "z"))
+
+    def test_placement(self):
+        """
+        Test that the keys are placed by the keys as made for the nodes, like
+        by ketama clients, so each version of a key has its own node.
+        """
+
+        params = dict(self.params, KEY_PREFIX="p", VERSION=3)
+        backend = ConsistentHashingBackend(self.servers, params)
+        for i in range(50):
+            backend.set("key%d" % i, i)
+            backend.set_many({"key%d" % i: -i}, version=4)
+
+        ring = backend._ring
+        for server in self.servers:
+            for key in FakeNode.stores[server]:
+                self.assertEquals(server, ring.get_node(key))
+        self.assertEquals(100, sum(len(FakeNode.stores[server])
+                                   for server in self.servers))
+        self.assertEquals(7, backend.get("key7"))
+        self.assertEquals({"key7": -7}, backend.get_many(["key7"], 4))
+
+    def test_bulk(self):
+        """
+        Test that bulk calls are made once per node, concurrently.
+        """
+
+        barrier = threading.Barrier(2, timeout=5)
+        get_many = FakeNode.get_many
+
+        def concurrent_get_many(node, keys, version=None):
+            barrier.wait()
+            return get_many(node, keys, version)
+
+        self.assertEquals([], self.backend.set_many({self.a: 1, self.b: 2}))
+        with patch.object(FakeNode, "get_many", concurrent_get_many):
+            self.assertEquals({self.a: 1, self.b: 2},
+                              self.backend.get_many([self.a, self.b, "x"]))
+        self.backend.delete_many([self.a, self.b])
+        self.assertEquals({}, self.backend.get_many([self.a, self.b]))
+
+        self.assertEquals(
+            [(self.servers[0], "set_many", [self.a]),
+             (self.servers[1], "set_many", [self.b])],
+            sorted(FakeNode.calls[:2]))
+        self.assertEquals(2, len([call for call in FakeNode.calls
+                                  if call[1] == "delete_many"]))
+
+    def test_workers_busy(self):
+        """
+        Test that bulk calls are made in the calling thread while all workers
+        are busy with a hanging node, instead of queueing behind it.
+        """
+
+        servers = self.servers + ["%s-c:11211" % self.id()]
+        backend = ConsistentHashingBackend(servers, self.params)
+        a, b, c = [dict((backend._node(key), key)
+                        for key in ["key%d" % i for i in range(100)])[server]
+                   for server in servers]
+        hanging, release = threading.Semaphore(0), threading.Event()
+        get_many = FakeNode.get_many
+
+        def hanging_get_many(node, keys, version=None):
+            if node.server == servers[0]:
+                hanging.release()
+                release.wait(5)
+            return get_many(node, keys, version)
+
+        with patch.object(FakeNode, "get_many", hanging_get_many):
+            # Each client gets b in its own thread, and a in a worker
+            clients = [threading.Thread(target=backend.get_many,
+                                        args=([b, a],))
+                       for i in range(len(servers))]
+            for client in clients:
+                client.start()
+            for client in clients:
+                self.assertTrue(hanging.acquire(timeout=5))
+
+            started = time.time()
+            backend.set_many({b: 1, c: 2})
+            self.assertEquals({b: 1, c: 2}, backend.get_many([b, c]))
+            self.assertTrue(time.time() - started < 1)
+
+            release.set()
+            for client in clients:
+                client.join(5)
+        self.assertEquals({b: 1, c: 2}, backend.get_many([a, b, c]))
+        self.assertEquals({}, backend.get_many([]))
+
+    def test_node_down(self):
+        """
+        Test that the keys of a node which is down are misses, that writes to
+        it fail silently, and that it is not called again until the retry
+        timeout.
+        """
+
+        self.backend.set_many({self.a: 1, self.b: 2})
+        FakeNode.down.add(self.servers[0])
+        del FakeNode.calls[:]
+
+        self.assertEquals(None, self.backend.get(self.a))
+        self.assertEquals({self.b: 2},
+                          self.backend.get_many([self.a, self.b]))
+        self.assertEquals([self.a], self.backend.set_many({self.a: 3,
+                                                           self.b: 4}))
+        self.assertFalse(self.backend.add(self.a, 5))
+        self.assertTrue(self.backend.is_down(self.a))
+        self.assertFalse(self.backend.is_down(self.b))
+        self.backend.set(self.a, 6)
+        self.assertEquals(1, len([call for call in FakeNode.calls
+                                  if call[0] == self.servers[0]]))
+
+        FakeNode.down.clear()
+        time.sleep(0.06)
+        self.assertEquals(1, self.backend.get(self.a))
+
+    def test_anti_dogpiling(self):
+        """
+        Test that the renewal write-backs of a bulk get take one bulk set per
+        node, and that a node which is down degrades to misses.
+        """
+
+        self.now = 1000.5
+        cache = MultiNodeCache(self.servers, dict(
+            self.params, OPTIONS=dict(self.params["OPTIONS"],
+                                      clock=lambda: self.now)))
+        cache.set_many({self.a: "x", self.b: "y"}, 10)
+        self.now = 1011
+
+        del FakeNode.calls[:]
+        self.assertEquals({}, cache.get_many([self.a, self.b]))
+        self.assertEquals(
+            [(self.servers[0], "get_many", [self.a]),
+             (self.servers[0], "set_many", [self.a]),
+             (self.servers[1], "get_many", [self.b]),
+             (self.servers[1], "set_many", [self.b])],
+            sorted(FakeNode.calls))
+        self.assertEquals({self.a: "x", self.b: "y"},
+                          cache.get_many([self.a, self.b]))
+
+        # The lease of a key on a node which is down is not waited for
+        FakeNode.down.add(self.servers[0])
+        producer = Mock(return_value="z")
+        with patch("time.sleep") as sleep:
+            self.assertEquals("z", cache.get_or_set(self.a, producer, 10))
+        self.assertFalse(sleep.called)
+        self.assertFalse(cache.add(self.a, "w"))
+        self.assertEquals("y", cache.get(self.b))
+
+        async def aget_or_set():
+            with patch("asyncio.sleep") as sleep:
+                self.assertEquals("z", await cache.aget_or_set(
+                    self.a, producer, 10))
+            self.assertFalse(sleep.called)
+
+        asyncio.run(aget_or_set())